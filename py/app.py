@@ -1,32 +1,41 @@
 import sys
-import pandas as pd
-import numpy as np
-from sklearn.cluster import KMeans
-from spotify_recc import authenticate_spotify, extract_track_id, get_track_details, get_related_artists, get_related_top, get_related_features, recommend_tracks
-from movie_recc import preprocess_text as preprocess_movie_text, compute_features, cosine_similarity_matrix, get_recommendations, extract_imdb_id, fill_missing_info
-from book_recc import fetch_book_details, extract_volume_id, format_book_data, preprocess_text as preprocess_book_text, compute_similarity, find_recommendations, search_google_books
+import os
+from spotify_recc import get_spotify_client, extract_track_id, get_track_details, get_related_artists, get_related_top, get_related_features
+from track_store import add_and_recommend
+from upstream import gather
+from movie_recc import extract_imdb_id
+from movie_index import load_movie_index
+from book_recc import extract_volume_id, search_google_books, NO_LINKS
+from book_index import load_book_index
 
-sp = None
-sp = authenticate_spotify()
+def prompt_spotify_client():
+    # Credentials come from the environment, or are asked for, only when a Spotify link is given
+    client_id = os.environ.get("SPOTIFY_CLIENT_ID") or input("Enter your Spotify client ID: ")
+    client_secret = os.environ.get("SPOTIFY_CLIENT_SECRET") or input("Enter your Spotify client secret: ")
+    return get_spotify_client(client_id, client_secret)
 
-def main(sp):
+def main(sp=None):
     link = input("Please paste a Spotify track URL, an IMDb link, or a Google Books URL: ")
 
     # Check if the link is a Spotify link
     if "open.spotify.com" in link or "spotify:track:" in link:
+        if sp is None:
+            sp = prompt_spotify_client()
+        if sp is None:
+            print("Spotify authentication failed. Please check your credentials and try again.")
+            sys.exit(1)
+
         spotify_url = link
         track_id = extract_track_id(spotify_url)
         track_data = get_track_details(sp, track_id)
-        artist_id = track_data['artist_id']
+        track = track_data.record(0)
+        artist_id = track['artist_id']
         related_artists = get_related_artists(sp, artist_id)
         top_artist_rel = get_related_top(sp, related_artists)
         track_features = get_related_features(sp, top_artist_rel)
-        X = np.array([[f['energy'], f['tempo'], f['valence']] for f in track_features])
-        kmeans = KMeans(n_clusters=5, random_state=0).fit(X)
-
-        recommended_tracks = recommend_tracks(track_data, track_features, kmeans)
-        print(f"Recommendations for '{track_data['name']}' by {track_data['artist']}:")
-        for track in recommended_tracks:
+        recommended_tracks = add_and_recommend(track_data, track_features)
+        print(f"Recommendations for '{track['name']}' by {track['artist']}:")
+        for track in recommended_tracks.to_records():
             print(f"Title: {track['name']}\n"
                   f"Album: {track['album']}\n"
                   f"Artist: {track['artist']}\n"
@@ -35,19 +44,10 @@ def main(sp):
     
     # Check if the link is an IMDb link
     elif "imdb.com/title/tt" in link:
-        df = pd.read_csv("imdb-movies-dataset.csv")
-        df['Genre'] = df['Genre'].fillna('')
-        df['Genre'] = df['Genre'].astype(str)
-        df['Genre'] = df['Genre'].apply(lambda x: x.split(', '))
-
         imdb_id = extract_imdb_id(link)
         if imdb_id:
-            df = fill_missing_info(df, imdb_id)
-            if not df.empty:
-                df['preprocessed_description'] = df['Description'].apply(preprocess_movie_text)
-                combined_features = compute_features(df)
-                cosine_sim = cosine_similarity_matrix(combined_features)
-                recommendations = get_recommendations(df.iloc[-1]['Title'], cosine_sim, df)
+            movie, recommendations = load_movie_index().recommend_for_imdb_id(imdb_id)
+            if movie is not None:
                 print("Recommendations:")
                 for movie in recommendations:
                     print(f"Title: {movie['Title']}")
@@ -65,41 +65,20 @@ def main(sp):
     
     # Check if the link is a Google Books link
     elif "books/edition/" in link:
-        df = pd.read_csv("goodreads_data.csv")
-        df.drop(columns=["Unnamed: 0", "URL"], inplace=True)
-        df.dropna(inplace=True)
-        df["Genres"] = df["Genres"].str.split(", ").apply(lambda x: [genre.strip("[]") for genre in x])
-        df["Genres"] = df["Genres"].apply(lambda x: ', '.join(x))
-        df["Genres"] = df["Genres"].apply(lambda x: x.replace("'", ""))
-
         volume_id = extract_volume_id(link)
-        book_data = fetch_book_details(volume_id)
-        formatted_data = format_book_data(book_data)
-
-        input_book = formatted_data["Book"]
-        input_description = preprocess_book_text(formatted_data["Description"])
-        input_genres = preprocess_book_text(formatted_data["Genres"])
-
-        input_book_df = pd.DataFrame([{
-            "Book": input_book,
-            "Description": input_description,
-            "Genres": input_genres,
-            "Author": formatted_data["Author"]
-        }])
-
-        df_extended = pd.concat([df, input_book_df], ignore_index=True)
-        description_similarity, genre_similarity = compute_similarity(df_extended["Description"], df_extended["Genres"])
-        input_book_idx = df_extended.index[df_extended["Book"] == input_book][0]
-        recommendations = find_recommendations(input_book_idx, df_extended, description_similarity, genre_similarity)
+        book, recommendations = load_book_index().recommend_for_volume_id(volume_id) if volume_id else (None, [])
+        if book is None:
+            print("Failed to retrieve book information from Google Books.")
+            sys.exit(1)
 
-        print(f"Recommendations for '{input_book}':")
-        for book, author in recommendations:
-            cover_url, book_url = search_google_books(book, author)
-            book_row = df_extended[df_extended['Book'] == book].iloc[0]
-            print(f"Title: {book}")
-            print(f"Author: {author}")
-            print(f"Description: {book_row['Description']}")
-            print(f"Genres: {book_row['Genres']}")
+        print(f"Recommendations for '{book['Book']}':")
+        book_links = gather([(search_google_books, row['Book'], row['Author']) for row in recommendations], default=NO_LINKS)
+        book_links = [links or NO_LINKS for links in book_links]
+        for row, (cover_url, book_url) in zip(recommendations, book_links):
+            print(f"Title: {row['Book']}")
+            print(f"Author: {row['Author']}")
+            print(f"Description: {row['Description']}")
+            print(f"Genres: {row['Genres']}")
             print(f"Cover: {cover_url}")
             print(f"Link: {book_url}")
             print()
@@ -109,6 +88,4 @@ def main(sp):
         sys.exit(1)
 
 if __name__ == "__main__":
-    if sp == None:
-        sp = authenticate_spotify()
-    main(sp)
+    main()
@@ -0,0 +1,239 @@
+import atexit
+import fcntl
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from cache import DEFAULT_TTLS
+from track_batch import TrackBatch, TrackTable
+
+ARTIST_GRAPH_PATH = "artist_graph.json"
+RELATED_MAX_AGE = DEFAULT_TTLS['spotify.related_artists']  # Older entries are refreshed (in the background when prefetching)
+TOP_TRACKS_MAX_AGE = DEFAULT_TTLS['spotify.top_tracks']
+PREFETCH_WORKERS = int(os.environ.get("RECC_PREFETCH_WORKERS", 4))  # 0 disables prefetching
+PREFETCH_DEPTH = int(os.environ.get("RECC_PREFETCH_DEPTH", 1))  # Hops from a queried artist warmed in the background
+MAX_PREFETCH_QUEUE = 10000
+MAX_RECENT_ARTISTS = 1000  # Queried artists whose neighbourhoods are kept fresh
+REFRESH_INTERVAL = 3600
+SAVE_INTERVAL = 300
+
+logger = logging.getLogger(__name__)
+
+class ArtistGraph:
+    # Related-artist adjacency lists and per-artist top tracks (columnar, see track_batch),
+    # filled on demand by requests. Once an artist is queried, a small worker pool fetches its
+    # neighbourhood up to PREFETCH_DEPTH hops, so following a recommendation to the next artist
+    # is served locally, and re-fetches entries of recently queried artists once they go stale.
+    def __init__(self, path=None, warm=None, workers=PREFETCH_WORKERS, forward=None):
+        self.path = path
+        self.warm = warm  # warm(artist_id, related): fetch whatever of the artist is missing or stale
+        self.workers = workers
+        self.forward = forward  # forward(artist_id): hand queried artists to the process that prefetches instead
+        self.lock = threading.RLock()
+        self.related = {}  # artist ID -> (fetched_at, [related artist IDs])
+        self.top = {}  # artist ID -> (fetched_at, [top track IDs])
+        self.tracks = TrackTable()  # Every top track fetched, with its audio features
+        self.recent = OrderedDict()  # queried artist IDs, most recent last
+        self.queue = queue.PriorityQueue(MAX_PREFETCH_QUEUE)
+        self.queued = set()
+        self.counter = itertools.count()  # Tie-break: first queued, first fetched within a hop
+        self.threads = []
+        self.saver = None
+        self.dirty = False
+        self.disk_mtime = None
+        if path and os.path.exists(path):
+            self.load()
+        if path and forward is not None:
+            self.start_saver()  # Also picks up what the prefetching process saves
+
+    def related_artists(self, artist_id):
+        entry = self.related.get(artist_id)
+        return entry[1] if entry is not None else None
+
+    def set_related(self, artist_id, related_ids):
+        with self.lock:
+            self.related[artist_id] = (time.time(), list(related_ids))
+            self.mark_dirty()
+
+    def top_tracks(self, artist_id):
+        entry = self.top.get(artist_id)
+        return entry[1] if entry is not None else None
+
+    def set_top(self, artist_id, track_ids):
+        with self.lock:
+            self.top[artist_id] = (time.time(), list(track_ids))
+            self.mark_dirty()
+
+    def add_tracks(self, batch):
+        if self.tracks.add(batch):
+            self.mark_dirty()
+
+    def stale(self, entries, artist_id, max_age):
+        entry = entries.get(artist_id)
+        return entry is None or time.time() - entry[0] > max_age
+
+    def needs_related(self, artist_id):
+        return self.stale(self.related, artist_id, RELATED_MAX_AGE)
+
+    def needs_top(self, artist_id):
+        return self.stale(self.top, artist_id, TOP_TRACKS_MAX_AGE)
+
+    def prefetching(self):
+        # Without workers nothing refreshes stale entries, so requests fetch them themselves
+        return self.forward is not None or (self.warm is not None and self.workers > 0)
+
+    def touch(self, artist_id):
+        # A request used this artist: keep it fresh and warm its neighbourhood in the background
+        if self.forward is not None:
+            self.forward(artist_id)
+            return
+        if not self.prefetching():
+            return
+        with self.lock:
+            self.recent[artist_id] = None
+            self.recent.move_to_end(artist_id)
+            while len(self.recent) > MAX_RECENT_ARTISTS:
+                self.recent.popitem(last=False)
+        self.start()
+        self.enqueue(artist_id, 0)
+
+    def enqueue(self, artist_id, depth):
+        with self.lock:
+            if artist_id in self.queued:
+                return
+            self.queued.add(artist_id)
+        try:
+            # Nearest hops first: they are the next requests' artists
+            self.queue.put_nowait((depth, next(self.counter), artist_id))
+        except queue.Full:
+            with self.lock:
+                self.queued.discard(artist_id)  # Fetched by the request that needs it instead
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.threads = [threading.Thread(target=self.work, name=f'artist-prefetch-{i}', daemon=True)
+                            for i in range(self.workers)]
+            self.threads.append(threading.Thread(target=self.maintain, name='artist-refresh', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def work(self):
+        while True:
+            depth, _, artist_id = self.queue.get()
+            try:
+                # The outermost hop only needs its top tracks, not its own adjacency list
+                self.warm(artist_id, depth < PREFETCH_DEPTH)
+            except Exception:
+                logger.exception("Prefetching artist %s failed", artist_id)
+            finally:
+                with self.lock:
+                    self.queued.discard(artist_id)
+            if depth < PREFETCH_DEPTH:
+                for related_id in self.related_artists(artist_id) or []:
+                    self.enqueue(related_id, depth + 1)
+
+    def maintain(self):
+        # Re-walk recently queried artists every REFRESH_INTERVAL (only stale entries are fetched)
+        while True:
+            time.sleep(REFRESH_INTERVAL)
+            with self.lock:
+                recent = list(self.recent)
+            for artist_id in recent:
+                self.enqueue(artist_id, 0)
+
+    def mark_dirty(self):
+        # Saving doesn't depend on prefetching: with RECC_PREFETCH_WORKERS=0 requests still fill the graph
+        self.dirty = True
+        if self.path and self.saver is None:
+            self.start_saver()
+
+    def start_saver(self):
+        with self.lock:
+            if self.saver is not None:
+                return
+            self.saver = threading.Thread(target=self.autosave, name='artist-graph-save', daemon=True)
+            atexit.register(self.save_if_dirty)
+        self.saver.start()
+
+    def autosave(self):
+        # Every SAVE_INTERVAL if the graph changed, and once more at exit; a clean graph instead
+        # picks up what other processes saved (save() merges the file in anyway)
+        while True:
+            time.sleep(SAVE_INTERVAL)
+            if self.dirty:
+                self.save_if_dirty()
+            else:
+                self.reload_if_changed()
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self.disk_mtime:
+                self.merge(read_graph(self.path))
+                self.disk_mtime = mtime
+        except (OSError, ValueError):
+            logger.exception("Reading the artist graph from %s failed", self.path)
+
+    def save_if_dirty(self):
+        if self.dirty and self.path:
+            try:
+                self.save()
+            except OSError:
+                logger.exception("Saving the artist graph to %s failed", self.path)
+
+    def clear(self):
+        with self.lock:
+            self.related.clear()
+            self.top.clear()
+            self.tracks.clear()
+            self.mark_dirty()
+
+    def save(self):
+        # Merge-on-write: serve.py workers each keep a graph and save the same file, so what is on disk
+        # is merged in first (under a file lock), keeping the newest entry per artist. Reading and
+        # writing happen outside self.lock, which requests take; it is held only to merge and snapshot.
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(self.path):
+                self.merge(read_graph(self.path))
+            with self.lock:
+                related, top = dict(self.related), dict(self.top)
+                tracks = self.tracks.batch()  # Rows are only ever appended, so this view stays valid
+                self.dirty = False
+            try:
+                data = {'related': related, 'top': top, 'tracks': tracks.to_state()}
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+                self.disk_mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                self.dirty = True
+                raise
+
+    def load(self):
+        with self.lock:
+            self.related, self.top = {}, {}
+            self.tracks = TrackTable()
+            self.disk_mtime = os.stat(self.path).st_mtime_ns
+            self.merge(read_graph(self.path))
+            self.dirty = False
+
+    def merge(self, data):
+        tracks = TrackBatch.from_state(data['tracks'], self.tracks.strings)  # Interned once, not recoded
+        with self.lock:
+            for entries, saved in ((self.related, data['related']), (self.top, data['top'])):
+                for artist_id, entry in saved.items():
+                    if artist_id not in entries or entries[artist_id][0] < entry[0]:
+                        entries[artist_id] = tuple(entry)
+            self.tracks.add(tracks)
+
+def read_graph(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+from spotify_recc import get_spotify_client, extract_track_id, get_track_details, get_related_artists, get_related_top, get_related_features
+from track_store import get_track_store
+from track_batch import TrackBatch
+from upstream import gather, batch_timeout
+from movie_recc import extract_imdb_id
+from movie_index import load_movie_index
+from book_recc import extract_volume_id, search_google_books, NO_LINKS
+from book_index import load_book_index
+
+# Batch mode: many mixed links in, one JSON object per link out, streamed type by type.
+#   python batch.py links.txt            one link per line, or a JSON list of links
+#   python batch.py - < links.json
+# Each line carries the link's position in the input ('index'), since lines come out grouped by type.
+UNSUPPORTED_LINK = "Unsupported link format. Please provide a Spotify track URL, an IMDb link, or a Google Books URL."
+SPOTIFY_CHUNK_LINKS = 8  # Spotify links whose upstream lookups are fanned out together
+
+def link_type(link):
+    # (type, ID), with the same checks as the single-link paths; ID is None if the link doesn't parse
+    if "open.spotify.com" in link or "spotify:track:" in link:
+        try:
+            return 'spotify', extract_track_id(link)
+        except ValueError:
+            return 'spotify', None
+    if "imdb.com/title/tt" in link:
+        return 'imdb', extract_imdb_id(link)
+    if "books" in link:
+        return 'books', extract_volume_id(link)
+    return None, None
+
+def result(index, link, kind, query=None, recommendations=None, error=None):
+    if error is not None:
+        return {'index': index, 'link': link, 'type': kind, 'error': error}
+    return {'index': index, 'link': link, 'type': kind, 'query': query, 'recommendations': recommendations}
+
+def positions(items):
+    # ID -> [(index, link), ...]; a repeated link is looked up once and answered for every position
+    by_key = defaultdict(list)
+    for index, link, key in items:
+        by_key[key].append((index, link))
+    return by_key
+
+def spotify_results(items, sp, n_recommendations):
+    if sp is None:
+        for index, link, _ in items:
+            yield result(index, link, 'spotify', error="Spotify credentials are required for Spotify links.")
+        return
+    by_key = positions(items)
+    track_ids = list(by_key)
+    # A chunk of links at a time: each link fans out to ~20 related artists and their ~200 top tracks,
+    # so one fan-out for the whole batch would be thousands of calls racing a single timeout
+    for start in range(0, len(track_ids), SPOTIFY_CHUNK_LINKS):
+        yield from spotify_chunk_results(track_ids[start:start + SPOTIFY_CHUNK_LINKS], by_key, sp, n_recommendations)
+
+def spotify_chunk_results(track_ids, by_key, sp, n_recommendations):
+    details = dict(zip(track_ids, gather([(get_track_details, sp, track_id) for track_id in track_ids],
+                                         batch_timeout(len(track_ids)))))
+
+    # One related-artists lookup per distinct artist and one top-tracks lookup per distinct related artist
+    found = [track for track in details.values() if track is not None]
+    artist_ids = list(dict.fromkeys(TrackBatch.concat(found).column('artist_id').tolist()))
+    related = gather([(get_related_artists, sp, artist_id) for artist_id in artist_ids], batch_timeout(len(artist_ids)), [])
+    related_ids = list(dict.fromkeys(artist_id for artists in related for artist_id in artists))
+    track_features = get_related_features(sp, get_related_top(sp, related_ids))
+
+    store = get_track_store()
+    store.add(TrackBatch.concat(found + [track_features]))
+    for track_id in track_ids:
+        track_data = details[track_id]
+        if track_data is not None:
+            query, recommended = track_data.record(0), store.recommend(track_data, n_recommendations).to_records()
+        for index, link in by_key[track_id]:
+            if track_data is None:
+                yield result(index, link, 'spotify', error="Failed to retrieve track information from Spotify.")
+            else:
+                yield result(index, link, 'spotify', query, recommended)
+
+def movie_results(items, index, n_recommendations):
+    by_key = positions(items)
+    for imdb_id, movie, recs in index.recommend_for_imdb_ids(list(by_key), k=n_recommendations):
+        recommended = [dict(zip(recs.dtype.names, rec)) for rec in recs] if movie is not None else None
+        for position, link in by_key[imdb_id]:
+            if movie is None:
+                yield result(position, link, 'imdb', error="Failed to retrieve movie information from IMDb.")
+            else:
+                yield result(position, link, 'imdb', movie, recommended)
+
+def book_results(items, index, n_recommendations):
+    by_key = positions(items)
+    found = list(index.recommend_for_volume_ids(list(by_key), n_recommendations))
+    # Cover/link lookups for every distinct recommended book in the batch, run concurrently
+    pairs = list(dict.fromkeys((row['Book'], row['Author']) for _, book, recs in found if book is not None for row in recs))
+    links = dict(zip(pairs, gather([(search_google_books, *pair) for pair in pairs], batch_timeout(len(pairs)), NO_LINKS)))
+    links = {pair: value or NO_LINKS for pair, value in links.items()}
+    for volume_id, book, recs in found:
+        recommended = [dict(row, cover_url=links[row['Book'], row['Author']][0], book_url=links[row['Book'], row['Author']][1])
+                       for row in recs]
+        for position, link in by_key[volume_id]:
+            if book is None:
+                yield result(position, link, 'books', error="Failed to retrieve book information from Google Books.")
+            else:
+                yield result(position, link, 'books', book, recommended)
+
+def recommend_batch(links, sp=None, get_movie_index=load_movie_index, get_book_index=load_book_index, n_recommendations=3):
+    # One result dict per link. Links are grouped by type, each index is loaded once (and only if
+    # needed), and each group's similarity queries go through a single batched multiply.
+    groups = defaultdict(list)
+    for index, link in enumerate(links):
+        kind, key = link_type(link)
+        if kind is None:
+            yield result(index, link, None, error=UNSUPPORTED_LINK)
+        elif key is None:
+            yield result(index, link, kind, error=f"Invalid {kind} link.")
+        else:
+            groups[kind].append((index, link, key))
+    if groups['spotify']:
+        yield from spotify_results(groups['spotify'], sp, n_recommendations)
+    if groups['imdb']:
+        yield from movie_results(groups['imdb'], get_movie_index(), n_recommendations)
+    if groups['books']:
+        yield from book_results(groups['books'], get_book_index(), n_recommendations)
+
+def json_default(value):
+    # numpy scalars and arrays (scores, genre lists) in result records
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+def json_lines(results):
+    for line in results:
+        yield json.dumps(line, default=json_default) + '\n'
+
+def read_links(text):
+    # A JSON list of links, {"links": [...]}, or one link per line
+    try:
+        links = json.loads(text)
+    except ValueError:
+        return [line.strip() for line in text.splitlines() if line.strip()]
+    if isinstance(links, dict):
+        links = links.get('links', [])
+    if not isinstance(links, list):
+        raise ValueError("expected a list of links")
+    return [str(link) for link in links]
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommendations for a batch of Spotify, IMDb and Google Books links.")
+    parser.add_argument('input', help="file of links, or - for stdin")
+    parser.add_argument('--output', help="JSON lines file (default: stdout)")
+    parser.add_argument('-n', '--recommendations', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.input == '-':
+        links = read_links(sys.stdin.read())
+    else:
+        with open(args.input) as f:
+            links = read_links(f.read())
+
+    # Spotify credentials come from the environment only; batches don't prompt
+    sp = None
+    client_id, client_secret = os.environ.get("SPOTIFY_CLIENT_ID"), os.environ.get("SPOTIFY_CLIENT_SECRET")
+    if client_id and client_secret and any(link_type(link)[0] == 'spotify' for link in links):
+        sp = get_spotify_client(client_id, client_secret)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for line in json_lines(recommend_batch(links, sp, n_recommendations=args.recommendations)):
+            out.write(line)
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.metrics.pairwise import euclidean_distances
+from benchmark_fixtures import (install_http_stub, install_spotify_stub, write_imdb_csv, write_books_csv,
+                                synthetic_tracks, load_fixture)
+from cache import get_cache
+from similarity import similarity_scores, top_k
+from catalogues import load_imdb_catalogue, load_books_catalogue
+from movie_recc import preprocess_descriptions as preprocess_movie_descriptions, fit_features as fit_movie_features, fetch_omdb_movie
+from movie_index import MovieIndex, CANDIDATE_POOL as MOVIE_CANDIDATE_POOL
+from book_recc import preprocess_descriptions as preprocess_book_descriptions, fit_features as fit_book_features, fetch_book, search_google_books, NO_LINKS
+from book_index import BookIndex, CANDIDATE_POOL as BOOK_CANDIDATE_POOL
+import spotify_recc
+from artist_graph import ArtistGraph
+from spotify_recc import get_track_details, get_related_artists, get_related_top, get_related_features
+from track_batch import ID
+import track_store
+from track_store import TrackStore
+from upstream import gather
+import web_app
+
+# Offline benchmarks of the three pipelines, stage by stage, on synthetic catalogues.
+# Upstream APIs are replayed from fixtures/; results are written as JSON for comparing commits:
+#   python benchmark.py --sizes 10000 100000 --output before.json
+#   python benchmark.py --sizes 10000 100000 --compare before.json
+SIZES = [10000, 100000, 1000000]
+PIPELINES = ['movies', 'books', 'spotify', 'route']
+REPEATS = 5  # Per query-time stage; build stages (load, preprocess, vectorise, index) run once
+OUTPUT_PATH = "benchmark_results.json"
+REGRESSION_THRESHOLD = 1.25  # Median slower than the baseline by this factor is a regression
+NO_STORE_DIR = "no_store"  # Makes the catalogue loaders read the CSV
+
+SPOTIFY_LINK = "https://open.spotify.com/track/3n3Ppam7vgaVa1iaRUc9Lp"
+IMDB_LINK = "https://www.imdb.com/title/tt1375666/"
+BOOKS_LINK = "https://www.google.com/books/edition/_/zyTCAlFPjgYC"
+SPOTIFY_CREDENTIALS = ('benchmark-client-id', 'benchmark-client-secret')
+
+class Recorder:
+    def __init__(self, repeats, upstream):
+        self.repeats = repeats
+        self.upstream = upstream  # Objects with a calls Counter, e.g. the stub clients
+        self.results = []
+
+    def upstream_calls(self):
+        calls = Counter()
+        for stub in self.upstream:
+            calls.update(stub.calls)
+        return calls
+
+    def stage(self, pipeline, size, stage, func, runs=None):
+        # Runs func, keeps its last result and records wall time and upstream calls per run
+        runs = runs or self.repeats
+        timings = []
+        before = self.upstream_calls()
+        for _ in range(runs):
+            start = time.perf_counter()
+            value = func()
+            timings.append((time.perf_counter() - start) * 1000)
+        calls = self.upstream_calls() - before
+        self.results.append({
+            'pipeline': pipeline,
+            'size': size,
+            'stage': stage,
+            'runs': runs,
+            'min_ms': round(min(timings), 3),
+            'median_ms': round(statistics.median(timings), 3),
+            'mean_ms': round(statistics.mean(timings), 3),
+            'upstream_calls': {name: count / runs for name, count in sorted(calls.items())},
+        })
+        print(f"{pipeline:<8} {size:>8} {stage:<16} {statistics.median(timings):10.2f} ms", flush=True)
+        return value
+
+def uncached(func):
+    # Every run goes through the (stubbed) upstream APIs
+    def run():
+        get_cache().clear()
+        spotify_recc.get_artist_graph().clear()
+        return func()
+    return run
+
+def bench_movies(recorder, size):
+    path = f"imdb_{size}.csv"
+    write_imdb_csv(path, size)
+    df = recorder.stage('movies', size, 'load', lambda: load_imdb_catalogue(path, NO_STORE_DIR), runs=1)
+    preprocessed = recorder.stage('movies', size, 'preprocess',
+                                  lambda: preprocess_movie_descriptions(df['Description'], os.cpu_count() or 1, cache=False), runs=1)
+    features, tfidf_vectorizer, mlb = recorder.stage('movies', size, 'vectorise',
+                                                     lambda: fit_movie_features(df.assign(preprocessed_description=preprocessed)), runs=1)
+
+    def build_index():
+        index = MovieIndex(df, features, tfidf_vectorizer, mlb, features_path=None, merged_path=None, delta_path=None)
+        index.ranking_codes()
+        return index
+    index = recorder.stage('movies', size, 'index', build_index, runs=1)
+
+    query = size // 2
+    title, description = df.iloc[query]['Title'], df.iloc[query]['Description']
+    scores = recorder.stage('movies', size, 'similarity', lambda: similarity_scores(index.features[query], index.features))
+
+    def rank():
+        rows, top = top_k(scores, MOVIE_CANDIDATE_POOL + 3)
+        return index.rank(df.iloc[rows], rows, top, title, description)
+    recorder.stage('movies', size, 'rank', rank)
+    imdb_id = load_fixture('omdb_movie')['imdbID']
+    recorder.stage('movies', size, 'enrich', uncached(lambda: fetch_omdb_movie(imdb_id)))
+    return index
+
+def bench_books(recorder, size):
+    path = f"books_{size}.csv"
+    write_books_csv(path, size)
+    df = recorder.stage('books', size, 'load', lambda: load_books_catalogue(path, NO_STORE_DIR), runs=1)
+
+    def preprocess():
+        n_jobs = os.cpu_count() or 1
+        return (preprocess_book_descriptions(df['Description'], n_jobs, cache=False),
+                preprocess_book_descriptions(df['Genres'].astype(str), n_jobs, cache=False))
+    descriptions, genres = recorder.stage('books', size, 'preprocess', preprocess, runs=1)
+    features, desc_vectorizer, genre_vectorizer = recorder.stage('books', size, 'vectorise',
+                                                                 lambda: fit_book_features(descriptions, genres), runs=1)
+    index = recorder.stage('books', size, 'index', lambda: BookIndex(df, features, desc_vectorizer, genre_vectorizer,
+                                                                     features_path=None, merged_path=None, delta_path=None), runs=1)
+
+    query = size // 2
+    title = df.iloc[query]['Book']
+    scores = recorder.stage('books', size, 'similarity', lambda: similarity_scores(index.features[query], index.features))
+    recommendations = recorder.stage('books', size, 'rank',
+                                     lambda: index.rank(df, top_k(scores, BOOK_CANDIDATE_POOL + 3)[0], title))
+
+    volume_id = load_fixture('google_books_volume')['id']
+
+    def enrich():
+        fetch_book(volume_id)
+        return [links or NO_LINKS for links in
+                gather([(search_google_books, row['Book'], row['Author']) for row in recommendations], default=NO_LINKS)]
+    recorder.stage('books', size, 'enrich', uncached(enrich))
+    return index
+
+def bench_spotify(recorder, size, sp):
+    tracks = synthetic_tracks(size)
+    store = TrackStore()
+    recorder.stage('spotify', size, 'load', lambda: store.add(tracks), runs=1)
+    recorder.stage('spotify', size, 'vectorise', store.rebuild_index, runs=1)
+
+    track_id = load_fixture('spotify_track')['id']
+
+    def enrich():
+        track_data = get_track_details(sp, track_id)
+        related_artists = get_related_artists(sp, track_data.column('artist_id')[0])
+        return track_data, get_related_features(sp, get_related_top(sp, related_artists))
+    track_data, track_features = recorder.stage('spotify', size, 'enrich', uncached(enrich))
+    recorder.stage('spotify', size, 'similarity', lambda: store.nearest(track_data.features[0], 13))
+    recorder.stage('spotify', size, 'rank', lambda: store.recommend(track_data))
+    recorder.stage('spotify', size, 'render', lambda: store.recommend(track_data).to_records())
+
+    # The original app's KMeans ranking (recommend_tracks below), over the related tracks
+    def kmeans_rank():
+        model = KMeans(n_clusters=min(5, len(track_features)), n_init=10, random_state=0)
+        model.fit(track_features.features)
+        return recommend_tracks(track_data, track_features, model)
+    recorder.stage('spotify', size, 'rank_kmeans', kmeans_rank)
+    return store
+
+def recommend_tracks(track_data, track_features, kmeans_model, n_recommendations=3):
+    # The original app's ranking, kept as a baseline for the KD-tree: nearest tracks in the input's cluster.
+    # track_data and track_features are TrackBatches; the model was fitted on track_features.features
+    track_data = track_data.recode(track_features.strings)
+    input_features = track_data.features[:1]
+    input_cluster = kmeans_model.predict(input_features)[0]
+
+    cluster_tracks = track_features[np.flatnonzero(kmeans_model.labels_ == input_cluster)]
+
+    distances = euclidean_distances(input_features, cluster_tracks.features)[0]
+    closest_indices = distances.argsort()[:n_recommendations + 1]  # Get one extra to account for input track
+    closest_indices = closest_indices[cluster_tracks.codes[closest_indices, ID] != track_data.codes[0, ID]]
+
+    return cluster_tracks[closest_indices[:n_recommendations]]
+
+def bench_route(recorder, size, movie_index, book_index, store):
+    # /recommend end to end through Flask's test client, on the indexes built above
+    web_app.indexes.update({name: index for name, index in (('imdb', movie_index), ('books', book_index)) if index is not None})
+    if store is not None:
+        track_store._track_store = store
+    client = web_app.app.test_client()
+    client_id, client_secret = SPOTIFY_CREDENTIALS
+    links = {'spotify': (SPOTIFY_LINK, store), 'imdb': (IMDB_LINK, movie_index), 'books': (BOOKS_LINK, book_index)}
+    for branch, (link, prerequisite) in links.items():
+        if prerequisite is None:
+            continue
+
+        def post():
+            response = client.post('/recommend', data={'link': link, 'spotify_client_id': client_id,
+                                                       'spotify_client_secret': client_secret})
+            if response.status_code != 200:
+                raise RuntimeError(f"/recommend returned {response.status_code} for {link}")
+            return response
+        recorder.stage('route', size, branch, uncached(post))
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline_path, threshold):
+    # Prints median ratios against a baseline file; True if any stage regressed
+    with open(baseline_path) as f:
+        baseline = {(r['pipeline'], r['size'], r['stage']): r for r in json.load(f)['results']}
+    regressed = False
+    for result in results:
+        before = baseline.get((result['pipeline'], result['size'], result['stage']))
+        if before is None or before['median_ms'] <= 0:
+            continue
+        ratio = result['median_ms'] / before['median_ms']
+        status = 'REGRESSION' if ratio > threshold else 'ok'
+        regressed = regressed or ratio > threshold
+        print(f"{result['pipeline']:<8} {result['size']:>8} {result['stage']:<16} "
+              f"{before['median_ms']:10.2f} -> {result['median_ms']:10.2f} ms  x{ratio:.2f}  {status}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recommendation pipelines offline.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--pipelines', nargs='+', choices=PIPELINES, default=PIPELINES)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--output', default=OUTPUT_PATH)
+    parser.add_argument('--compare', help="baseline results file to compare against")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument('--keep', action='store_true', help="keep the working directory with the synthetic CSVs")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    http_stub = install_http_stub()
+    sp = install_spotify_stub(*SPOTIFY_CREDENTIALS)
+    spotify_recc._artist_graph = ArtistGraph()  # In memory and without prefetching, so call counts are per request
+    recorder = Recorder(args.repeats, [http_stub, sp])
+
+    # Relative paths (catalogue stores, deltas, neighbour tables, track store) resolve in a scratch directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='recc-benchmark-')
+    os.chdir(workdir)
+    try:
+        for size in args.sizes:
+            movie_index = bench_movies(recorder, size) if 'movies' in args.pipelines or 'route' in args.pipelines else None
+            book_index = bench_books(recorder, size) if 'books' in args.pipelines or 'route' in args.pipelines else None
+            store = bench_spotify(recorder, size, sp) if 'spotify' in args.pipelines or 'route' in args.pipelines else None
+            if 'route' in args.pipelines:
+                bench_route(recorder, size, movie_index, book_index, store)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sizes': args.sizes,
+        'results': recorder.results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if baseline and compare(recorder.results, baseline, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import copy
+import hashlib
+import json
+import os
+from collections import Counter
+import numpy as np
+import pandas as pd
+import http_client
+import spotify_recc
+from movie_recc import OMDB_API_URL
+from book_recc import GOOGLE_BOOKS_API_URL
+from track_batch import TrackBatch
+
+# Recorded API responses, replayed by the stub clients below so benchmarks never touch the network
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+VOCABULARY_SIZE = 5000
+DESCRIPTION_WORDS = 30
+GENRES = ['Action', 'Adventure', 'Animation', 'Biography', 'Comedy', 'Crime', 'Documentary', 'Drama', 'Family',
+          'Fantasy', 'History', 'Horror', 'Music', 'Mystery', 'Romance', 'Sci-Fi', 'Sport', 'Thriller', 'War', 'Western']
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name + '.json')) as f:
+        return json.load(f)
+
+def id_fraction(value, salt=''):
+    # Deterministic number in [0, 1) per ID, so stubbed features vary but are stable between runs
+    digest = hashlib.md5((salt + value).encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'little') / 2 ** 32
+
+class StubResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.headers = {}
+
+    def json(self):
+        return copy.deepcopy(self.payload)
+
+class StubSession:
+    # Stands in for the requests.Session inside http_client, so retries and breakers still run
+    def __init__(self):
+        self.calls = Counter()
+        self.omdb_movie = load_fixture('omdb_movie')
+        self.volume = load_fixture('google_books_volume')
+        self.search = load_fixture('google_books_search')
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        params = params or {}
+        if url == OMDB_API_URL:
+            self.calls['omdb'] += 1
+            return StubResponse(200, dict(self.omdb_movie, imdbID=params.get('i')))
+        if url.startswith(GOOGLE_BOOKS_API_URL + '/volumes/'):
+            self.calls['google_books.volume'] += 1
+            return StubResponse(200, dict(self.volume, id=url.rsplit('/', 1)[-1]))
+        if url == GOOGLE_BOOKS_API_URL + '/volumes':
+            self.calls['google_books.search'] += 1
+            return StubResponse(200, self.search)
+        self.calls['unknown'] += 1
+        return StubResponse(404)
+
+class StubSpotify:
+    # Answers the spotipy calls made by spotify_recc from the recorded responses, varying IDs and features
+    def __init__(self):
+        self.calls = Counter()
+        self.track_fixture = load_fixture('spotify_track')
+        self.features_fixture = load_fixture('spotify_audio_features')
+        self.related_fixture = load_fixture('spotify_related_artists')
+        self.top_tracks_fixture = load_fixture('spotify_top_tracks')
+
+    def make_track(self, track_id):
+        track = copy.deepcopy(self.track_fixture)
+        if track_id != track['id']:
+            track['id'] = track_id
+            track['name'] = f"Track {track_id[:8]}"
+            track['artists'] = [{'id': 'artist' + track_id[:6], 'name': f"Artist {track_id[:6]}"}]
+            track['external_urls'] = {'spotify': f"https://open.spotify.com/track/{track_id}"}
+        return track
+
+    def make_features(self, track_id):
+        features = dict(self.features_fixture, id=track_id)
+        if track_id != self.features_fixture['id']:
+            features['energy'] = id_fraction(track_id, 'energy')
+            features['valence'] = id_fraction(track_id, 'valence')
+            features['tempo'] = 60 + 140 * id_fraction(track_id, 'tempo')
+        return features
+
+    def track(self, track_id):
+        self.calls['track'] += 1
+        return self.make_track(track_id)
+
+    def tracks(self, track_ids):
+        self.calls['tracks'] += 1
+        return {'tracks': [self.make_track(track_id) for track_id in track_ids]}
+
+    def audio_features(self, track_ids):
+        self.calls['audio_features'] += 1
+        if isinstance(track_ids, str):
+            track_ids = [track_ids]
+        return [self.make_features(track_id) for track_id in track_ids]
+
+    def artist_related_artists(self, artist_id):
+        self.calls['artist_related_artists'] += 1
+        return copy.deepcopy(self.related_fixture)
+
+    def artist_top_tracks(self, artist_id):
+        # Distinct track IDs per artist, as the real endpoint returns
+        self.calls['artist_top_tracks'] += 1
+        return {'tracks': [dict(track, id=artist_id[:11] + track['id'][:11]) for track in self.top_tracks_fixture['tracks']]}
+
+def install_http_stub():
+    session = StubSession()
+    http_client.get_client().session = session
+    return session
+
+def install_spotify_stub(client_id, client_secret):
+    # Served by get_spotify_client() for these credentials without authenticating
+    sp = StubSpotify()
+    with spotify_recc._clients_lock:
+        spotify_recc._clients[spotify_recc.credential_hash(client_id, client_secret)] = sp
+    return sp
+
+def synthetic_vocabulary(size=VOCABULARY_SIZE):
+    # Four-letter words, letters only so the movie preprocessing keeps them
+    return np.array([''.join(chr(97 + (i // 26 ** k) % 26) for k in range(4)) for i in range(size)])
+
+def synthetic_descriptions(rng, n_rows, n_words=DESCRIPTION_WORDS):
+    # Zipf-like word frequencies, like real plot summaries
+    vocabulary = synthetic_vocabulary()
+    weights = 1 / (np.arange(len(vocabulary)) + 10)
+    words = rng.choice(vocabulary, size=(n_rows, n_words), p=weights / weights.sum())
+    return [' '.join(row) for row in words]
+
+def synthetic_genres(rng, n_rows):
+    counts = rng.integers(1, 4, size=n_rows)
+    return [list(rng.choice(GENRES, size=count, replace=False)) for count in counts]
+
+def synthetic_imdb(n_rows, seed=0):
+    # Rows shaped like the Kaggle IMDb CSV, with Genre already split into lists
+    rng = np.random.default_rng(seed)
+    directors = rng.integers(0, max(1, n_rows // 20), size=n_rows)
+    return pd.DataFrame({
+        'Title': [f"Movie {i}" for i in range(n_rows)],
+        'Genre': synthetic_genres(rng, n_rows),
+        'Description': synthetic_descriptions(rng, n_rows),
+        'Director': [f"Director {d}" for d in directors],
+        'Poster': [f"https://example.com/posters/{i}.jpg" for i in range(n_rows)],
+    })
+
+def synthetic_books(n_rows, seed=0):
+    # Rows shaped like the Goodreads CSV, including the columns the loader drops
+    rng = np.random.default_rng(seed)
+    authors = rng.integers(0, max(1, n_rows // 10), size=n_rows)
+    return pd.DataFrame({
+        'Unnamed: 0': np.arange(n_rows),
+        'Book': [f"Book {i}" for i in range(n_rows)],
+        'Author': [f"Author {a}" for a in authors],
+        'Description': synthetic_descriptions(rng, n_rows),
+        'Genres': [str(genres) for genres in synthetic_genres(rng, n_rows)],
+        'Avg_Rating': np.round(rng.uniform(1, 5, size=n_rows), 2),
+        'Num_Ratings': rng.integers(0, 100000, size=n_rows),
+        'URL': [f"https://example.com/books/{i}" for i in range(n_rows)],
+    })
+
+def write_imdb_csv(path, n_rows, seed=0):
+    df = synthetic_imdb(n_rows, seed)
+    df['Genre'] = df['Genre'].apply(', '.join)
+    df.to_csv(path, index=False)
+
+def write_books_csv(path, n_rows, seed=0):
+    synthetic_books(n_rows, seed).to_csv(path, index=False)
+
+def synthetic_tracks(n_rows, seed=0):
+    # A TrackBatch shaped like spotify_recc's fetched tracks
+    rng = np.random.default_rng(seed)
+    energy, valence = rng.random(n_rows), rng.random(n_rows)
+    tempo = rng.uniform(60, 200, size=n_rows)
+    artists = rng.integers(0, max(1, n_rows // 10), size=n_rows)
+    ids = [f"track{i:017d}" for i in range(n_rows)]
+    return TrackBatch.from_columns({
+        'id': ids,
+        'name': [f"Track {i}" for i in range(n_rows)],
+        'artist': [f"Artist {a}" for a in artists],
+        'artist_id': [f"artist{a:016d}" for a in artists],
+        'album': [f"Album {i // 10}" for i in range(n_rows)],
+        'release_date': ['2000-01-01'] * n_rows,
+        'energy': energy,
+        'tempo': tempo,
+        'valence': valence,
+        'url': [f"https://open.spotify.com/track/{track_id}" for track_id in ids],
+        'album_art_url': [None] * n_rows,
+    })
@@ -0,0 +1,130 @@
+import os
+import resource
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from book_recc import fetch_book, preprocess_text, preprocess_descriptions, fit_features, transform_features, combine_features
+from similarity import normalize_rows
+from catalogues import BOOKS_STORE_DIR, CHUNK_ROWS
+from delta_index import SegmentedIndex
+from metrics import span
+
+FEATURES_PATH = "book_features.npz"
+VECTORIZERS_PATH = "book_vectorizers.pkl"
+PREPROCESS_CACHE_PATH = "book_preprocessed.pkl"
+DELTA_PATH = "book_delta.jsonl"
+MERGED_PATH = "book_merged.jsonl"
+NEIGHBOURS_PREFIX = "book"
+STORE_DIR = BOOKS_STORE_DIR
+TEXT_HASH_FEATURES = 2 ** 18  # Hashed description terms in a store; no vocabulary to hold in memory
+GENRE_HASH_FEATURES = 2 ** 12
+CANDIDATE_POOL = 10  # Neighbours fetched before dropping the input book itself
+
+class BookIndex(SegmentedIndex):
+    RECORD_COLUMNS = ["Book", "Author", "Description", "Genres"]
+    CATALOGUE = "books"
+    TITLE_COLUMN = "Book"
+    AUTHOR_COLUMN = "Author"
+    VECTORIZERS = ("desc_vectorizer", "genre_vectorizer")
+    FEATURES_PATH = FEATURES_PATH
+    VECTORIZERS_PATH = VECTORIZERS_PATH
+    PREPROCESS_CACHE_PATH = PREPROCESS_CACHE_PATH
+    DELTA_PATH = DELTA_PATH
+    MERGED_PATH = MERGED_PATH
+    STORE_DIR = STORE_DIR
+    NEIGHBOURS_PREFIX = NEIGHBOURS_PREFIX
+
+    def __init__(self, df, features, desc_vectorizer, genre_vectorizer, keys=None,
+                 features_path=FEATURES_PATH, merged_path=MERGED_PATH, delta_path=DELTA_PATH):
+        super().__init__(df, normalize_rows(features), keys, features_path, merged_path, delta_path, NEIGHBOURS_PREFIX)
+        self.desc_vectorizer = desc_vectorizer
+        self.genre_vectorizer = genre_vectorizer
+
+    def project(self, book):
+        # Vectorize a single book (e.g. from Google Books) against the frozen vocabulary
+        return transform_features([preprocess_text(book["Description"])], [preprocess_text(book["Genres"])],
+                                  self.desc_vectorizer, self.genre_vectorizer)
+
+    def recommend(self, book, query_vec=None, n_recommendations=3, row=None):
+        if query_vec is None:
+            query_vec = self.project(book)
+        return self.rank_search(self.candidates(query_vec, CANDIDATE_POOL + n_recommendations), book, row, n_recommendations)
+
+    def rank(self, candidates, order, title, n_recommendations=3, rows=None, exclude_row=None):
+        # rows: candidates' main-index rows (-1 for delta items), None when candidates is the main frame.
+        # The input book is dropped by its catalogue row as well as by title.
+        similar_books = []
+        with span("rank"):
+            for idx in order:
+                row = candidates.iloc[idx]
+                if row["Book"] == title or (exclude_row is not None and (idx if rows is None else rows[idx]) == exclude_row):
+                    continue
+                similar_books.append(row[self.RECORD_COLUMNS].to_dict())
+                if len(similar_books) == n_recommendations:
+                    break
+        return similar_books
+
+    def rank_search(self, result, book, row=None, n_recommendations=3):
+        # result: one candidates() tuple
+        candidates, order, _, rows = result
+        return self.rank(candidates, order, book["Book"], n_recommendations, rows, row)
+
+    def rank_neighbours(self, row, book, n_recommendations=3):
+        # Catalogue titles are served from the precomputed neighbour table; None without one
+        ids, _ = self.precomputed_neighbours(row)
+        if ids is None:
+            return None
+        return self.rank(self.df, ids, book["Book"], n_recommendations, exclude_row=row)
+
+    def recommend_for_volume_id(self, volume_id):
+        # Google Books is only called the first time an out-of-catalogue volume is seen
+        book, query_vec, row = self.resolve(volume_id, fetch_book)
+        if book is None:
+            return None, []
+        recs = self.rank_neighbours(row, book)
+        if recs is not None:
+            return book, recs
+        return book, self.recommend(book, query_vec, row=row)
+
+    def recommend_for_volume_ids(self, volume_ids, n_recommendations=3):
+        # recommend_for_volume_id() over a batch: yields (volume_id, book, recs) per distinct ID, in order
+        return self.recommend_many(volume_ids, fetch_book, CANDIDATE_POOL + n_recommendations,
+                                   lambda row, book: self.rank_neighbours(row, book, n_recommendations),
+                                   lambda result, book, row: self.rank_search(result, book, row, n_recommendations))
+
+    @classmethod
+    def fit(cls, df, previous):
+        n_jobs = os.cpu_count() or 1
+        descriptions = preprocess_descriptions(df["Description"], n_jobs=n_jobs)
+        genres = preprocess_descriptions(df["Genres"].astype(str), n_jobs=n_jobs)
+        features, desc_vectorizer, genre_vectorizer = fit_features(descriptions, genres)
+        return features, {"desc_vectorizer": desc_vectorizer, "genre_vectorizer": genre_vectorizer}
+
+    @classmethod
+    def store_fields(cls):
+        return [
+            ("desc_vectorizer", HashingVectorizer(n_features=TEXT_HASH_FEATURES, alternate_sign=False, norm=None, dtype=np.float32), True),
+            ("genre_vectorizer", HashingVectorizer(n_features=GENRE_HASH_FEATURES, alternate_sign=False, norm=None, dtype=np.float32), True),
+        ]
+
+    @classmethod
+    def store_inputs(cls, frame, n_jobs):
+        return [preprocess_descriptions(frame["Description"], n_jobs, cache=False),
+                preprocess_descriptions(frame["Genres"].astype(str), n_jobs, cache=False)]
+
+    @classmethod
+    def combine_blocks(cls, blocks, extra):
+        return combine_features(*blocks)
+
+def build_book_index(df=None, features_path=FEATURES_PATH, vectorizers_path=VECTORIZERS_PATH, keys=None):
+    return BookIndex.build(df, features_path, vectorizers_path, keys=keys)
+
+def ingest_book_store(store_dir=STORE_DIR, chunk_rows=CHUNK_ROWS):
+    return BookIndex.ingest_store(store_dir, chunk_rows)
+
+load_book_store = BookIndex.load_store
+load_book_index = BookIndex.load
+
+if __name__ == "__main__":
+    index = build_book_index()
+    print(f"Indexed {index.features.shape[0]} books with {index.features.shape[1]} features.")
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
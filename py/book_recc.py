@@ -1,33 +1,28 @@
-import pandas as pd
-import requests
+import os
+from urllib.parse import quote
+import http_client
 import re
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from nltk.stem import WordNetLemmatizer
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-
-# NLTK setup
-nltk.download("punkt")
-nltk.download("stopwords")
-nltk.download("wordnet")
-
-stop_words = set(stopwords.words("english"))
-lemmatizer = WordNetLemmatizer()
-
-# Load the dataset
-df = pd.read_csv("goodreads_data.csv")
-df.drop(columns=["Unnamed: 0", "URL"], inplace=True)
-df.dropna(inplace=True)
-df["Genres"] = df["Genres"].str.split(", ").apply(lambda x: [genre.strip("[]") for genre in x])
-df["Genres"] = df["Genres"].apply(lambda x: ', '.join(x))
-df["Genres"] = df["Genres"].apply(lambda x: x.replace("'", ""))
-
+from sklearn.preprocessing import normalize
+import numpy as np
+from scipy import sparse
+from cache import cached
+from catalogues import get_catalogue
+from text_prep import preprocess, preprocess_series
+
+GOOGLE_BOOKS_API_URL = os.environ.get("GOOGLE_BOOKS_API_URL", "https://www.googleapis.com/books/v1")
+
+def __getattr__(name):
+    # book_recc.df is loaded on first access rather than at import
+    if name == "df":
+        return get_catalogue("books")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@cached('google_books.volume')
 def fetch_book_details(volume_id):
-    url = f"https://www.googleapis.com/books/v1/volumes/{volume_id}"
-    response = requests.get(url)
-    if response.status_code == 200:
+    url = f"{GOOGLE_BOOKS_API_URL}/volumes/{quote(volume_id, safe='')}"
+    response = http_client.get(url)
+    if response is not None and response.status_code == 200:
         return response.json()
     else:
         return None
@@ -57,44 +52,47 @@ def format_book_data(book_data):
 
     return book_dict
 
+NO_LINKS = ("N/A", "N/A")  # (cover_url, book_url) when Google Books has no match or the lookup failed
+
+@cached('google_books.search')
 def search_google_books(book_title, author):
+    # None on a failed lookup, so the cache doesn't keep it; callers show NO_LINKS instead
     query = f"{book_title} {author}"
-    url = f"https://www.googleapis.com/books/v1/volumes?q={query}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        results = response.json().get("items", [])
-        if results:
-            volume_info = results[0]["volumeInfo"]
-            info_link = volume_info.get("infoLink", "N/A")
-            cover_url = volume_info["imageLinks"].get("thumbnail", "N/A") if "imageLinks" in volume_info else "N/A"
-            return cover_url, info_link
-    return "N/A", "N/A"
+    url = f"{GOOGLE_BOOKS_API_URL}/volumes"
+    response = http_client.get(url, params={"q": query})
+    if response is None or response.status_code != 200:
+        return None
+    results = response.json().get("items", [])
+    if results:
+        volume_info = results[0]["volumeInfo"]
+        info_link = volume_info.get("infoLink", "N/A")
+        cover_url = volume_info["imageLinks"].get("thumbnail", "N/A") if "imageLinks" in volume_info else "N/A"
+        return cover_url, info_link
+    return NO_LINKS
 
 def preprocess_text(text):
-    if pd.isnull(text):  # Check if the text is NaN
-        return ""        # If NaN, return an empty string
-
     # Tokenize, lemmatize, and remove stopwords
-    tokens = word_tokenize(text)
-    clean_tokens = [lemmatizer.lemmatize(token.lower()) for token in tokens if token.isalnum() and token.lower() not in stop_words]
-    return " ".join(clean_tokens)
+    return preprocess(text, lemmatize_tokens=True, alpha_only=False)
 
-def compute_similarity(descriptions, genres):
-    # Vectorize text
-    tfidf_vectorizer = TfidfVectorizer()
-    tfidf_matrix_desc = tfidf_vectorizer.fit_transform(descriptions)
-    tfidf_matrix_genres = tfidf_vectorizer.fit_transform(genres)
+def preprocess_descriptions(descriptions, n_jobs=1, cache=True):
+    return preprocess_series(descriptions, lemmatize_tokens=True, alpha_only=False, n_jobs=n_jobs, cache=cache)
 
-    # Compute cosine similarity
-    description_similarity = cosine_similarity(tfidf_matrix_desc)
-    genre_similarity = cosine_similarity(tfidf_matrix_genres)
-
-    return description_similarity, genre_similarity
+def fetch_book(volume_id):
+    book_data = fetch_book_details(volume_id)
+    if book_data is None:
+        return None
+    return format_book_data(book_data)
 
-def find_recommendations(input_book_idx, book_data, description_similarity, genre_similarity):
-    combined_similarity = (description_similarity[input_book_idx] + genre_similarity[input_book_idx]) / 2
+def combine_features(tfidf_matrix_desc, tfidf_matrix_genres):
+    # Both blocks are unit rows, so the cosine of the stacked rows is (description + genre similarity) / 2
+    combined_features = sparse.hstack((tfidf_matrix_desc, tfidf_matrix_genres), format='csr', dtype=np.float32)
+    return normalize(combined_features, norm='l2', copy=False)
 
-    similar_indices = combined_similarity.argsort()[-4:-1][::-1]
-    similar_books = [(book_data.iloc[idx]["Book"], book_data.iloc[idx]["Author"]) for idx in similar_indices]
+def fit_features(descriptions, genres):
+    desc_vectorizer = TfidfVectorizer(dtype=np.float32)
+    genre_vectorizer = TfidfVectorizer(dtype=np.float32)
+    combined_features = combine_features(desc_vectorizer.fit_transform(descriptions), genre_vectorizer.fit_transform(genres))
+    return combined_features, desc_vectorizer, genre_vectorizer
 
-    return similar_books
+def transform_features(descriptions, genres, desc_vectorizer, genre_vectorizer):
+    return combine_features(desc_vectorizer.transform(descriptions), genre_vectorizer.transform(genres))
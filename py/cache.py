@@ -0,0 +1,148 @@
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+# Seconds each endpoint's responses stay fresh
+DEFAULT_TTLS = {
+    'spotify.track': 24 * 3600,
+    'spotify.related_artists': 7 * 24 * 3600,
+    'spotify.top_tracks': 24 * 3600,
+    'omdb.movie': 7 * 24 * 3600,
+    'google_books.volume': 7 * 24 * 3600,
+    'google_books.search': 24 * 3600,
+}
+DEFAULT_TTL = 3600
+MAX_ENTRIES = 10000
+CACHE_PATH = os.environ.get("RECC_CACHE_PATH")  # Set to a file path to keep entries across restarts
+
+class LRUCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class SQLiteCache:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL, value TEXT)")
+
+    def connect(self):
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self.connect().execute("SELECT expires_at, value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] < time.time():
+            return False, None
+        return True, json.loads(row[1])
+
+    def set(self, key, value, ttl):
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)",
+                         (key, time.time() + ttl, json.dumps(value)))
+
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM cache")
+
+class Cache:
+    def __init__(self, max_entries=MAX_ENTRIES, path=None, ttls=None):
+        self.memory = LRUCache(max_entries)
+        self.disk = SQLiteCache(path) if path else None
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def get(self, endpoint, key, decode=None):
+        # encode/decode convert values that aren't JSON (e.g. TrackBatch) for the disk layer only
+        hit, value = self.memory.get(key)
+        if not hit and self.disk is not None:
+            hit, value = self.disk.get(key)
+            if hit:
+                if decode is not None:
+                    value = decode(value)
+                self.memory.set(key, value, self.ttls.get(endpoint, DEFAULT_TTL))
+        if hit:
+            self.hits[endpoint] += 1
+        else:
+            self.misses[endpoint] += 1
+        return hit, value
+
+    def set(self, endpoint, key, value, encode=None):
+        ttl = self.ttls.get(endpoint, DEFAULT_TTL)
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            self.disk.set(key, encode(value) if encode is not None else value, ttl)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        endpoints = set(self.hits) | set(self.misses)
+        return {endpoint: {'hits': self.hits[endpoint], 'misses': self.misses[endpoint]} for endpoint in sorted(endpoints)}
+
+_cache = Cache(path=CACHE_PATH)
+
+def configure_cache(max_entries=MAX_ENTRIES, path=None, ttls=None):
+    global _cache
+    _cache = Cache(max_entries, path, ttls)
+    return _cache
+
+def get_cache():
+    return _cache
+
+def make_key(endpoint, args, kwargs):
+    return endpoint + ':' + json.dumps([list(args), kwargs], sort_keys=True, default=str)
+
+def cached(endpoint, skip_args=0, encode=None, decode=None):
+    # skip_args leaves leading arguments (e.g. the Spotify client) out of the key.
+    # encode/decode turn values into JSON and back for the SQLite layer.
+    # Cached values are shared between callers, so treat them as read-only.
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(endpoint, args[skip_args:], kwargs)
+            hit, value = _cache.get(endpoint, key, decode)
+            if hit:
+                return value
+            value = func(*args, **kwargs)
+            if value is not None:  # Don't cache failed lookups
+                _cache.set(endpoint, key, value, encode)
+            return value
+        return wrapper
+    return decorator
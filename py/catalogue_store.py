@@ -0,0 +1,211 @@
+import json
+import os
+import pickle
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.pipeline import make_pipeline
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc  # noqa: F401
+except ImportError:
+    pa = None
+
+# On-disk catalogue built by streaming the source CSV in chunks:
+#   records.arrow            display/lookup columns, Arrow IPC, memory-mapped at serve time
+#   features.{data,indices,indptr}   row-normalised CSR matrix as raw arrays, memory-mapped
+#   vectorizers.pkl          hashing vectorizers (+ idf) for projecting new items, same keys as the index pickles
+#   keys.json                external ID -> row for items folded in from merged/delta segments
+#   meta.json                matrix shape; written last, so a store without it is incomplete
+RECORDS_FILE = "records.arrow"
+FEATURES_PREFIX = "features"
+VECTORIZERS_FILE = "vectorizers.pkl"
+KEYS_FILE = "keys.json"
+META_FILE = "meta.json"
+READY_SUFFIX = ".ready"  # Sibling of a store directory, rewritten once a new store is swapped in
+CSR_DTYPES = {'data': np.float32, 'indices': np.int32, 'indptr': np.int64}
+BLOCK_ROWS = 50000  # Rows idf-weighted and normalised at once in the second pass
+
+def ready_path(store_dir):
+    return store_dir + READY_SUFFIX
+
+def store_exists(store_dir):
+    return pa is not None and os.path.exists(os.path.join(store_dir, META_FILE))
+
+def label_tokens(labels):
+    # Analyzer for label fields: a list of labels, or one "a, b" string
+    if isinstance(labels, str):
+        return [label for label in labels.split(', ') if label]
+    if labels is None or (isinstance(labels, float) and labels != labels):
+        return []
+    return list(labels)
+
+class CSRWriter:
+    # Appends CSR row blocks to raw data/indices/indptr files that are memory-mapped back by read_csr
+    def __init__(self, prefix, n_features=None):
+        self.prefix = prefix
+        self.n_features = n_features
+        self.n_rows = 0
+        self.nnz = 0
+        self.files = {part: open(f"{prefix}.{part}", 'wb') for part in CSR_DTYPES}
+        self.files['indptr'].write(np.zeros(1, dtype=CSR_DTYPES['indptr']).tobytes())
+
+    def append(self, matrix):
+        matrix = sparse.csr_matrix(matrix)
+        matrix.sort_indices()
+        self.n_features = matrix.shape[1]
+        self.files['data'].write(matrix.data.astype(CSR_DTYPES['data']).tobytes())
+        self.files['indices'].write(matrix.indices.astype(CSR_DTYPES['indices']).tobytes())
+        self.files['indptr'].write((matrix.indptr[1:].astype(CSR_DTYPES['indptr']) + self.nnz).tobytes())
+        self.n_rows += matrix.shape[0]
+        self.nnz += matrix.nnz
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        return {'n_rows': self.n_rows, 'n_features': self.n_features, 'nnz': self.nnz}
+
+def read_csr(prefix, n_rows, n_features, nnz):
+    # Read-only CSR over memory-mapped arrays; pages are loaded on demand and shared between processes
+    parts = {}
+    for part, dtype in CSR_DTYPES.items():
+        length = n_rows + 1 if part == 'indptr' else nnz
+        parts[part] = np.memmap(f"{prefix}.{part}", dtype=dtype, mode='r', shape=(length,)) if length else np.zeros(0, dtype)
+    return sparse.csr_matrix((parts['data'], parts['indices'], parts['indptr']), shape=(n_rows, n_features), copy=False)
+
+def remove_csr(prefix):
+    for part in CSR_DTYPES:
+        os.remove(f"{prefix}.{part}")
+
+class RecordWriter:
+    # Streams frames into one Arrow IPC file; the schema is fixed by the first frame
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.schema = None
+        self.writer = None
+        self.n_rows = 0
+
+    def append(self, frame):
+        frame = frame.reset_index(drop=True)
+        if self.writer is None:
+            self.columns = [column for column in self.columns if column in frame]
+            schema = pa.Table.from_pandas(frame[self.columns], preserve_index=False).schema.remove_metadata()
+            # A column that is empty in the first chunk is text in the rest of the file
+            self.schema = pa.schema([pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                                     for field in schema])
+            self.writer = pa.ipc.new_file(self.path, self.schema)
+        frame = frame.assign(**{column: None for column in self.columns if column not in frame})
+        self.writer.write_table(pa.Table.from_pandas(frame[self.columns], schema=self.schema, preserve_index=False))
+        self.n_rows += len(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def read_records(store_dir):
+    # Text columns stay in the memory-mapped Arrow buffers instead of becoming Python strings
+    source = pa.memory_map(os.path.join(store_dir, RECORDS_FILE), 'r')
+    table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(types_mapper=lambda t: pd.StringDtype('pyarrow') if t in (pa.string(), pa.large_string()) else None)
+
+def ingest(chunks, fields, combine, store_dir, columns, extra=None, block_rows=BLOCK_ROWS):
+    # chunks yields (frame, inputs, keys): records to store, one input per field and the frame's
+    # external IDs (or None). fields is a list of (name, HashingVectorizer, use_idf); combine(blocks)
+    # turns the per-field blocks into the final row-normalised features. Memory is bounded by the
+    # chunk and block size, never by the catalogue.
+    if pa is None:
+        raise ImportError("pyarrow is required to write a catalogue store")
+    tmp_dir = store_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    # First pass: records, hashed term counts and document frequencies
+    records = RecordWriter(os.path.join(tmp_dir, RECORDS_FILE), columns)
+    counts = [CSRWriter(os.path.join(tmp_dir, name), vectorizer.n_features) for name, vectorizer, _ in fields]
+    doc_freq = [np.zeros(vectorizer.n_features, dtype=np.int64) for _, vectorizer, _ in fields]
+    keys = {}
+    for frame, inputs, frame_keys in chunks:
+        keys.update((key, records.n_rows + i) for i, key in enumerate(frame_keys or []))
+        records.append(frame)
+        for (_, vectorizer, _), writer, freq, values in zip(fields, counts, doc_freq, inputs):
+            matrix = vectorizer.transform(values)
+            writer.append(matrix)
+            freq += np.bincount(matrix.indices, minlength=vectorizer.n_features)
+    records.close()
+    n_rows = records.n_rows
+    if n_rows == 0:
+        shutil.rmtree(tmp_dir)
+        raise ValueError("no rows to ingest")
+
+    # Second pass: idf weights (smoothed, as TfidfVectorizer does) and normalisation, block by block
+    transformers, vectorizers = [], {}
+    for (name, vectorizer, use_idf), freq in zip(fields, doc_freq):
+        if use_idf:
+            transformer = TfidfTransformer()
+            transformer.idf_ = (np.log((1 + n_rows) / (1 + freq)) + 1).astype(np.float32)
+            transformer.n_features_in_ = vectorizer.n_features
+            vectorizers[name] = make_pipeline(vectorizer, transformer)
+        else:
+            transformer = None
+            vectorizers[name] = vectorizer
+        transformers.append(transformer)
+    raw = [read_csr(writer.prefix, **writer.close()) for writer in counts]
+    features = CSRWriter(os.path.join(tmp_dir, FEATURES_PREFIX))
+    for start in range(0, n_rows, block_rows):
+        blocks = [matrix[start:start + block_rows] for matrix in raw]
+        blocks = [transformer.transform(block) if transformer is not None else block
+                  for transformer, block in zip(transformers, blocks)]
+        features.append(combine(blocks))
+    meta = features.close()
+    del raw
+    for writer in counts:
+        remove_csr(writer.prefix)
+
+    with open(os.path.join(tmp_dir, VECTORIZERS_FILE), 'wb') as f:
+        pickle.dump({**vectorizers, **(extra or {})}, f)
+    with open(os.path.join(tmp_dir, KEYS_FILE), 'w') as f:
+        json.dump(keys, f)
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    # Swap directories; processes still serving the old store keep their mappings
+    old_dir = store_dir + '.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(store_dir):
+        os.rename(store_dir, old_dir)
+    os.rename(tmp_dir, store_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    # Written last, so a watcher never sees a change while the directories are being swapped
+    with open(ready_path(store_dir) + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(ready_path(store_dir) + '.tmp', ready_path(store_dir))
+    return meta
+
+def open_store(store_dir):
+    # (features, vectorizers, keys) for serving; records are read by catalogues.get_catalogue
+    with open(os.path.join(store_dir, META_FILE)) as f:
+        meta = json.load(f)
+    features = read_csr(os.path.join(store_dir, FEATURES_PREFIX), **meta)
+    with open(os.path.join(store_dir, VECTORIZERS_FILE), 'rb') as f:
+        vectorizers = pickle.load(f)
+    with open(os.path.join(store_dir, KEYS_FILE)) as f:
+        keys = json.load(f)
+    return features, vectorizers, keys
+
+if __name__ == "__main__":
+    from movie_index import ingest_movie_store, STORE_DIR as MOVIE_STORE_DIR
+    from book_index import ingest_book_store, STORE_DIR as BOOK_STORE_DIR
+
+    targets = {
+        'imdb': (ingest_movie_store, MOVIE_STORE_DIR),
+        'books': (ingest_book_store, BOOK_STORE_DIR),
+    }
+    for name in sys.argv[1:] or list(targets):
+        ingest_store, store_dir = targets[name]
+        meta = ingest_store()
+        print(f"{name}: {meta['n_rows']} rows x {meta['n_features']} features ({meta['nnz']} non-zeros) -> {store_dir}/")
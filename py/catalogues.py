@@ -0,0 +1,191 @@
+import re
+import threading
+import unicodedata
+import pandas as pd
+from catalogue_store import store_exists, read_records
+
+try:
+    import pyarrow  # noqa: F401
+    STRING_DTYPE = "string[pyarrow]"
+except ImportError:
+    STRING_DTYPE = "string"
+
+IMDB_PATH = "imdb-movies-dataset.csv"
+BOOKS_PATH = "goodreads_data.csv"
+IMDB_STORE_DIR = "movie_store"  # Written by `python catalogue_store.py imdb`, preferred over the CSV
+BOOKS_STORE_DIR = "book_store"
+CHUNK_ROWS = 50000  # CSV rows parsed at once when ingesting into a store
+
+SERIES_SUFFIX_RE = re.compile(r"\s*\([^)]*#\s*\d+[^)]*\)\s*$")  # Goodreads "(Series, #1)"
+NON_ALNUM_RE = re.compile(r"[\W_]+")
+YEAR_RE = re.compile(r"\d{4}")
+YEAR_TOLERANCE = 1  # OMDb's year and the dataset's can differ by a year around release dates
+
+def normalise_title(title):
+    # Case, accents, punctuation and Goodreads series suffixes don't matter for matching
+    if not isinstance(title, str):
+        return ''
+    title = SERIES_SUFFIX_RE.sub('', title)
+    title = unicodedata.normalize('NFKD', title)
+    title = ''.join(char for char in title if not unicodedata.combining(char))
+    return NON_ALNUM_RE.sub(' ', title.casefold()).strip()
+
+def normalise_author(author):
+    # First author (or director) only: Google Books and OMDb join several with ", ", the datasets list one
+    if not isinstance(author, str) or author.strip() == 'N/A':
+        return ''
+    return normalise_title(author.split(',')[0])
+
+def normalise_year(year):
+    # First four digits: OMDb gives "2010" or "2010–2013", the dataset a number
+    match = YEAR_RE.search(str(year)) if year is not None else None
+    return int(match.group(0)) if match else None
+
+class CatalogueLookup:
+    # Hash indexes from normalised title and external ID to rows. Titles aren't unique (remakes,
+    # books of the same name), so a title match is only taken when the author/director and year
+    # don't contradict it.
+    def __init__(self, df, title_column, author_column=None, year_column=None):
+        self.by_title = {}  # title -> rows
+        self.by_id = {}
+        self.authors = {}  # row -> normalised author or director, where the row has one
+        self.years = {}
+        titles = [normalise_title(title) for title in df[title_column]]
+        authors = [normalise_author(author) for author in df[author_column]] if author_column in df else [None] * len(titles)
+        years = [normalise_year(year) for year in df[year_column]] if year_column in df else [None] * len(titles)
+        for row, (title, author, year) in enumerate(zip(titles, authors, years)):
+            self.add(row, title, author, year=year)
+
+    def add(self, row, title, author=None, key=None, year=None):
+        # title/author already normalised
+        if title:
+            self.by_title.setdefault(title, []).append(row)
+        if author:
+            self.authors[row] = author
+        if year is not None:
+            self.years[row] = year
+        if key is not None:
+            self.by_id[key] = row
+
+    def add_record(self, row, title, author=None, key=None, year=None):
+        self.add(row, normalise_title(title), normalise_author(author), key, normalise_year(year))
+
+    def match(self, title, author=None, year=None):
+        # (row, confirmed): the first row with this title whose author and year don't contradict the
+        # given ones, preferring one where either is known on both sides and agrees (confirmed)
+        author, year = normalise_author(author), normalise_year(year)
+        first = None
+        for row in self.by_title.get(normalise_title(title), ()):
+            row_author, row_year = self.authors.get(row), self.years.get(row)
+            if author and row_author and author != row_author:
+                continue
+            if year is not None and row_year is not None and abs(year - row_year) > YEAR_TOLERANCE:
+                continue
+            if (author and row_author) or (year is not None and row_year is not None):
+                return row, True
+            if first is None:
+                first = row
+        return first, False
+
+    def find(self, key=None, title=None, author=None, year=None):
+        if key is not None and key in self.by_id:
+            return self.by_id[key]
+        if title is None:
+            return None
+        return self.match(title, author, year)[0]
+
+def clean_imdb_frame(df):
+    df['Genre'] = df['Genre'].fillna('')
+    df['Genre'] = df['Genre'].astype(str)
+    df['Genre'] = df['Genre'].apply(lambda x: x.split(', '))  # Lists, as MultiLabelBinarizer expects
+    for column in ['Title', 'Description', 'Poster']:
+        if column in df:
+            df[column] = df[column].fillna('')  # No pd.NA, so comparisons stay boolean
+    return df
+
+def set_imdb_dtypes(df):
+    for column in ['Title', 'Description', 'Poster']:
+        if column in df:
+            df[column] = df[column].astype(STRING_DTYPE)
+    if 'Director' in df:
+        df['Director'] = df['Director'].astype('category')
+    return df
+
+def load_imdb_catalogue(path=IMDB_PATH, store_dir=IMDB_STORE_DIR):
+    if store_exists(store_dir):
+        return set_imdb_dtypes(read_records(store_dir))
+    return set_imdb_dtypes(clean_imdb_frame(pd.read_csv(path)))
+
+def clean_books_frame(df):
+    df.drop(columns=["Unnamed: 0", "URL"], inplace=True)
+    df.dropna(inplace=True)
+    df["Genres"] = df["Genres"].str.split(", ").apply(lambda x: [genre.strip("[]") for genre in x])
+    df["Genres"] = df["Genres"].apply(lambda x: ', '.join(x))
+    df["Genres"] = df["Genres"].apply(lambda x: x.replace("'", ""))
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+def set_books_dtypes(df):
+    for column in ["Book", "Description"]:
+        df[column] = df[column].astype(STRING_DTYPE)
+    df["Genres"] = df["Genres"].astype("category")
+    df["Author"] = df["Author"].astype("category")
+    return df
+
+def load_books_catalogue(path=BOOKS_PATH, store_dir=BOOKS_STORE_DIR):
+    if store_exists(store_dir):
+        return set_books_dtypes(read_records(store_dir))
+    return set_books_dtypes(clean_books_frame(pd.read_csv(path)))
+
+def iter_catalogue_chunks(name, chunk_rows=CHUNK_ROWS):
+    # Cleaned CSV chunks, so a catalogue larger than memory can be ingested into a store
+    path, clean = SOURCES[name]
+    for chunk in pd.read_csv(path, chunksize=chunk_rows):
+        chunk = clean(chunk)
+        if len(chunk):
+            yield chunk
+
+SOURCES = {
+    'imdb': (IMDB_PATH, clean_imdb_frame),
+    'books': (BOOKS_PATH, clean_books_frame),
+}
+LOADERS = {
+    'imdb': lambda: load_imdb_catalogue(IMDB_PATH),
+    'books': lambda: load_books_catalogue(BOOKS_PATH),
+}
+LOOKUP_COLUMNS = {
+    'imdb': ('Title', 'Director', 'Year'),
+    'books': ('Book', 'Author', None),
+}
+
+def build_lookup(name, df):
+    return CatalogueLookup(df, *LOOKUP_COLUMNS[name])
+
+# One copy per worker process. Frames are shared by all handlers: treat them as read-only.
+_catalogues = {}
+_reload_listeners = []
+_lock = threading.Lock()
+
+def get_catalogue(name):
+    catalogue = _catalogues.get(name)
+    if catalogue is None:
+        with _lock:
+            catalogue = _catalogues.get(name)
+            if catalogue is None:
+                catalogue = LOADERS[name]()
+                _catalogues[name] = catalogue
+    return catalogue
+
+def on_reload(listener):
+    # listener(name) is called after a catalogue has been reloaded, e.g. to rebuild an index
+    _reload_listeners.append(listener)
+    return listener
+
+def reload_catalogues(*names):
+    names = names or tuple(LOADERS)
+    for name in names:
+        catalogue = LOADERS[name]()
+        with _lock:
+            _catalogues[name] = catalogue  # Swap in one step, readers never see a half-loaded frame
+        for listener in _reload_listeners:
+            listener(name)
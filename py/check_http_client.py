@@ -0,0 +1,132 @@
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from http_client import HTTPClient, CircuitOpenError
+
+# Offline check of the pooled HTTP client against a local stub server: retries on 5xx and
+# read timeouts, and a breaker that opens, short-circuits, half-opens and closes again.
+#   python check_http_client.py
+READ_TIMEOUT = 0.2
+BREAKER_THRESHOLD = 2
+BREAKER_COOLDOWN = 0.3
+
+class StubHandler(BaseHTTPRequestHandler):
+    # path -> list of (status, delay) answered in turn; the last one repeats
+    script = {}
+    hits = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            steps = self.script.get(self.path, [(404, 0)])
+            hit = self.hits.get(self.path, 0)
+            self.hits[self.path] = hit + 1
+        status, delay = steps[min(hit, len(steps) - 1)]
+        time.sleep(delay)
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', '2')
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(b'{}')
+        except OSError:
+            pass  # The client gave up on a delayed answer
+
+    def log_message(self, *args):
+        pass
+
+def stub(path, *steps):
+    with StubHandler.lock:
+        StubHandler.script[path] = list(steps)
+        StubHandler.hits[path] = 0
+
+def hits(path):
+    with StubHandler.lock:
+        return StubHandler.hits.get(path, 0)
+
+def make_client(max_retries=3):
+    return HTTPClient(max_retries=max_retries, timeout=(1, READ_TIMEOUT), backoff_base=0.01,
+                      breaker_threshold=BREAKER_THRESHOLD, breaker_cooldown=BREAKER_COOLDOWN)
+
+def check_retry_on_5xx(base, host):
+    client = make_client()
+    stub('/flaky', (503, 0), (502, 0), (200, 0))
+    response = client.get(base + '/flaky')
+    assert response.status_code == 200, response.status_code
+    assert hits('/flaky') == 3, hits('/flaky')
+    stats = client.stats()[host]
+    assert stats['retries'] == 2 and stats['errors'] == 2 and stats['requests'] == 3, stats
+    assert stats['breaker_open'] == 0, stats
+
+def check_retry_on_timeout(base, host):
+    client = make_client()
+    stub('/slow', (200, READ_TIMEOUT * 5), (200, 0))
+    response = client.get(base + '/slow')
+    assert response.status_code == 200, response.status_code
+    assert client.stats()[host]['retries'] == 1, client.stats()
+
+def check_gives_up(base, host):
+    client = make_client(max_retries=2)
+    stub('/down', (500, 0))
+    response = client.get(base + '/down')
+    assert response.status_code == 500, response.status_code
+    assert hits('/down') == 3, hits('/down')
+
+def check_breaker(base, host):
+    client = make_client(max_retries=0)
+    stub('/down', (500, 0))
+    for _ in range(BREAKER_THRESHOLD):
+        client.get(base + '/down')
+    assert client.stats()[host]['breaker_open'] == 1, client.stats()
+
+    # Open: refused without reaching the server
+    calls = hits('/down')
+    try:
+        client.get(base + '/down')
+        raise AssertionError("breaker didn't open")
+    except CircuitOpenError:
+        pass
+    assert hits('/down') == calls and client.stats()[host]['short_circuited'] == 1, client.stats()
+
+    # Half-open after the cooldown: one trial goes through; it fails, so the breaker stays open
+    time.sleep(BREAKER_COOLDOWN)
+    client.get(base + '/down')
+    assert hits('/down') == calls + 1, hits('/down')
+    try:
+        client.get(base + '/down')
+        raise AssertionError("breaker closed after a failed trial")
+    except CircuitOpenError:
+        pass
+
+    # A successful trial closes it
+    stub('/down', (200, 0))
+    time.sleep(BREAKER_COOLDOWN)
+    assert client.get(base + '/down').status_code == 200
+    assert client.get(base + '/down').status_code == 200
+    assert client.stats()[host]['breaker_open'] == 0, client.stats()
+
+CHECKS = [check_retry_on_5xx, check_retry_on_timeout, check_gives_up, check_breaker]
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f'127.0.0.1:{server.server_address[1]}'
+    failed = False
+    try:
+        for check in CHECKS:
+            try:
+                check(f'http://{host}', host)
+                status = 'ok'
+            except (AssertionError, requests.RequestException) as e:
+                status = f'FAILED {e!r}'
+                failed = True
+            print(f"{check.__name__:<24} {status}")
+    finally:
+        server.shutdown()
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
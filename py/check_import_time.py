@@ -0,0 +1,52 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# Cumulative import budget per module, in milliseconds. Imports must stay free of
+# network calls, dataset loading and client creation; these budgets catch regressions.
+IMPORT_BUDGETS_MS = {
+    'spotify_recc': 600,
+    'movie_recc': 1200,
+    'book_recc': 1200,
+    'movie_index': 1500,
+    'book_index': 1500,
+    'app': 1800,
+    'web_app': 1800,
+}
+RUNS = 3
+
+def measure_import_time(module):
+    # Cumulative microseconds reported by `python -X importtime` for the top-level import
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+    for line in reversed(result.stderr.splitlines()):
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.strip() == module and name.startswith(' ' + module):
+            return int(cumulative) / 1000
+    raise RuntimeError(f"no importtime entry for {module}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail if importing the recommender modules exceeds its time budget.")
+    parser.add_argument('modules', nargs='*', default=list(IMPORT_BUDGETS_MS))
+    parser.add_argument('--runs', type=int, default=RUNS)
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        # Best of several runs, so a cold disk cache doesn't count as a regression
+        elapsed = min(measure_import_time(module) for _ in range(args.runs))
+        budget = IMPORT_BUDGETS_MS.get(module)
+        status = 'ok'
+        if budget is not None and elapsed > budget:
+            status = 'OVER BUDGET'
+            failed = True
+        print(f"{module:<14} {elapsed:8.1f} ms  (budget {budget} ms)  {status}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import sys
+import numpy as np
+from movie_recc import group_ranks, rank_candidates, hash_codes, empty_code
+
+# Offline check of the vectorised candidate ranking on small hand-made pools:
+# duplicate descriptions are dropped, diversity limits hold and filters apply before k.
+#   python check_ranking.py
+SCORES = [0.9, 0.8, 0.7, 0.6, 0.5]
+
+def positions(ranked):
+    return ranked['position'].tolist()
+
+def check_hash_codes():
+    codes = hash_codes(['a', 'a', 'b', None, ''])
+    assert codes[0] == codes[1] and codes[0] != codes[2], codes
+    assert codes[3] == codes[4] == empty_code(), codes
+
+def check_group_ranks():
+    ranks = group_ranks(np.array([5, 3, 5, 5, 3, 7]))
+    assert ranks.tolist() == [0, 0, 1, 2, 1, 0], ranks
+
+def check_dedup_by_description():
+    # The best scoring copy of a description is kept, even when it comes later in the pool
+    ranked = rank_candidates([0.5, 0.9, 0.7, 0.8], hash_codes(['a', 'a', 'b', 'c']), k=5)
+    assert positions(ranked) == [1, 3, 2], positions(ranked)
+    assert np.allclose(ranked['score'], [0.9, 0.8, 0.7]), ranked['score']
+
+def check_dedup_after_exclude():
+    # An excluded candidate doesn't hide the next copy of its description
+    exclude = [True, False, False, False, False]
+    ranked = rank_candidates(SCORES, hash_codes(['a', 'a', 'b', 'b', 'c']), k=5, exclude=exclude)
+    assert positions(ranked) == [1, 2, 4], positions(ranked)
+
+def check_diversity_limit():
+    descriptions = hash_codes(['a', 'b', 'c', 'd', 'e'])
+    directors = hash_codes(['x', 'x', 'x', 'y', 'y'])
+    ranked = rank_candidates(SCORES, descriptions, k=5, groups=[(directors, 1)])
+    assert positions(ranked) == [0, 3], positions(ranked)
+    ranked = rank_candidates(SCORES, descriptions, k=3, groups=[(directors, 2)])
+    assert positions(ranked) == [0, 1, 3], positions(ranked)
+
+def check_diversity_after_dedup():
+    # A dropped duplicate doesn't use up its group's quota
+    descriptions = hash_codes(['a', 'a', 'b', 'c', 'd'])
+    directors = hash_codes(['x', 'x', 'x', 'y', 'y'])
+    ranked = rank_candidates(SCORES, descriptions, k=5, groups=[(directors, 2)])
+    assert positions(ranked) == [0, 2, 3, 4], positions(ranked)
+
+def check_missing_group_unlimited():
+    descriptions = hash_codes(['a', 'b', 'c', 'd', 'e'])
+    directors = hash_codes([None, '', None, 'x', 'x'])
+    ranked = rank_candidates(SCORES, descriptions, k=5, groups=[(directors, 1), (directors, None)])
+    assert positions(ranked) == [0, 1, 2, 3], positions(ranked)
+
+def check_score_filters():
+    scores = [0.9, np.nan, 0.7, 0.2, -np.inf]
+    ranked = rank_candidates(scores, hash_codes(['a', 'b', 'c', 'd', 'e']), k=5, min_score=0.5)
+    assert positions(ranked) == [0, 2], positions(ranked)
+    ranked = rank_candidates(scores, hash_codes(['a', 'b', 'c', 'd', 'e']), k=1)
+    assert positions(ranked) == [0], positions(ranked)
+    assert len(rank_candidates([], hash_codes([]), k=3)) == 0
+
+CHECKS = [check_hash_codes, check_group_ranks, check_dedup_by_description, check_dedup_after_exclude,
+          check_diversity_limit, check_diversity_after_dedup, check_missing_group_unlimited, check_score_filters]
+
+def main():
+    failed = False
+    for check in CHECKS:
+        try:
+            check()
+            status = 'ok'
+        except AssertionError as e:
+            status = f'FAILED {e}'
+            failed = True
+        print(f"{check.__name__:<30} {status}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
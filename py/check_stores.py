@@ -0,0 +1,118 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from catalogue_store import CSRWriter, read_csr, remove_csr
+from delta_index import (SegmentedIndex, DeltaSegment, append_line, read_lines, item_vector, load_merged,
+                         pending_items, fold_delta, take_delta)
+
+# Offline check of the on-disk formats in a temporary directory: a CSR matrix written in blocks
+# reads back unchanged, and delta items survive append, merge and reload without duplicates.
+#   python check_stores.py
+N_FEATURES = 4
+
+class StubIndex(SegmentedIndex):
+    RECORD_COLUMNS = ['Title', 'Director']
+    CATALOGUE = 'imdb'
+    TITLE_COLUMN = 'Title'
+    AUTHOR_COLUMN = 'Director'
+    YEAR_COLUMN = 'Year'
+
+def catalogue():
+    df = pd.DataFrame({'Title': ['A', 'B', 'C'], 'Director': ['x', 'y', 'z'], 'Year': [2000, 2001, 2002]})
+    features = sparse.csr_matrix(np.eye(len(df), N_FEATURES, dtype=np.float32))
+    return df, features
+
+def delta_item(key, title):
+    return {'key': key, 'record': {'Title': title, 'Director': 'w', 'Year': 2003}, 'indices': [3], 'data': [1.0]}
+
+def keys(items):
+    return [item['key'] for item in items]
+
+def check_csr_round_trip():
+    expected = sparse.csr_matrix(np.array([[0, 1, 0, 2, 0], [0, 0, 0, 0, 0], [3, 0, 0, 0, 4]], dtype=np.float32))
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = os.path.join(tmp, 'features')
+        writer = CSRWriter(prefix)
+        for block in (expected[:2], sparse.csr_matrix((0, 5)), expected[2:]):
+            writer.append(block)
+        meta = writer.close()
+        assert meta == {'n_rows': 3, 'n_features': 5, 'nnz': 4}, meta
+        matrix = read_csr(prefix, **meta)
+        assert matrix.shape == expected.shape and (matrix != expected).nnz == 0, matrix.toarray()
+        del matrix
+        remove_csr(prefix)
+        assert not os.listdir(tmp), os.listdir(tmp)
+
+def check_delta_append_reload():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'delta.jsonl')
+        segment = DeltaSegment(path, N_FEATURES)
+        other = DeltaSegment(path, N_FEATURES)  # A second worker that hasn't seen the first's append
+        for delta in (segment, other, segment):
+            item = delta_item('tt9', 'D')
+            delta.append(item['key'], item['record'], item_vector(item, N_FEATURES))
+        assert len(read_lines(path)) == 2, read_lines(path)
+        reloaded = DeltaSegment(path, N_FEATURES)
+        assert len(reloaded) == 1, len(reloaded)
+        record, vector = reloaded.get('tt9')
+        assert record['Title'] == 'D' and vector.toarray().tolist() == [[0, 0, 0, 1]], (record, vector)
+
+def check_delta_merge_reload():
+    df, features = catalogue()
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {name: os.path.join(tmp, file) for name, file in
+                 (('features_path', 'features.npz'), ('merged_path', 'merged.jsonl'), ('delta_path', 'delta.jsonl'))}
+        sparse.save_npz(paths['features_path'], features)
+        index = StubIndex(df, features, **paths)
+        worker = StubIndex(df, features, **paths)  # Another process serving the same files
+        item = delta_item('tt9', 'D')
+        index.delta.append(item['key'], item['record'], item_vector(item, N_FEATURES))
+
+        assert index.merge_delta() == 1
+        assert sparse.load_npz(paths['features_path']).shape == (4, N_FEATURES)
+        assert keys(read_lines(paths['merged_path'])) == ['tt9'] and not read_lines(paths['delta_path'])
+        assert len(index.df) == 4 and len(index.delta) == 0, (len(index.df), len(index.delta))
+        assert index.lookup.find(key='tt9') == 3 and index.lookup.match('D', 'w', 2003) == (3, True)
+        # The other process picks the merged row up instead of merging it again
+        assert worker.merge_delta() == 1 and len(worker.df) == 4, len(worker.df)
+        assert index.merge_delta() == 0
+
+        merged_df, merged_keys = load_merged(df, paths['merged_path'])
+        reloaded = StubIndex(merged_df, sparse.load_npz(paths['features_path']).tocsr(), merged_keys, **paths)
+        assert merged_keys == {'tt9': 3} and reloaded.catalogue_rows == 3, (merged_keys, reloaded.catalogue_rows)
+        assert reloaded.lookup.find(key='tt9') == 3 and reloaded.df['Title'].tolist() == ['A', 'B', 'C', 'D']
+        assert reloaded.features[3].toarray().tolist() == [[0, 0, 0, 1]], reloaded.features[3]
+        assert reloaded.merge_delta() == 0
+
+def check_fold_and_take_delta():
+    with tempfile.TemporaryDirectory() as tmp:
+        delta_path, merged_path = os.path.join(tmp, 'delta.jsonl'), os.path.join(tmp, 'merged.jsonl')
+        for key in ('k1', 'k2', 'k1'):
+            append_line(delta_path, delta_item(key, key))
+        # An ingest that read k1 records it as merged; k2 arrived after and stays pending
+        fold_delta(delta_path, merged_path, ['k1'])
+        fold_delta(delta_path, merged_path, ['k1'])
+        assert keys(read_lines(merged_path)) == ['k1'], read_lines(merged_path)
+        assert keys(read_lines(delta_path)) == ['k2'], read_lines(delta_path)
+        assert keys(pending_items(merged_path, delta_path)) == ['k1', 'k2']
+        assert keys(take_delta(delta_path)) == ['k2'] and not read_lines(delta_path)
+
+CHECKS = [check_csr_round_trip, check_delta_append_reload, check_delta_merge_reload, check_fold_and_take_delta]
+
+def main():
+    failed = False
+    for check in CHECKS:
+        try:
+            check()
+            status = 'ok'
+        except AssertionError as e:
+            status = f'FAILED {e}'
+            failed = True
+        print(f"{check.__name__:<30} {status}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
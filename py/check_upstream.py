@@ -0,0 +1,124 @@
+import sys
+import threading
+import time
+import spotify_recc
+from artist_graph import ArtistGraph
+from cache import get_cache
+from upstream import gather
+
+# Offline check of the upstream fan-out with a stub Spotify client whose calls sleep or raise:
+# calls run concurrently, and a failed or timed-out call falls back to the default.
+#   python check_upstream.py
+DELAY = 0.2
+CALLS = 8
+
+class StubError(Exception):
+    pass
+
+def sleepy(value, delay=DELAY):
+    time.sleep(delay)
+    return value
+
+def failing(value):
+    raise StubError(value)
+
+class StubSpotify:
+    # Sleeps DELAY per call and raises for any ID in fail; counts calls and the peak in flight
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+
+    def call(self, ids):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(DELAY)
+            if self.fail & set(ids):
+                raise StubError(sorted(self.fail & set(ids)))
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def tracks(self, track_ids):
+        self.call(track_ids)
+        return {'tracks': [track(track_id) for track_id in track_ids]}
+
+    def audio_features(self, track_ids):
+        self.call(track_ids)
+        return [{'energy': 0.5, 'tempo': 120.0, 'valence': 0.5} for _ in track_ids]
+
+    def artist_top_tracks(self, artist_id):
+        self.call([artist_id])
+        return {'tracks': [{'id': f'{artist_id}-{i}'} for i in range(3)]}
+
+def track(track_id):
+    return {'name': track_id, 'artists': [{'name': 'artist', 'id': 'artist'}],
+            'album': {'name': 'album', 'release_date': '2000', 'images': []},
+            'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'}}
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def check_gather_concurrent():
+    results, elapsed = timed(gather, [(sleepy, i) for i in range(CALLS)])
+    assert results == list(range(CALLS)), results
+    assert elapsed < DELAY * CALLS / 2, f"{CALLS} calls took {elapsed:.2f}s"
+
+def check_gather_failure_default():
+    results = gather([(sleepy, 1), (failing, 2), (sleepy, 3)], default='default')
+    assert results == [1, 'default', 3], results
+
+def check_gather_timeout_default():
+    results, elapsed = timed(gather, [(sleepy, 1), (sleepy, 2, DELAY * 10)], DELAY * 2, 'default')
+    assert results == [1, 'default'], results
+    assert elapsed < DELAY * 5, f"timed-out call held the fan-out for {elapsed:.2f}s"
+
+def check_track_batch_fan_out():
+    # 120 IDs: three track chunks and two feature chunks, all in flight at once
+    sp = StubSpotify(fail=['t-10'])
+    track_ids = [f't-{i}' for i in range(120)]
+    batch, elapsed = timed(spotify_recc.fetch_track_batch, sp, track_ids)
+    assert sp.calls == 5 and sp.peak == 5, (sp.calls, sp.peak)
+    assert elapsed < DELAY * 3, f"{sp.calls} calls took {elapsed:.2f}s"
+    # Only the tracks of the failed chunks (the first of each endpoint, which hold t-10) are dropped
+    dropped = set(track_ids[:spotify_recc.TRACKS_BATCH_SIZE]) | set(track_ids[:spotify_recc.AUDIO_FEATURES_BATCH_SIZE])
+    ids = batch.ids().tolist()
+    assert ids == [track_id for track_id in track_ids if track_id not in dropped], ids[:5]
+
+def check_related_top_fan_out():
+    sp = StubSpotify(fail=['a-2'])
+    artists = [f'a-{i}' for i in range(CALLS)]
+    top, elapsed = timed(spotify_recc.get_related_top, sp, artists)
+    assert sp.peak == CALLS, sp.peak
+    assert elapsed < DELAY * CALLS / 2, f"{CALLS} calls took {elapsed:.2f}s"
+    expected = [f'{artist_id}-{i}' for artist_id in artists if artist_id != 'a-2' for i in range(3)]
+    assert top == expected, top
+
+CHECKS = [check_gather_concurrent, check_gather_failure_default, check_gather_timeout_default,
+          check_track_batch_fan_out, check_related_top_fan_out]
+
+def main():
+    # In-memory graph without prefetching and an empty cache, so every lookup reaches the stub
+    spotify_recc._artist_graph = ArtistGraph(workers=0)
+    failed = False
+    for check in CHECKS:
+        get_cache().clear()
+        spotify_recc.get_artist_graph().clear()
+        try:
+            check()
+            status = 'ok'
+        except AssertionError as e:
+            status = f'FAILED {e}'
+            failed = True
+        print(f"{check.__name__:<30} {status}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
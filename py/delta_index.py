@@ -0,0 +1,506 @@
+import fcntl
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from similarity import normalize_rows, top_k
+from neighbours import load_neighbour_table, remove_neighbour_table
+from catalogues import build_lookup, get_catalogue, iter_catalogue_chunks, CHUNK_ROWS
+from catalogue_store import store_exists, open_store, ingest
+from text_prep import load_preprocess_cache, save_preprocess_cache
+from metrics import span
+from upstream import gather, batch_timeout
+
+MERGE_INTERVAL = 600  # Seconds between background merges into the main index
+MERGE_THRESHOLD = 1  # Minimum delta size worth merging
+QUERY_BLOCK_BYTES = 256 * 1024 * 1024  # Dense query x catalogue scores computed at once by candidates_many
+
+logger = logging.getLogger(__name__)
+
+def append_line(path, item):
+    # One JSON object per line; the lock keeps concurrent appends from interleaving
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(item) + '\n')
+
+@contextmanager
+def locked_lines(path):
+    # (file, items) of a JSON-lines file under an exclusive lock, for read-modify-write;
+    # append_line() waits on the same lock, so no line is lost or interleaved meanwhile
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        yield f, [json.loads(line) for line in f if line.strip()]
+
+def rewrite_lines(f, items):
+    f.truncate(0)
+    f.write(''.join(json.dumps(item) + '\n' for item in items))
+
+def read_lines(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def item_vector(item, n_features):
+    # Row vector of a delta line
+    data = np.array(item['data'], dtype=np.float32)
+    indices = np.array(item['indices'], dtype=np.int32)
+    return sparse.csr_matrix((data, indices, [0, len(data)]), shape=(1, n_features))
+
+def unique_items(items, seen=()):
+    # First item per key: serve.py workers each append the unseen IDs they are asked for,
+    # so two of them can write the same item
+    seen = set(seen)
+    unique = []
+    for item in items:
+        if item['key'] not in seen:
+            seen.add(item['key'])
+            unique.append(item)
+    return unique
+
+def save_npz_atomic(path, matrix):
+    # Readers (other workers, the next load) see the old file or the new one, never a partial write
+    tmp_path = path + '.tmp.npz'
+    sparse.save_npz(tmp_path, matrix)
+    os.replace(tmp_path, path)
+
+def pickle_atomic(path, value):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(value, f)
+    os.replace(tmp_path, path)
+
+@contextmanager
+def file_lock(path, operation=fcntl.LOCK_EX):
+    with open(path, 'a') as f:
+        fcntl.flock(f, operation)
+        yield
+
+def index_files_lock(features_path, operation=fcntl.LOCK_EX):
+    # Guards an index's features + vectorizers pair: builds and merges write under LOCK_EX,
+    # loads read under LOCK_SH, so a load never pairs a new matrix with old vectorizers
+    return file_lock(features_path + '.lock', operation)
+
+def read_index_files(features_path, vectorizers_path):
+    # (features, vectorizers) as last written, or (None, None) before the first build
+    with index_files_lock(features_path, fcntl.LOCK_SH):
+        if not (os.path.exists(features_path) and os.path.exists(vectorizers_path)):
+            return None, None
+        features = sparse.load_npz(features_path).tocsr()
+        with open(vectorizers_path, 'rb') as f:
+            return features, pickle.load(f)
+
+def load_or_build(n_rows, features_path, vectorizers_path, build):
+    # (features, vectorizers, None) saved for an n_rows frame, or (None, None, index) when they were
+    # missing or out of date and build(previous vectorizers) rebuilt them. Loaders that find the files
+    # out of date queue on one build lock, so the first rebuilds and the rest read what it wrote.
+    features, vectorizers = read_index_files(features_path, vectorizers_path)
+    if features is not None and features.shape[0] == n_rows:
+        return features, vectorizers, None
+    with file_lock(features_path + '.build'):
+        features, vectorizers = read_index_files(features_path, vectorizers_path)
+        if features is not None and features.shape[0] == n_rows:
+            return features, vectorizers, None
+        return None, None, build(vectorizers or {})
+
+class DeltaSegment:
+    # Append-only segment of out-of-catalogue items (an unseen IMDb title or Google Books volume).
+    # Each item is one JSON line: its key, its display record and its sparse vector against the
+    # index's frozen vocabulary, so a repeated lookup is a dict hit instead of an API call + transform.
+    def __init__(self, path, n_features):
+        self.path = path
+        self.n_features = n_features
+        self.lock = threading.RLock()
+        self.keys = {}
+        self.records = []
+        self.vectors = []
+        self._matrix = None
+        for item in unique_items(read_lines(path)):
+            self.add(item['key'], item['record'], item_vector(item, n_features))
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key):
+        with self.lock:
+            row = self.keys.get(key)
+            if row is None:
+                return None, None
+            return self.records[row], self.vectors[row]
+
+    def append(self, key, record, vector):
+        vector = sparse.csr_matrix(vector, dtype=np.float32)
+        with self.lock:
+            if key in self.keys:
+                return
+            self.add(key, record, vector)
+            if self.path:
+                append_line(self.path, {'key': key, 'record': record,
+                                        'indices': vector.indices.tolist(), 'data': vector.data.tolist()})
+
+    def add(self, key, record, vector):
+        self.keys[key] = len(self.records)
+        self.records.append(record)
+        self.vectors.append(vector)
+        self._matrix = None
+
+    def snapshot(self):
+        with self.lock:
+            if self._matrix is None:
+                if self.vectors:
+                    self._matrix = sparse.vstack(self.vectors, format='csr')
+                else:
+                    self._matrix = sparse.csr_matrix((0, self.n_features), dtype=np.float32)
+            return list(self.keys), list(self.records), self._matrix
+
+    def pending_on_disk(self):
+        return bool(self.path) and os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def discard(self, keys):
+        # Drop merged items from memory; the file is truncated by the merge itself
+        with self.lock:
+            keep = [row for key, row in self.keys.items() if key not in keys]
+            self.records = [self.records[row] for row in keep]
+            self.vectors = [self.vectors[row] for row in keep]
+            self.keys = {key: i for i, key in enumerate(key for key in self.keys if key not in keys)}
+            self._matrix = None
+
+class SegmentedIndex:
+    # Main (frozen) matrix plus a delta segment for items added at serve time.
+    # Subclasses provide project(record) -> row vector, RECORD_COLUMNS for display,
+    # CATALOGUE for the lookup columns and TITLE_COLUMN/AUTHOR_COLUMN (author or director)/YEAR_COLUMN
+    # for matching fetched records to catalogue rows. For building and loading (the classmethods at
+    # the end) they also provide the file paths, VECTORIZERS (the names of their constructor's
+    # vectorizer arguments, as saved) and fit()/store_fields()/store_inputs()/combine_blocks().
+    RECORD_COLUMNS = []
+    CATALOGUE = None
+    TITLE_COLUMN = None
+    AUTHOR_COLUMN = None
+    YEAR_COLUMN = None
+    STORE_COLUMNS = None  # Catalogue columns kept in a store; RECORD_COLUMNS when None
+    VECTORIZERS = ()
+    FEATURES_PATH = None
+    VECTORIZERS_PATH = None
+    PREPROCESS_CACHE_PATH = None
+    DELTA_PATH = None
+    MERGED_PATH = None
+    STORE_DIR = None
+    NEIGHBOURS_PREFIX = None
+
+    def __init__(self, df, features, keys=None, features_path=None, merged_path=None, delta_path=None, neighbours_prefix=None):
+        self.df = df
+        self.features = features
+        self.features_path = features_path
+        self.merged_path = merged_path
+        self.lock = threading.Lock()
+        self.delta = DeltaSegment(delta_path, features.shape[1])
+        self.neighbours = load_neighbour_table(neighbours_prefix, len(df)) if neighbours_prefix else None
+        # Title (with author and year) and external ID (including keys merged from earlier deltas) -> row
+        self.lookup = build_lookup(self.CATALOGUE, df)
+        self.lookup.by_id.update(keys or {})
+        self.catalogue_rows = len(df) - len(keys or {})  # Rows before the items merged from deltas (see load_merged)
+
+    def match_record(self, record):
+        # (row, confirmed) of a fetched record in the catalogue, see CatalogueLookup.match
+        author = record.get(self.AUTHOR_COLUMN) if self.AUTHOR_COLUMN else None
+        year = record.get(self.YEAR_COLUMN) if self.YEAR_COLUMN else None
+        return self.lookup.match(record.get(self.TITLE_COLUMN), author, year)
+
+    def precomputed_neighbours(self, row):
+        # Neighbour ids and scores from the offline table for a catalogue row, else (None, None)
+        if row is None or self.neighbours is None or row >= len(self.neighbours):
+            return None, None
+        return self.neighbours.lookup(row)
+
+    def project(self, record):
+        raise NotImplementedError
+
+    def reproject(self, items):
+        # Re-vectorize delta items saved against an older vocabulary (see take_delta)
+        for item in items:
+            self.delta.append(item['key'], item['record'], self.project(item['record']))
+
+    def resolve(self, key, fetch):
+        # (record, vector, row) for an external ID; row is None unless the item is in the main index.
+        # fetch(key) is only called the first time a key is seen.
+        with self.lock:
+            row = self.lookup.find(key=key)
+            if row is not None:
+                return self.df.iloc[row][self.RECORD_COLUMNS].to_dict(), self.features[row], row
+        record, vector = self.delta.get(key)
+        if record is not None:
+            return record, vector, None
+
+        with span('fetch'):
+            record = fetch(key)
+        if record is None:
+            return None, None, None
+        with self.lock:
+            row, confirmed = self.match_record(record)
+            if row is not None:
+                # Already in the catalogue: no vector to store, and answer with the catalogue's record so
+                # its title matches the row's (rank() excludes the input by title). The ID is remembered
+                # only when the author/director or year confirmed the title; a bare title match is
+                # checked again next time (against the response cache), so a mistake doesn't stick.
+                if confirmed:
+                    self.lookup.add(row, None, key=key)
+                return self.df.iloc[row][self.RECORD_COLUMNS].to_dict(), self.features[row], row
+        record = {column: record.get(column) for column in self.RECORD_COLUMNS}
+        with span('project'):
+            vector = self.project(record)
+        self.delta.append(key, record, vector)
+        return record, vector, None
+
+    def resolve_many(self, keys, fetch):
+        # resolve() for each distinct key, in first-seen order; fetches for unseen keys run concurrently
+        keys = list(dict.fromkeys(keys))
+        resolved = gather([(self.resolve, key, fetch) for key in keys], batch_timeout(len(keys)), (None, None, None))
+        return dict(zip(keys, resolved))
+
+    def recommend_many(self, keys, fetch, k, rank_neighbours, rank_search):
+        # (key, record, recs) per distinct key, in order: rank_neighbours(row, record) for titles on the
+        # neighbour table (None otherwise), else rank_search(candidates() result, record, row), with
+        # the searches scored together by candidates_many()
+        resolved = self.resolve_many(keys, fetch)
+        searches = [key for key, (record, _, row) in resolved.items()
+                    if record is not None and self.precomputed_neighbours(row)[0] is None]
+        results = iter(())
+        if searches:
+            query_matrix = sparse.vstack([resolved[key][1] for key in searches], format='csr')
+            results = self.candidates_many(query_matrix, k)
+        for key, (record, _, row) in resolved.items():
+            if record is None:
+                yield key, None, []
+                continue
+            recs = rank_neighbours(row, record)
+            if recs is None:
+                recs = rank_search(next(results), record, row)
+            yield key, record, recs
+
+    def candidates(self, query_vec, k):
+        # Best k rows of the main matrix plus the best k delta rows, as one frame ordered by score.
+        # rows maps each frame position to its main-index row, -1 for delta items.
+        return next(self.candidates_many(query_vec, k))
+
+    def candidates_many(self, query_matrix, k):
+        # candidates() for each row of query_matrix, in order. Scores come from one sparse product
+        # per block of queries, rather than one pass over the catalogue per query.
+        with self.lock:
+            df, features = self.df, self.features
+        query_matrix = normalize_rows(query_matrix)
+        _, delta_records, delta_matrix = self.delta.snapshot()
+        block_size = max(1, QUERY_BLOCK_BYTES // (max(features.shape[0], 1) * 8))
+        for start in range(0, query_matrix.shape[0], block_size):
+            block = query_matrix[start:start + block_size]
+            with span('similarity'):
+                block_scores = (block @ features.T).toarray()
+                delta_scores = (block @ delta_matrix.T).toarray() if delta_records else None
+            for i, scores in enumerate(block_scores):
+                indices, scores = top_k(scores, k)
+                candidates = df.iloc[indices][self.RECORD_COLUMNS]
+                rows = indices
+                if delta_records:
+                    # Only the delta's own top k become records, so a large delta costs one product, not a frame
+                    delta_indices, delta_top = top_k(delta_scores[i], k)
+                    delta_frame = pd.DataFrame([delta_records[j] for j in delta_indices], columns=self.RECORD_COLUMNS)
+                    candidates = pd.concat([candidates, delta_frame])
+                    scores = np.concatenate([scores, delta_top])
+                    rows = np.concatenate([rows, np.full(len(delta_indices), -1)])
+                candidates = candidates.reset_index(drop=True)
+                order = np.argsort(-scores, kind='stable')
+                yield candidates, order, scores[order], rows
+
+    def merge_delta(self):
+        # Fold the shared delta file into the main matrix on disk, then bring this process's index up
+        # to date with it. Runs under an exclusive lock on the delta file, so with several workers each
+        # item is merged once, by whichever gets there first, and appends wait instead of being lost.
+        # Indexes over a memory-mapped store (no features_path) pick the delta up on the next ingest instead.
+        if self.features_path is None or self.merged_path is None or self.delta.path is None:
+            return 0
+        with index_files_lock(self.features_path), locked_lines(self.delta.path) as (log, items):
+            merged = unique_items(read_lines(self.merged_path))
+            pending = unique_items(items, [item['key'] for item in merged])
+            features = sparse.load_npz(self.features_path).tocsr()
+            if features.shape[0] != self.catalogue_rows + len(merged):
+                logger.warning("%s doesn't match %s; merge skipped until the index is rebuilt", self.features_path, self.merged_path)
+                return 0
+            if pending:
+                matrix = sparse.vstack([item_vector(item, features.shape[1]) for item in pending], format='csr')
+                features = sparse.vstack([features, matrix], format='csr')
+                # Persist before dropping the delta lines, so a crash loses nothing
+                save_npz_atomic(self.features_path, features)
+                for item in pending:
+                    append_line(self.merged_path, {'key': item['key'], 'record': item['record']})
+                merged += pending
+            log.truncate(0)
+        return self.sync_merged(merged, features)
+
+    def sync_merged(self, merged, features):
+        # Append the merged rows this process doesn't have yet (its own merge, or another worker's)
+        with self.lock:
+            start = len(self.df)
+            new = merged[start - self.catalogue_rows:]
+            if not new:
+                return 0
+            records = [item['record'] for item in new]
+            self.df = pd.concat([self.df, pd.DataFrame(records)], ignore_index=True)
+            self.features = sparse.vstack([self.features, normalize_rows(features[start:])], format='csr')
+            for i, (item, record) in enumerate(zip(new, records)):
+                author = record.get(self.AUTHOR_COLUMN) if self.AUTHOR_COLUMN else None
+                year = record.get(self.YEAR_COLUMN) if self.YEAR_COLUMN else None
+                self.lookup.add_record(start + i, record.get(self.TITLE_COLUMN), author, item['key'], year)
+        self.delta.discard({item['key'] for item in new})
+        return len(new)
+
+    @classmethod
+    def from_vectorizers(cls, df, features, vectorizers, keys=None, **paths):
+        return cls(df, features, *(vectorizers.get(name) for name in cls.VECTORIZERS), keys=keys, **paths)
+
+    @classmethod
+    def fit(cls, df, previous):
+        # (features, vectorizers by name) fitted on df; previous holds the last build's vectorizers
+        raise NotImplementedError
+
+    @classmethod
+    def build(cls, df=None, features_path=None, vectorizers_path=None, previous=None, keys=None):
+        features_path = features_path or cls.FEATURES_PATH
+        vectorizers_path = vectorizers_path or cls.VECTORIZERS_PATH
+        if df is None:
+            df, keys = load_merged(get_catalogue(cls.CATALOGUE), cls.MERGED_PATH)
+        # Descriptions unchanged since the last build are served from the content-hash cache
+        load_preprocess_cache(cls.PREPROCESS_CACHE_PATH)
+        features, vectorizers = cls.fit(df, previous or {})
+        save_preprocess_cache(cls.PREPROCESS_CACHE_PATH)
+
+        with index_files_lock(features_path):
+            save_npz_atomic(features_path, features)
+            pickle_atomic(vectorizers_path, vectorizers)
+            pending = take_delta(cls.DELTA_PATH)
+        remove_neighbour_table(cls.NEIGHBOURS_PREFIX)  # Rebuild with `python neighbours.py <catalogue>`
+        index = cls.from_vectorizers(df, features, vectorizers, keys, features_path=features_path)
+        index.reproject(pending)
+        return index
+
+    @classmethod
+    def load(cls, df=None, features_path=None, vectorizers_path=None):
+        features_path = features_path or cls.FEATURES_PATH
+        vectorizers_path = vectorizers_path or cls.VECTORIZERS_PATH
+        if df is None and store_exists(cls.STORE_DIR):
+            return cls.load_store()
+        if df is None:
+            df = get_catalogue(cls.CATALOGUE)
+        df, keys = load_merged(df, cls.MERGED_PATH)
+        # Built when missing or when the dataset changed since the last build
+        features, vectorizers, index = load_or_build(len(df), features_path, vectorizers_path, lambda previous: cls.build(
+            df, features_path, vectorizers_path, previous, keys))
+        if index is not None:
+            return index
+        return cls.from_vectorizers(df, features, vectorizers, keys, features_path=features_path)
+
+    @classmethod
+    def store_fields(cls):
+        # [(vectorizer name, HashingVectorizer, use_idf)] for ingest()
+        raise NotImplementedError
+
+    @classmethod
+    def store_inputs(cls, frame, n_jobs):
+        # One input per store field for a chunk of records
+        raise NotImplementedError
+
+    @classmethod
+    def combine_blocks(cls, blocks, extra):
+        raise NotImplementedError
+
+    @classmethod
+    def delta_frame(cls, records):
+        return pd.DataFrame(records, columns=cls.RECORD_COLUMNS)
+
+    @classmethod
+    def ingest_store(cls, store_dir=None, chunk_rows=CHUNK_ROWS, extra=None):
+        # Streams the catalogue CSV (plus items added at serve time) into a memory-mapped store;
+        # extra is saved with the vectorizers (e.g. feature weights) and passed to combine_blocks()
+        store_dir = store_dir or cls.STORE_DIR
+        n_jobs = os.cpu_count() or 1
+        ingested = []  # Keys of the serve-time items in this ingest
+
+        def chunks():
+            for chunk in iter_catalogue_chunks(cls.CATALOGUE, chunk_rows):
+                yield chunk, cls.store_inputs(chunk, n_jobs), None
+            pending = pending_items(cls.MERGED_PATH, cls.DELTA_PATH)
+            ingested.extend(item['key'] for item in pending)
+            if pending:
+                frame = cls.delta_frame([item['record'] for item in pending])
+                yield frame, cls.store_inputs(frame, 1), [item['key'] for item in pending]
+
+        meta = ingest(chunks(), cls.store_fields(), lambda blocks: cls.combine_blocks(blocks, extra or {}), store_dir,
+                      cls.STORE_COLUMNS or cls.RECORD_COLUMNS, extra=extra)
+        fold_delta(cls.DELTA_PATH, cls.MERGED_PATH, ingested)  # Now part of the store, and of the next ingest
+        remove_neighbour_table(cls.NEIGHBOURS_PREFIX)
+        return meta
+
+    @classmethod
+    def load_store(cls, store_dir=None):
+        # Features stay memory-mapped; the catalogue frame is read from the same store by get_catalogue
+        store_dir = store_dir or cls.STORE_DIR
+        features, vectorizers, keys = open_store(store_dir)
+        df = get_catalogue(cls.CATALOGUE)
+        if features.shape[0] != len(df):
+            raise ValueError(f"{store_dir} doesn't match the loaded catalogue, call reload_catalogues({cls.CATALOGUE!r}) after ingesting")
+        return cls.from_vectorizers(df, features, vectorizers, keys, features_path=None, merged_path=None)
+
+def load_merged(df, merged_path):
+    # Catalogue frame extended with items merged from earlier deltas, and their key -> row map
+    items = unique_items(read_lines(merged_path))
+    if not items:
+        return df, {}
+    keys = {item['key']: len(df) + i for i, item in enumerate(items)}
+    df = pd.concat([df, pd.DataFrame([item['record'] for item in items])], ignore_index=True)
+    return df, keys
+
+def pending_items(merged_path, delta_path):
+    # Items added at serve time, merged or not, as {'key', 'record'} dicts
+    return [{'key': item['key'], 'record': item['record']} for item in unique_items(read_lines(merged_path) + read_lines(delta_path))]
+
+def fold_delta(delta_path, merged_path, keys):
+    # Record the delta items a store was just ingested with (keys) as merged; items appended
+    # since the ingest read the delta stay in it for the next one
+    if not os.path.exists(delta_path):
+        return
+    keys = set(keys)
+    with locked_lines(delta_path) as (log, items):
+        merged = [item['key'] for item in read_lines(merged_path)]
+        for item in unique_items([item for item in items if item['key'] in keys], merged):
+            append_line(merged_path, {'key': item['key'], 'record': item['record']})
+        rewrite_lines(log, [item for item in items if item['key'] not in keys])
+
+def take_delta(delta_path):
+    # Empty a delta file before a rebuild changes the vocabulary, returning its items for reproject()
+    if not os.path.exists(delta_path):
+        return []
+    with locked_lines(delta_path) as (log, items):
+        log.truncate(0)
+    return items
+
+def start_merge_thread(get_indexes, interval=MERGE_INTERVAL):
+    # get_indexes() returns the indexes currently being served, so reloaded indexes are picked up
+    def run():
+        while True:
+            time.sleep(interval)
+            for index in get_indexes():
+                try:
+                    # Items another worker appended count too; merge_delta() also picks up their merges
+                    if len(index.delta) >= MERGE_THRESHOLD or index.delta.pending_on_disk():
+                        index.merge_delta()
+                except Exception:
+                    logger.exception("Merging delta segment into %s failed", type(index).__name__)
+
+    thread = threading.Thread(target=run, name="delta-merge", daemon=True)
+    thread.start()
+    return thread
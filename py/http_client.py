@@ -0,0 +1,132 @@
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import instrument_session
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5  # Seconds, doubled per attempt, with full jitter
+BACKOFF_MAX = 8
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BREAKER_THRESHOLD = 5  # Consecutive failures before a host is short-circuited
+BREAKER_COOLDOWN = 30  # Seconds before a single trial request is let through again
+POOL_SIZE = 32
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                self.opened_at = time.monotonic()  # Half-open: one trial, others wait another cooldown
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+class HTTPClient:
+    # Keep-alive session shared by every thread, with timeouts, retries and a breaker per host
+    def __init__(self, max_retries=MAX_RETRIES, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=POOL_SIZE,
+                 backoff_base=BACKOFF_BASE, breaker_threshold=BREAKER_THRESHOLD, breaker_cooldown=BREAKER_COOLDOWN):
+        self.session = instrument_session(requests.Session())  # Every attempt is timed in metrics
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.breakers = defaultdict(lambda: CircuitBreaker(breaker_threshold, breaker_cooldown))
+        self.counters = defaultdict(lambda: defaultdict(float))
+        self.lock = threading.Lock()
+
+    def count(self, host, name, value=1):
+        with self.lock:
+            self.counters[host][name] += value
+
+    def backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), BACKOFF_MAX)
+        return random.uniform(0, min(BACKOFF_MAX, self.backoff_base * 2 ** attempt))
+
+    def get(self, url, params=None, headers=None):
+        # Returns the final response (any status), or raises for connection errors and open breakers
+        host = urlsplit(url).netloc
+        breaker = self.breakers[host]
+        if not breaker.allow():
+            self.count(host, 'short_circuited')
+            raise CircuitOpenError(f"circuit open for {host}")
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            response = None
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            self.count(host, 'requests')
+            self.count(host, 'latency_seconds', time.perf_counter() - start)
+
+            retryable = error is not None or response.status_code in RETRY_STATUSES
+            if not retryable:
+                breaker.record_success()
+                return response
+            self.count(host, 'errors')
+            if attempt >= self.max_retries:
+                breaker.record_failure()
+                if error is not None:
+                    raise error
+                return response
+            self.count(host, 'retries')
+            time.sleep(self.backoff(attempt, response))
+            attempt += 1
+
+    def stats(self):
+        # host -> counters, plus breaker_open (1 while the host is short-circuited or on trial)
+        with self.lock:
+            stats = {host: dict(counters) for host, counters in self.counters.items()}
+        for host, breaker in list(self.breakers.items()):
+            stats.setdefault(host, {})['breaker_open'] = int(breaker.opened_at is not None)
+        return stats
+
+_client = HTTPClient()
+
+def get_client():
+    return _client
+
+def get(url, params=None, headers=None):
+    # Convenience wrapper: None instead of an exception when the host can't be reached
+    try:
+        return _client.get(url, params=params, headers=headers)
+    except (CircuitOpenError, requests.RequestException) as e:
+        logger.warning("GET %s failed: %s", url, e)
+        return None
@@ -0,0 +1,176 @@
+import bisect
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+import requests
+from cache import get_cache
+
+# Prometheus text exposition, kept in process; each worker process serves its own /metrics
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + '}'
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for label_values, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                labels = format_labels(self.label_names + ['le'], label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {values[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class CounterMetric:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, value=1):
+        with self.lock:
+            self.values[label_values] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = dict(self.values)
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+request_seconds = Histogram('recc_request_seconds', "Latency of /recommend by branch.", ['branch'])
+stage_seconds = Histogram('recc_stage_seconds', "Latency of each pipeline stage by branch.", ['branch', 'stage'])
+upstream_seconds = Histogram('recc_upstream_seconds', "Latency of upstream API calls by host.", ['host'])
+upstream_requests = CounterMetric('recc_upstream_requests_total', "Upstream API calls by host and status.", ['host', 'status'])
+METRICS = [request_seconds, stage_seconds, upstream_seconds, upstream_requests]
+
+class Trace:
+    # Spans and upstream calls of one request; shared with the upstream pool threads it fans out to
+    def __init__(self, branch):
+        self.branch = branch
+        self.start = time.perf_counter()
+        self.spans = []
+        self.upstream = Counter()
+        self.upstream_time = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def add_span(self, name, seconds):
+        with self.lock:
+            self.spans.append((name, seconds))
+
+    def add_upstream(self, host, seconds):
+        with self.lock:
+            self.upstream[host] += 1
+            self.upstream_time[host] += seconds
+
+    def server_timing(self):
+        # Server-Timing header, shown per request in the browser's network panel
+        with self.lock:
+            entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.spans]
+            entries += [f'upstream;desc="{host} x{count}";dur={self.upstream_time[host] * 1000:.1f}'
+                        for host, count in self.upstream.items()]
+        return ', '.join(entries)
+
+_trace = ContextVar('trace', default=None)
+
+def start_trace(branch):
+    trace = Trace(branch)
+    return trace, _trace.set(trace)
+
+def end_trace(trace, token):
+    _trace.reset(token)
+    request_seconds.observe(time.perf_counter() - trace.start, trace.branch)
+
+@contextmanager
+def span(name):
+    # Times a stage of the current request; a no-op outside one (CLI, benchmarks, background merges)
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        trace.add_span(name, seconds)
+        stage_seconds.observe(seconds, trace.branch, name)
+
+def record_response(response, *args, **kwargs):
+    # requests response hook: every upstream call is counted and timed, per request and in total
+    host = urlsplit(response.url).netloc
+    seconds = response.elapsed.total_seconds()
+    upstream_requests.inc(host, response.status_code)
+    upstream_seconds.observe(seconds, host)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_upstream(host, seconds)
+    return response
+
+def instrument_session(session):
+    session.hooks['response'].append(record_response)
+    return session
+
+def instrumented_session():
+    return instrument_session(requests.Session())
+
+# HTTPClient.stats() counter -> (metric, type, help), rendered per upstream host
+HTTP_CLIENT_METRICS = [
+    ('requests', 'recc_http_client_attempts_total', 'counter', "OMDb/Google Books HTTP attempts, retries included, by host."),
+    ('errors', 'recc_http_client_errors_total', 'counter', "Attempts that failed to connect, timed out or got a retryable status, by host."),
+    ('retries', 'recc_http_client_retries_total', 'counter', "Attempts retried after backoff, by host."),
+    ('short_circuited', 'recc_http_client_short_circuited_total', 'counter', "Calls refused while the host's circuit breaker was open, by host."),
+    ('latency_seconds', 'recc_http_client_latency_seconds_total', 'counter', "Time spent in HTTP attempts, by host."),
+    ('breaker_open', 'recc_http_client_breaker_open', 'gauge', "1 while the host's circuit breaker is open or half-open."),
+]
+
+def render():
+    import http_client  # http_client times its session through this module
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += ["# HELP recc_cache_lookups_total Response cache lookups by endpoint and result.",
+              "# TYPE recc_cache_lookups_total counter"]
+    for endpoint, stats in get_cache().stats().items():
+        for result, count in (('hit', stats['hits']), ('miss', stats['misses'])):
+            lines.append(f"recc_cache_lookups_total{format_labels(['endpoint', 'result'], (endpoint, result))} {count}")
+    http_stats = http_client.get_client().stats()
+    for key, name, kind, help_text in HTTP_CLIENT_METRICS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for host, counters in sorted(http_stats.items()):
+            lines.append(f"{name}{format_labels(['host'], (host,))} {counters.get(key, 0)}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,172 @@
+import os
+import resource
+import pandas as pd
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from movie_recc import (fetch_omdb_movie, preprocess_descriptions, fit_features, transform_features, feature_memory,
+                        hash_codes, primary_genres, rank_candidates, to_records, combine_feature_blocks, DEFAULT_FEATURE_WEIGHTS)
+from similarity import normalize_rows
+from catalogues import IMDB_STORE_DIR, CHUNK_ROWS
+from catalogue_store import label_tokens
+from delta_index import SegmentedIndex
+from metrics import span
+
+FEATURES_PATH = "movie_features.npz"
+VECTORIZERS_PATH = "movie_vectorizers.pkl"
+PREPROCESS_CACHE_PATH = "movie_preprocessed.pkl"
+DELTA_PATH = "movie_delta.jsonl"
+MERGED_PATH = "movie_merged.jsonl"
+NEIGHBOURS_PREFIX = "movie"
+STORE_DIR = IMDB_STORE_DIR
+TEXT_HASH_FEATURES = 2 ** 18  # Hashed description terms in a store; no vocabulary to hold in memory
+GENRE_HASH_FEATURES = 2 ** 10
+CANDIDATE_POOL = 50  # Neighbours fetched before de-duplicating descriptions and diversity limits
+
+class MovieIndex(SegmentedIndex):
+    RECORD_COLUMNS = ['Title', 'Genre', 'Description', 'Director', 'Poster']
+    CATALOGUE = 'imdb'
+    TITLE_COLUMN = 'Title'
+    AUTHOR_COLUMN = 'Director'
+    YEAR_COLUMN = 'Year'
+    STORE_COLUMNS = RECORD_COLUMNS + [YEAR_COLUMN]
+    VECTORIZERS = ('tfidf_vectorizer', 'mlb', 'weights')
+    FEATURES_PATH = FEATURES_PATH
+    VECTORIZERS_PATH = VECTORIZERS_PATH
+    PREPROCESS_CACHE_PATH = PREPROCESS_CACHE_PATH
+    DELTA_PATH = DELTA_PATH
+    MERGED_PATH = MERGED_PATH
+    STORE_DIR = STORE_DIR
+    NEIGHBOURS_PREFIX = NEIGHBOURS_PREFIX
+
+    def __init__(self, df, features, tfidf_vectorizer, mlb, weights=None, keys=None,
+                 features_path=FEATURES_PATH, merged_path=MERGED_PATH, delta_path=DELTA_PATH):
+        super().__init__(df, normalize_rows(features), keys, features_path, merged_path, delta_path, NEIGHBOURS_PREFIX)
+        self.tfidf_vectorizer = tfidf_vectorizer
+        self.mlb = mlb
+        self.weights = weights or DEFAULT_FEATURE_WEIGHTS
+        self._codes = None
+
+    def project(self, movie):
+        # Vectorize a single movie (e.g. from OMDb) against the frozen vocabulary
+        movie_df = pd.DataFrame([movie])
+        # Serve time: cache=False keeps one-off texts out of the build's content-hash cache
+        movie_df['preprocessed_description'] = preprocess_descriptions(movie_df['Description'], cache=False)
+        return transform_features(movie_df, self.tfidf_vectorizer, self.mlb, self.weights)
+
+    def ranking_codes(self):
+        # Per-row hash codes for de-duplication and diversity, recomputed when a merge replaces df
+        df = self.df
+        if self._codes is None or self._codes[0] is not df:
+            self._codes = (df, code_columns(df))
+        return self._codes[1]
+
+    def rank(self, frame, rows, scores, title, description, k=3, min_score=None, max_per_director=None, max_per_genre=None):
+        # frame: candidate records; rows: their main-index rows (-1 for delta items); scores aligned with frame
+        with span('rank'):
+            main = rows >= 0
+            codes = {column: values[rows[main]] for column, values in self.ranking_codes().items()}
+            if not main.all():
+                delta_codes = code_columns(frame[~main])
+                for column, values in codes.items():
+                    merged = np.empty(len(rows), dtype=values.dtype)
+                    merged[main], merged[~main] = values, delta_codes[column]
+                    codes[column] = merged
+            exclude = (frame['Title'].to_numpy() == title) | (codes['Description'] == hash_codes([description])[0])
+            ranked = rank_candidates(scores, codes['Description'], k, min_score, exclude,
+                                     [(codes['Director'], max_per_director), (codes['Genre'], max_per_genre)])
+            return to_records(frame, ranked)
+
+    def recommend(self, movie, query_vec=None, k=3, min_score=None, max_per_director=None, max_per_genre=None):
+        if query_vec is None:
+            query_vec = self.project(movie)
+        return self.rank_search(self.candidates(query_vec, CANDIDATE_POOL + k), movie,
+                                k, min_score, max_per_director, max_per_genre)
+
+    def rank_search(self, result, movie, k=3, min_score=None, max_per_director=None, max_per_genre=None):
+        # result: one candidates() tuple; scores are re-aligned with the candidate frame for rank()
+        candidates, order, sorted_scores, rows = result
+        scores = np.empty_like(sorted_scores)
+        scores[order] = sorted_scores
+        return self.rank(candidates, rows, scores, movie['Title'], movie['Description'],
+                         k, min_score, max_per_director, max_per_genre)
+
+    def rank_neighbours(self, row, movie, k=3, min_score=None, max_per_director=None, max_per_genre=None):
+        # Catalogue titles are served from the precomputed neighbour table; None without one
+        ids, scores = self.precomputed_neighbours(row)
+        if ids is None:
+            return None
+        ids = np.asarray(ids, dtype=np.int64)
+        return self.rank(self.df.iloc[ids], ids, scores, movie['Title'], self.df.iloc[row]['Description'],
+                         k, min_score, max_per_director, max_per_genre)
+
+    def recommend_for_imdb_id(self, imdb_id, k=3, min_score=None, max_per_director=None, max_per_genre=None):
+        # OMDb is only called the first time an out-of-catalogue title is seen
+        movie, query_vec, row = self.resolve(imdb_id, fetch_omdb_movie)
+        if movie is None:
+            return None, []
+        recs = self.rank_neighbours(row, movie, k, min_score, max_per_director, max_per_genre)
+        if recs is not None:
+            return movie, recs
+        return movie, self.recommend(movie, query_vec, k, min_score, max_per_director, max_per_genre)
+
+    def recommend_for_imdb_ids(self, imdb_ids, k=3, min_score=None, max_per_director=None, max_per_genre=None):
+        # recommend_for_imdb_id() over a batch: yields (imdb_id, movie, recs) per distinct ID, in order
+        limits = (k, min_score, max_per_director, max_per_genre)
+        return self.recommend_many(imdb_ids, fetch_omdb_movie, CANDIDATE_POOL + k,
+                                   lambda row, movie: self.rank_neighbours(row, movie, *limits),
+                                   lambda result, movie, row: self.rank_search(result, movie, *limits))
+
+    @classmethod
+    def fit(cls, df, previous):
+        # Keeps the weights of the build it replaces
+        weights = previous.get('weights') or DEFAULT_FEATURE_WEIGHTS
+        preprocessed = preprocess_descriptions(df['Description'], n_jobs=os.cpu_count() or 1)
+        # The catalogue frame is shared, so preprocessed text goes on a shallow copy
+        features, tfidf_vectorizer, mlb = fit_features(df.assign(preprocessed_description=preprocessed), weights)
+        return features, {'tfidf_vectorizer': tfidf_vectorizer, 'mlb': mlb, 'weights': weights}
+
+    @classmethod
+    def store_fields(cls):
+        return [
+            ('tfidf_vectorizer', HashingVectorizer(n_features=TEXT_HASH_FEATURES, alternate_sign=False, norm=None, dtype=np.float32), True),
+            ('mlb', HashingVectorizer(n_features=GENRE_HASH_FEATURES, analyzer=label_tokens, alternate_sign=False,
+                                      norm=None, binary=True, dtype=np.float32), False),
+        ]
+
+    @classmethod
+    def store_inputs(cls, frame, n_jobs):
+        return [preprocess_descriptions(frame['Description'], n_jobs, cache=False), frame['Genre']]
+
+    @classmethod
+    def combine_blocks(cls, blocks, extra):
+        return combine_feature_blocks(*blocks, extra['weights'])
+
+    @classmethod
+    def delta_frame(cls, records):
+        frame = super().delta_frame(records)
+        frame[['Title', 'Description', 'Poster']] = frame[['Title', 'Description', 'Poster']].fillna('')
+        return frame
+
+def code_columns(frame):
+    return {
+        'Description': hash_codes(frame['Description']),
+        'Director': hash_codes(frame['Director']),
+        'Genre': hash_codes(primary_genres(frame['Genre'])),
+    }
+
+def build_movie_index(df=None, features_path=FEATURES_PATH, vectorizers_path=VECTORIZERS_PATH, weights=None, keys=None):
+    return MovieIndex.build(df, features_path, vectorizers_path, {'weights': weights}, keys)
+
+def ingest_movie_store(store_dir=STORE_DIR, chunk_rows=CHUNK_ROWS, weights=None):
+    return MovieIndex.ingest_store(store_dir, chunk_rows, {'weights': weights or DEFAULT_FEATURE_WEIGHTS})
+
+load_movie_store = MovieIndex.load_store
+load_movie_index = MovieIndex.load
+
+if __name__ == "__main__":
+    index = build_movie_index()
+    n_rows, n_cols = index.features.shape
+    print(f"Indexed {n_rows} movies with {n_cols} features.")
+    print(f"Sparse feature matrix: {feature_memory(index.features) / 1e6:.1f} MB "
+          f"(dense float64 would be {n_rows * n_cols * 8 / 1e6:.1f} MB)")
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
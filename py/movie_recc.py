@@ -1,62 +1,113 @@
 import pandas as pd
 import re
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.preprocessing import MultiLabelBinarizer
+from sklearn.preprocessing import MultiLabelBinarizer, normalize
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-import requests
-from bs4 import BeautifulSoup
-
-# NLTK setup
-nltk.download('stopwords')
-nltk.download('punkt')
-
-def preprocess_text(text):
-    if pd.isna(text):
-        return ''
-    text = text.lower()
-    tokens = word_tokenize(text)
-    stop_words = set(stopwords.words('english'))
-    tokens = [word for word in tokens if word.isalpha() and word not in stop_words]
-    return ' '.join(tokens)
-
-def compute_features(df):
-    tfidf_vectorizer = TfidfVectorizer(max_features=5000)
+from scipy import sparse
+import os
+from functools import lru_cache
+import http_client
+from cache import cached
+from text_prep import preprocess_series
+
+OMDB_API_URL = os.environ.get("OMDB_API_URL", "http://www.omdbapi.com/")
+OMDB_API_KEY = os.environ.get("OMDB_API_KEY", "7d9eb382")
+
+def preprocess_descriptions(descriptions, n_jobs=1, cache=True):
+    return preprocess_series(descriptions, n_jobs=n_jobs, cache=cache)
+
+DEFAULT_FEATURE_WEIGHTS = {'description': 1.0, 'genre': 1.0}
+
+def combine_feature_blocks(tfidf_matrix, genre_matrix, weights=None):
+    # Weighted sparse hstack, rows L2-normalised so a dot product is the cosine similarity
+    weights = weights or DEFAULT_FEATURE_WEIGHTS
+    combined_features = sparse.hstack((tfidf_matrix * weights['description'],
+                                       genre_matrix * weights['genre']), format='csr', dtype=np.float32)
+    return normalize(combined_features, norm='l2', copy=False)
+
+def fit_features(df, weights=None):
+    tfidf_vectorizer = TfidfVectorizer(max_features=5000, dtype=np.float32)
     tfidf_matrix = tfidf_vectorizer.fit_transform(df['preprocessed_description'])
-    mlb = MultiLabelBinarizer()
+    mlb = MultiLabelBinarizer(sparse_output=True)
     genre_matrix = mlb.fit_transform(df['Genre'])
-    combined_features = np.hstack((tfidf_matrix.toarray(), genre_matrix))
-    return combined_features
-
-def cosine_similarity_matrix(combined_features):
-    return cosine_similarity(combined_features, combined_features)
-
-def get_recommendations(title, cosine_sim, df):
-    if title not in df['Title'].values:
-        return ["Movie not found in the dataset."]
-    
-    idx = df[df['Title'] == title].index[0]
-    sim_scores = list(enumerate(cosine_sim[idx]))
-    sim_scores = sorted(sim_scores, key=lambda x: x[1], reverse=True)
-    sim_scores = sim_scores[1:]  # Exclude the first one (itself)
-
-    recommended_titles = []
-    recommended_movies = []
-    seen_descriptions = set()
-
-    for sim_idx, _ in sim_scores:
-        row = df.iloc[sim_idx]
-        if row['Description'] not in seen_descriptions and row['Title'] != title:
-            if row['Description'] != df.iloc[idx]['Description']:  # Compare descriptions
-                seen_descriptions.add(row['Description'])
-                recommended_movies.append(row[['Title', 'Genre', 'Description', 'Director', 'Poster']])
-            if len(recommended_movies) == 3:
-                break
-
-    return recommended_movies
+    combined_features = combine_feature_blocks(tfidf_matrix, genre_matrix, weights)
+    return combined_features, tfidf_vectorizer, mlb
+
+def transform_features(df, tfidf_vectorizer, mlb, weights=None):
+    # Project rows onto an already fitted vocabulary, no refitting
+    tfidf_matrix = tfidf_vectorizer.transform(df['preprocessed_description'])
+    genre_matrix = mlb.transform(df['Genre'])
+    return combine_feature_blocks(tfidf_matrix, genre_matrix, weights)
+
+def feature_memory(matrix):
+    # Bytes held by a CSR matrix, or by a dense array
+    if sparse.issparse(matrix):
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return np.asarray(matrix).nbytes
+
+RANKED_COLUMNS = ['Title', 'Genre', 'Description', 'Director', 'Poster']
+RANKED_DTYPE = np.dtype([('position', np.int64), ('score', np.float32)])
+
+def hash_codes(values):
+    # uint64 code per value; equal strings get equal codes, missing values hash like ''
+    values = pd.Series(values, dtype=object).fillna('').astype(str)
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+@lru_cache(maxsize=None)
+def empty_code():
+    return hash_codes([''])[0]
+
+def primary_genres(genres):
+    return [g[0] if isinstance(g, (list, tuple, np.ndarray)) and len(g) else (g if isinstance(g, str) else '')
+            for g in genres]
+
+def group_ranks(codes):
+    # 0 for the best item of each group, 1 for the second, ...; codes are already in score order
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    ranks = np.empty(len(codes), dtype=np.int64)
+    ranks[order] = np.arange(len(codes)) - np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+    return ranks
+
+def rank_candidates(scores, description_codes, k=3, min_score=None, exclude=None, groups=()):
+    # Vectorised ranking of a candidate pool. All arguments are aligned per candidate:
+    # exclude is a boolean mask, groups a sequence of (codes, max_per_group) diversity limits.
+    # Returns up to k (position, score) records in score order, one per distinct description.
+    scores = np.asarray(scores, dtype=np.float32)
+    order = np.argsort(-scores, kind='stable')
+    keep = np.isfinite(scores[order])
+    if min_score is not None:
+        keep &= scores[order] >= min_score
+    if exclude is not None:
+        keep &= ~np.asarray(exclude, dtype=bool)[order]
+
+    # First (best scoring) occurrence of each description
+    kept = np.flatnonzero(keep)
+    _, first = np.unique(np.asarray(description_codes)[order][kept], return_index=True)
+    keep[:] = False
+    keep[kept[first]] = True
+
+    empty = empty_code()
+    for codes, max_per_group in groups:
+        if max_per_group is None:
+            continue
+        kept = np.flatnonzero(keep)
+        codes = np.asarray(codes)[order][kept]
+        over = (group_ranks(codes) >= max_per_group) & (codes != empty)  # Missing values aren't a group
+        keep[kept[over]] = False
+
+    selected = order[np.flatnonzero(keep)[:k]]
+    ranked = np.empty(len(selected), dtype=RANKED_DTYPE)
+    ranked['position'] = selected
+    ranked['score'] = scores[selected]
+    return ranked
+
+def to_records(frame, ranked, columns=RANKED_COLUMNS):
+    # Display fields for the ranked positions of frame, as a record array (rec['Title'], rec.score)
+    rows = frame.iloc[ranked['position']]
+    arrays = [rows[column].to_numpy(dtype=object) for column in columns]
+    return np.rec.fromarrays(arrays + [ranked['score']], names=list(columns) + ['score'])
 
 def extract_imdb_id(imdb_link):
     imdb_id = re.search(r'tt\d+', imdb_link)
@@ -64,22 +115,24 @@ def extract_imdb_id(imdb_link):
         return imdb_id.group(0)
     return None
 
-def fill_missing_info(df, imdb_id):
+@cached('omdb.movie')
+def fetch_omdb_movie(imdb_id):
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
         'Accept-Language': 'en-US,en;q=0.5'
     }
-    api_url = f"http://www.omdbapi.com/?i={imdb_id}&apikey=7d9eb382"
-    response = requests.get(api_url, headers=headers)
-    if response.status_code == 200:
+    params = {'i': imdb_id, 'apikey': OMDB_API_KEY}
+    response = http_client.get(OMDB_API_URL, params=params, headers=headers)
+    if response is not None and response.status_code == 200:
         movie_data = response.json()
         if movie_data['Response'] == 'True':
             new_movie = {
                 'Title': movie_data.get('Title', 'N/A'),
                 'Description': movie_data.get('Plot', 'N/A'),
                 'Genre': movie_data.get('Genre', 'N/A').split(', '),
-                'preprocessed_description': preprocess_text(movie_data.get('Plot', 'N/A'))
+                'Director': movie_data.get('Director', 'N/A'),
+                'Year': movie_data.get('Year', 'N/A'),  # For telling remakes apart in the catalogue
+                'Poster': movie_data.get('Poster', 'N/A'),
             }
-            new_movie_df = pd.DataFrame([new_movie])
-            df = pd.concat([df, new_movie_df], ignore_index=True)
-    return df
+            return new_movie
+    return None
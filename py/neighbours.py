@@ -0,0 +1,101 @@
+import multiprocessing
+import os
+import sys
+import numpy as np
+
+N_NEIGHBOURS = 20  # Enough slack for de-duplication and dropping the input item
+BLOCK_BYTES = 256 * 1024 * 1024  # Dense similarity block computed at once per process
+
+# Set in each worker by the pool initializer, so the matrix isn't pickled per block
+_features = None
+
+def neighbour_paths(prefix):
+    return prefix + "_neighbour_ids.npy", prefix + "_neighbour_scores.npy"
+
+def _init_worker(features):
+    global _features
+    _features = features
+
+def _process_block(start, stop, n_neighbours, ids_path, scores_path):
+    # Top-n neighbours of rows [start, stop) against every row; never materialises N x N
+    block = (_features[start:stop] @ _features.T).toarray()
+    block[np.arange(stop - start), np.arange(start, stop)] = -np.inf  # An item isn't its own neighbour
+    top = np.argpartition(-block, n_neighbours - 1, axis=1)[:, :n_neighbours]
+    top_scores = np.take_along_axis(block, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+
+    ids = np.load(ids_path, mmap_mode='r+')
+    scores = np.load(scores_path, mmap_mode='r+')
+    ids[start:stop] = np.take_along_axis(top, order, axis=1)
+    scores[start:stop] = np.take_along_axis(top_scores, order, axis=1)
+    ids.flush()
+    scores.flush()
+    return stop - start
+
+def build_neighbour_table(features, prefix, n_neighbours=N_NEIGHBOURS, n_jobs=None):
+    # features: row-normalised CSR matrix, so the dot product is the cosine similarity
+    n_rows = features.shape[0]
+    n_neighbours = min(n_neighbours, n_rows - 1)
+    ids_path, scores_path = neighbour_paths(prefix)
+    # Written to temporary files and renamed, so readers never see a half-built table
+    tmp_ids_path, tmp_scores_path = ids_path + '.tmp.npy', scores_path + '.tmp.npy'
+    np.lib.format.open_memmap(tmp_ids_path, mode='w+', dtype=np.int32, shape=(n_rows, n_neighbours)).flush()
+    np.lib.format.open_memmap(tmp_scores_path, mode='w+', dtype=np.float16, shape=(n_rows, n_neighbours)).flush()
+
+    block_size = max(1, BLOCK_BYTES // (n_rows * 8))
+    blocks = [(start, min(start + block_size, n_rows), n_neighbours, tmp_ids_path, tmp_scores_path)
+              for start in range(0, n_rows, block_size)]
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs > 1 and len(blocks) > 1:
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(features,)) as pool:
+            pool.starmap(_process_block, blocks)
+    else:
+        _init_worker(features)
+        for block in blocks:
+            _process_block(*block)
+
+    os.replace(tmp_ids_path, ids_path)
+    os.replace(tmp_scores_path, scores_path)
+    return NeighbourTable(prefix)
+
+def remove_neighbour_table(prefix):
+    # Called when the feature matrix is rebuilt, so a stale table is never served
+    for path in neighbour_paths(prefix):
+        if os.path.exists(path):
+            os.remove(path)
+
+class NeighbourTable:
+    # Precomputed top-N neighbours per catalogue row: int32 ids and float16 scores, memory-mapped
+    def __init__(self, prefix):
+        ids_path, scores_path = neighbour_paths(prefix)
+        self.ids = np.load(ids_path, mmap_mode='r')
+        self.scores = np.load(scores_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, row):
+        return self.ids[row], self.scores[row].astype(np.float32)
+
+def load_neighbour_table(prefix, n_rows):
+    # Rows merged in after the table was built only ever append, so a shorter table is still valid
+    if not all(os.path.exists(path) for path in neighbour_paths(prefix)):
+        return None
+    table = NeighbourTable(prefix)
+    if len(table) > n_rows:
+        return None
+    return table
+
+if __name__ == "__main__":
+    from movie_index import load_movie_index, NEIGHBOURS_PREFIX as MOVIE_NEIGHBOURS_PREFIX
+    from book_index import load_book_index, NEIGHBOURS_PREFIX as BOOK_NEIGHBOURS_PREFIX
+
+    targets = {
+        'imdb': (load_movie_index, MOVIE_NEIGHBOURS_PREFIX),
+        'books': (load_book_index, BOOK_NEIGHBOURS_PREFIX),
+    }
+    for name in sys.argv[1:] or list(targets):
+        load_index, prefix = targets[name]
+        index = load_index()
+        table = build_neighbour_table(index.features, prefix)
+        print(f"{name}: {len(table)} rows x {table.ids.shape[1]} neighbours -> {prefix}_neighbour_*.npy")
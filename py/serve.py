@@ -0,0 +1,322 @@
+import argparse
+import gc
+import logging
+import os
+import shutil
+import signal
+import socket
+import threading
+import time
+import pandas as pd
+from werkzeug.serving import make_server
+import web_app
+from spotify_recc import configure_artist_graph, save_artist_graph
+from catalogues import reload_catalogues, IMDB_STORE_DIR, BOOKS_STORE_DIR
+from catalogue_store import store_exists, ready_path, CSRWriter, read_csr, pa
+from movie_index import ingest_movie_store
+from book_index import ingest_book_store
+
+# Pre-fork serving: the supervisor loads every index once, then forks workers that attach to it.
+# Feature matrices are memory-mapped read-only (catalogue stores, or a copy written to SHARED_DIR),
+# so N workers share one copy through the page cache; the rest of what is loaded before the fork
+# (catalogue frames, lookups, ranking codes) is shared copy-on-write.
+#   python serve.py --workers 4 --port 8000
+#   kill -HUP <supervisor pid>     reload the indexes and replace the workers
+# With --watch, a store rebuilt by `python catalogue_store.py imdb` is picked up the same way.
+# Workers only append serve-time items to the shared delta files; the supervisor folds them into the
+# indexes (ingest for a store, merge_delta() otherwise) before each generation, and reloads once a
+# delta file passes FOLD_DELTA_BYTES, so per-query delta scoring stays small.
+# Only the first worker of a generation runs the artist-prefetch threads; the others forward the
+# artists their requests touch to it over a pipe and pick up what it warms from the saved graph.
+STORES = {'imdb': (IMDB_STORE_DIR, ingest_movie_store), 'books': (BOOKS_STORE_DIR, ingest_book_store)}
+SHARED_DIR = os.environ.get("RECC_SHARED_DIR", "shared_indexes")
+WORKERS = int(os.environ.get("RECC_WORKERS", os.cpu_count() or 1))
+POLL_INTERVAL = 1  # Seconds between supervisor checks for exited workers and signals
+WATCH_INTERVAL = 30  # Seconds between checks for rebuilt catalogue stores (with --watch) and delta sizes
+FOLD_DELTA_BYTES = int(os.environ.get("RECC_FOLD_DELTA_BYTES", 4 * 1024 * 1024))
+SHUTDOWN_TIMEOUT = 30  # Seconds a retiring worker gets to finish its requests
+
+logger = logging.getLogger(__name__)
+
+def ensure_stores():
+    # Build missing catalogue stores, so workers map the features instead of loading them
+    if pa is None:
+        logger.warning("pyarrow isn't installed; indexes are loaded from .npz and shared copy-on-write")
+        return
+    for name, (store_dir, ingest_store) in STORES.items():
+        if store_exists(store_dir):
+            continue
+        logger.info("Ingesting the %s catalogue into %s/", name, store_dir)
+        try:
+            ingest_store()
+        except (OSError, ValueError):
+            logger.exception("Ingesting %s failed; it is served from .npz instead", name)
+
+def store_signature():
+    # The ready marker, not the store itself: it only changes once ingest has swapped the new store in
+    signature = []
+    for store_dir, _ in STORES.values():
+        try:
+            stat = os.stat(ready_path(store_dir))
+            signature.append((stat.st_ino, stat.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append(None)
+    return signature
+
+def delta_bytes():
+    return max((os.path.getsize(index.delta.path) for index in list(web_app.indexes.values())
+                if index.delta.path and os.path.exists(index.delta.path)), default=0)
+
+def fold_deltas():
+    # Serve-time items the workers appended, folded in before the next generation is loaded;
+    # True if a store was re-ingested, so the catalogues need reloading
+    ingested = False
+    for name, index in list(web_app.indexes.items()):
+        if not index.delta.pending_on_disk():
+            continue
+        try:
+            if index.features_path is None:
+                logger.info("Ingesting %s with its delta items", name)
+                STORES[name][1]()
+                ingested = True
+            else:
+                logger.info("Merged %d %s delta items", index.merge_delta(), name)
+        except Exception:
+            logger.exception("Folding the %s delta failed; its items stay in the delta", name)
+    return ingested
+
+def share_features(index, name, shared_dir):
+    # Swap an in-memory feature matrix for a read-only memory-mapped copy; stores are mapped already
+    features = index.features
+    if not features.data.flags.writeable:
+        return
+    writer = CSRWriter(os.path.join(shared_dir, name))
+    writer.append(features)
+    with index.lock:
+        index.features = read_csr(writer.prefix, **writer.close())
+
+def arrow_strings(df):
+    # Text columns as Arrow strings: one buffer per column instead of a Python object per cell,
+    # whose refcount updates would copy the pages into every worker
+    if pa is None:
+        return
+    for column in df.columns:
+        if df[column].dtype == object and pd.api.types.infer_dtype(df[column], skipna=True) == 'string':
+            df[column] = df[column].astype(pd.StringDtype('pyarrow'))
+
+def prepare_indexes(generation):
+    # Everything workers would otherwise each build after the fork
+    shared_dir = os.path.join(SHARED_DIR, f"gen-{generation}")
+    os.makedirs(shared_dir, exist_ok=True)
+    for name, loader in web_app.INDEX_LOADERS.items():
+        index = web_app.indexes.get(name)
+        if index is None:
+            index = loader()
+        arrow_strings(index.df)
+        share_features(index, name, shared_dir)
+        if hasattr(index, 'ranking_codes'):
+            index.ranking_codes()
+        with web_app.indexes_lock:
+            web_app.indexes[name] = index
+    gc.collect()
+    gc.freeze()  # Keep the collector from touching (and so copying) the preloaded objects
+    return shared_dir
+
+def forward_artist(fd, artist_id):
+    try:
+        os.write(fd, artist_id.encode('utf-8') + b'\n')  # Under PIPE_BUF, so lines never interleave
+    except BlockingIOError:
+        pass  # The prefetcher is behind; like a full prefetch queue, the artist is fetched on demand
+
+def receive_artists(fd, graph):
+    # Until every worker of the generation has closed its end
+    with os.fdopen(fd, 'rb') as pipe:
+        for line in pipe:
+            graph.touch(line.decode('utf-8').strip())
+
+def serve_worker(sock, host, port, artist_pipe, prefetcher):
+    for signum in (signal.SIGHUP, signal.SIGINT):
+        signal.signal(signum, signal.SIG_IGN)
+    web_app.merges_enabled = False
+    read_fd, write_fd = artist_pipe
+    if prefetcher:
+        os.close(write_fd)
+        graph = configure_artist_graph()
+        threading.Thread(target=receive_artists, args=(read_fd, graph), name='artist-receive', daemon=True).start()
+    else:
+        os.close(read_fd)
+        configure_artist_graph(workers=0, forward=lambda artist_id: forward_artist(write_fd, artist_id))
+    server = make_server(host, port, web_app.app, threaded=True, fd=sock.fileno())
+    server.daemon_threads = False  # server_close() waits for requests in flight
+
+    def retire(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, retire)
+    server.serve_forever()
+    server.server_close()
+    save_artist_graph()  # Workers leave through os._exit, which skips the graph's atexit save
+
+class Supervisor:
+    def __init__(self, sock, host, port, n_workers, watch=False):
+        self.sock = sock
+        self.host = host
+        self.port = port
+        self.n_workers = n_workers
+        self.watch = watch
+        self.generation = 0
+        self.shared_dir = None
+        self.signature = None
+        self.workers = set()  # pids of the serving generation
+        self.prefetcher = None  # pid of its worker running the artist-prefetch threads
+        self.artist_pipe = None  # (read fd, write fd) the generation's workers forward artists over
+        self.retiring = {}  # pid -> deadline
+        self.reload_requested = False
+        self.stopping = False
+        self.delta_floor = 0  # Delta bytes left after the last fold (e.g. one that failed), so it isn't retried every check
+
+    def spawn(self):
+        prefetcher = self.prefetcher is None
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                serve_worker(self.sock, self.host, self.port, self.artist_pipe, prefetcher)
+                status = 0
+            except Exception:
+                logger.exception("Worker failed")
+            finally:
+                os._exit(status)
+        self.workers.add(pid)
+        if prefetcher:
+            self.prefetcher = pid
+
+    def start_generation(self, old_dir=None):
+        old = self.workers
+        if self.artist_pipe is not None:
+            # Closed before forking, so only the retiring workers hold it: their prefetcher's reader ends with them
+            for fd in self.artist_pipe:
+                os.close(fd)
+        self.workers = set()
+        self.prefetcher = None
+        self.artist_pipe = os.pipe()
+        os.set_blocking(self.artist_pipe[1], False)
+        for _ in range(self.n_workers):
+            self.spawn()
+        # New requests now go to either generation; each is answered entirely by one of them
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for pid in old:
+            os.kill(pid, signal.SIGTERM)
+            self.retiring[pid] = deadline
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)  # Retiring workers keep their mappings
+        logger.info("Generation %d serving with %d workers", self.generation, self.n_workers)
+
+    def reload(self):
+        # Load the new indexes in the supervisor first; on failure the current workers keep serving
+        gc.unfreeze()
+        old_dir = self.shared_dir
+        fold_deltas()
+        try:
+            reload_catalogues()  # web_app.reload_index rebuilds the indexes
+            self.generation += 1
+            self.shared_dir = prepare_indexes(self.generation)
+        except Exception:
+            logger.exception("Reloading the indexes failed; keeping generation %d", self.generation)
+            gc.freeze()
+            return
+        self.signature = store_signature()
+        self.delta_floor = delta_bytes()
+        self.start_generation(old_dir)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self.retiring.pop(pid, None) is not None:
+                continue
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if pid == self.prefetcher:
+                    self.prefetcher = None  # Its replacement takes over prefetching
+                if not self.stopping:
+                    logger.warning("Worker %d exited with status %d, starting another", pid, os.waitstatus_to_exitcode(status))
+                    self.spawn()
+
+    def kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now > deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        ensure_stores()
+        for name, loader in web_app.INDEX_LOADERS.items():
+            web_app.indexes.setdefault(name, loader())
+        if fold_deltas():
+            reload_catalogues()  # Pick up the stores re-ingested with their delta
+        self.delta_floor = delta_bytes()
+        self.shared_dir = prepare_indexes(self.generation)
+        self.signature = store_signature()
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        self.start_generation()
+        last_watch = time.monotonic()
+        while not self.stopping:
+            time.sleep(POLL_INTERVAL)
+            self.reap()
+            self.kill_overdue()
+            if time.monotonic() - last_watch >= WATCH_INTERVAL:
+                last_watch = time.monotonic()
+                if self.watch and store_signature() != self.signature:
+                    logger.info("Catalogue store changed, reloading")
+                    self.reload_requested = True
+                elif delta_bytes() - self.delta_floor > FOLD_DELTA_BYTES:
+                    logger.info("Delta items past %d bytes, folding them in and reloading", FOLD_DELTA_BYTES)
+                    self.reload_requested = True
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+        self.stop()
+
+    def stop(self):
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+            self.retiring[pid] = deadline
+        self.workers = set()
+        while self.retiring:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
+        shutil.rmtree(SHARED_DIR, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the web app from several worker processes sharing one copy of the indexes.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--watch', action='store_true', help="reload when a catalogue store is rebuilt")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(process)d %(levelname)s %(message)s")
+
+    # One listening socket, inherited by every worker; the kernel spreads connections between them
+    sock = socket.create_server((args.host, args.port), backlog=128)
+    sock.set_inheritable(True)
+    Supervisor(sock, args.host, args.port, args.workers, args.watch).run()
+
+if __name__ == "__main__":
+    main()
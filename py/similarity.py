@@ -0,0 +1,38 @@
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+def normalize_rows(matrix):
+    # L2-normalise rows so a plain dot product is the cosine similarity
+    if sparse.issparse(matrix) and not matrix.data.flags.writeable:
+        return matrix  # Memory-mapped catalogue stores are written normalised
+    return normalize(sparse.csr_matrix(matrix), norm='l2', copy=False)
+
+def similarity_scores(query_vec, matrix):
+    # Cosine scores of one query against every row of a row-normalised matrix, O(nnz) instead of O(N^2)
+    query_vec = normalize_rows(query_vec)
+    scores = matrix @ query_vec.T
+    if sparse.issparse(scores):
+        scores = scores.toarray()
+    return np.asarray(scores).ravel()
+
+def top_k(scores, k, exclude=None):
+    scores = np.asarray(scores, dtype=float)
+    if exclude is not None:
+        scores = scores.copy()
+        scores[list(exclude)] = -np.inf
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=int), np.array([], dtype=float)
+
+    # Partial sort: only the k best are ordered
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+    order = order[np.isfinite(scores[order])]
+    return order, scores[order]
+
+def top_k_similar(query_vec, matrix, k, exclude=None):
+    return top_k(similarity_scores(query_vec, matrix), k, exclude)
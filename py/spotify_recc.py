@@ -1,9 +1,24 @@
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.cache_handler import MemoryCacheHandler
+import os
 import re
-from sklearn.cluster import KMeans
-import numpy as np
-from sklearn.metrics.pairwise import euclidean_distances
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from cache import cached
+from upstream import gather, batch_timeout
+from metrics import instrumented_session
+from artist_graph import ArtistGraph, ARTIST_GRAPH_PATH
+from track_batch import TrackBatch
+
+# Spotify Web API limits for the multi-ID endpoints
+TRACKS_BATCH_SIZE = 50
+AUDIO_FEATURES_BATCH_SIZE = 100
+
+TOKEN_REFRESH_MARGIN = 300  # Seconds before expiry at which a token is renewed
+MAX_POOLED_CLIENTS = 256
 
 #def authenticate_spotify():
 #    while True:
@@ -27,18 +42,56 @@ from sklearn.metrics.pairwise import euclidean_distances
 #            print("Authentication failed. Please check your credentials and try again.")
 #            continue
 
+class PooledClientCredentials(SpotifyClientCredentials):
+    # Renews the token a few minutes early so requests never wait on an expired one
+    def is_token_expired(self, token_info):
+        return token_info['expires_at'] - int(time.time()) < TOKEN_REFRESH_MARGIN
+
 def authenticate_spotify(client_id, client_secret):
     if not client_id or not client_secret:
         return None  # Invalid credentials
 
     try:
-        auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-        sp = spotipy.Spotify(auth_manager=auth_manager)
+        # Token kept in memory per client, not in a .cache file shared by all credentials
+        auth_manager = PooledClientCredentials(client_id=client_id, client_secret=client_secret,
+                                               cache_handler=MemoryCacheHandler())
+        sp = spotipy.Spotify(auth_manager=auth_manager, requests_session=instrumented_session())
         sp.track('3n3Ppam7vgaVa1iaRUc9Lp')  # This is a known public track ID
         return sp
     except (spotipy.exceptions.SpotifyException, Exception) as e:
         return None  # Authentication failed
 
+# sha256 of the credentials -> validated client, reused across requests
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+def credential_hash(client_id, client_secret):
+    return hashlib.sha256(f"{client_id}:{client_secret}".encode('utf-8')).hexdigest()
+
+def get_spotify_client(client_id, client_secret):
+    key = credential_hash(client_id, client_secret)
+    with _clients_lock:
+        sp = _clients.get(key)
+        if sp is not None:
+            _clients.move_to_end(key)
+            return sp
+
+    sp = authenticate_spotify(client_id, client_secret)  # Validated once per credential
+    if sp is not None:
+        with _clients_lock:
+            _clients[key] = sp
+            while len(_clients) > MAX_POOLED_CLIENTS:
+                _clients.popitem(last=False)
+    return sp
+
+def prefetch_client():
+    # Background prefetching uses the service credentials when set, else the most recently used pooled client
+    client_id, client_secret = os.environ.get("SPOTIFY_CLIENT_ID"), os.environ.get("SPOTIFY_CLIENT_SECRET")
+    if client_id and client_secret:
+        return get_spotify_client(client_id, client_secret)
+    with _clients_lock:
+        return next(reversed(_clients.values()), None)
+
 def extract_track_id(spotify_url):
     match = re.match(r'(https?://open\.spotify\.com/track/|spotify:track:)([a-zA-Z0-9]+)', spotify_url)
     if match:
@@ -46,10 +99,12 @@ def extract_track_id(spotify_url):
     else:
         raise ValueError("Invalid Spotify URL")
     
-def get_track_details(sp, track_id):
-    track = sp.track(track_id)
-    features = sp.audio_features(track_id)
-    album_art_url = track['album']['images'][0]['url']  # Extract album art URL from track information
+def chunked(ids, size):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+def format_track(track_id, track, features):
+    album_art_url = track['album']['images'][0]['url'] if track['album']['images'] else None  # Extract album art URL from track information
     return {
         'id': track_id,
         'name': track['name'],
@@ -57,61 +112,134 @@ def get_track_details(sp, track_id):
         'artist_id': track['artists'][0]['id'],
         'album': track['album']['name'],
         'release_date': track['album']['release_date'],
-        'energy': features[0]['energy'],
-        'tempo': features[0]['tempo'],
-        'valence': features[0]['valence'],
+        'energy': features['energy'],
+        'tempo': features['tempo'],
+        'valence': features['valence'],
         'url': track['external_urls']['spotify'],
         'album_art_url': album_art_url  # Include album art URL in the dictionary
     }
 
-def get_related_artists(sp, artist_id):
+@cached('spotify.track', skip_args=1, encode=TrackBatch.to_state, decode=TrackBatch.from_state)
+def get_track_details(sp, track_id):
+    # A one-track TrackBatch
+    track = sp.track(track_id)
+    features = sp.audio_features(track_id)
+    return TrackBatch.from_records([format_track(track_id, track, features[0])])
+
+@cached('spotify.related_artists', skip_args=1)
+def fetch_related_artists(sp, artist_id):
     related_artists = sp.artist_related_artists(artist_id)
     return [artist['id'] for artist in related_artists['artists']]
 
-def get_artist_top_tracks(sp, artist_id):
+@cached('spotify.top_tracks', skip_args=1)
+def fetch_artist_top_tracks(sp, artist_id):
     top_tracks = sp.artist_top_tracks(artist_id)
     return [track['id'] for track in top_tracks['tracks']]
 
+_artist_graph = None
+_artist_graph_lock = threading.Lock()
+
+def get_artist_graph(path=ARTIST_GRAPH_PATH):
+    global _artist_graph
+    if _artist_graph is None:
+        with _artist_graph_lock:
+            if _artist_graph is None:
+                _artist_graph = ArtistGraph(path, warm_artist)
+    return _artist_graph
+
+def configure_artist_graph(**kwargs):
+    # For processes that split prefetching between them (serve.py); call before the graph is first used
+    global _artist_graph
+    with _artist_graph_lock:
+        _artist_graph = ArtistGraph(ARTIST_GRAPH_PATH, warm_artist, **kwargs)
+    return _artist_graph
+
+def save_artist_graph():
+    # For processes that exit without running atexit handlers (serve.py workers)
+    if _artist_graph is not None:
+        _artist_graph.save_if_dirty()
+
+def warm_artist(artist_id, related=True):
+    # Background prefetch/refresh of one artist; skips the response cache so stale entries are replaced
+    sp = prefetch_client()
+    if sp is None:
+        return
+    graph = get_artist_graph()
+    if related and graph.needs_related(artist_id):
+        graph.set_related(artist_id, fetch_related_artists.__wrapped__(sp, artist_id))
+    if graph.needs_top(artist_id):
+        track_ids = fetch_artist_top_tracks.__wrapped__(sp, artist_id)
+        graph.set_top(artist_id, track_ids)
+        graph.add_tracks(fetch_track_batch(sp, [track_id for track_id in track_ids if track_id not in graph.tracks]))
+
+def get_related_artists(sp, artist_id):
+    # Served from the artist graph when known (stale entries too, while the prefetch workers refresh them);
+    # either way the artist's neighbourhood is then warmed
+    graph = get_artist_graph()
+    related = graph.related_artists(artist_id)
+    if related is None or (not graph.prefetching() and graph.needs_related(artist_id)):
+        related = fetch_related_artists(sp, artist_id)
+        graph.set_related(artist_id, related)
+    graph.touch(artist_id)
+    return related
+
+def get_artist_top_tracks(sp, artist_id):
+    graph = get_artist_graph()
+    track_ids = graph.top_tracks(artist_id)
+    if track_ids is None or (not graph.prefetching() and graph.needs_top(artist_id)):
+        track_ids = fetch_artist_top_tracks(sp, artist_id)
+        graph.set_top(artist_id, track_ids)
+    return track_ids
+
 def get_related_top(sp, related_artists):
+    # Top tracks from the artist graph; one call per missing (or, without prefetching, stale) artist,
+    # fanned out on the shared upstream pool. A failed refresh keeps the stale entry.
+    graph = get_artist_graph()
+    top_tracks = {artist_id: graph.top_tracks(artist_id) for artist_id in related_artists}
+    refresh = not graph.prefetching()
+    missing = [artist_id for artist_id, tracks in top_tracks.items()
+               if tracks is None or (refresh and graph.needs_top(artist_id))]
+    fetched = gather([(get_artist_top_tracks, sp, artist_id) for artist_id in missing], batch_timeout(len(missing)))
+    for artist_id, tracks in zip(missing, fetched):
+        if tracks is not None:
+            top_tracks[artist_id] = tracks
     related_top_tracks = []
-    for i in related_artists:
-        top_tracks = sp.artist_top_tracks(i)
-        related_top_tracks += [track['id'] for track in top_tracks['tracks']]
+    for artist_id in related_artists:
+        related_top_tracks += top_tracks[artist_id] or []
     return related_top_tracks
 
 def get_related_features(sp, top_artist_rel):
-    related_features = []
-    for i in top_artist_rel:
-        track = sp.track(i)
-        features = sp.audio_features(i)
-        album_art_url = track['album']['images'][0]['url']  # Extract album art URL from track information
-        related_features.append({
-            'id': i,
-            'name': track['name'],
-            'artist': track['artists'][0]['name'],
-            'artist_id': track['artists'][0]['id'],
-            'album': track['album']['name'],
-            'release_date': track['album']['release_date'],
-            'energy': features[0]['energy'],
-            'tempo': features[0]['tempo'],
-            'valence': features[0]['valence'],
-            'url': track['external_urls']['spotify'],
-            'album_art_url': album_art_url  # Include album art URL in the dictionary
-        })
-    return related_features
-
-def recommend_tracks(track_data, track_features, kmeans_model, n_recommendations=3):
-    input_features = np.array([[track_data['energy'], track_data['tempo'], track_data['valence']]])
-    input_cluster = kmeans_model.predict(input_features)[0]
-    
-    cluster_indices = [i for i, label in enumerate(kmeans_model.labels_) if label == input_cluster]
-    
-    cluster_tracks = [track_features[i] for i in cluster_indices]
-    cluster_features = np.array([[f['energy'], f['tempo'], f['valence']] for f in cluster_tracks])
-    
-    distances = euclidean_distances(input_features, cluster_features)[0]
-    closest_indices = distances.argsort()[:n_recommendations + 1]  # Get one extra to account for input track
-    
-    recommended_tracks = [cluster_tracks[i] for i in closest_indices if cluster_tracks[i]['id'] != track_data['id']]
-    
-    return recommended_tracks[:n_recommendations]
+    # TrackBatch of the tracks, read from the artist graph; tracks and audio features are fetched only for the rest
+    track_ids = list(dict.fromkeys(top_artist_rel))  # De-duplicate, keep order
+    graph = get_artist_graph()
+    graph.add_tracks(fetch_track_batch(sp, [track_id for track_id in track_ids if track_id not in graph.tracks]))
+    return graph.tracks.take(track_ids)
+
+def fetch_track_batch(sp, track_ids):
+    # TrackBatch of the available tracks, in order, batched to the multi-ID endpoints
+    if not track_ids:
+        return TrackBatch.empty()
+    track_chunks = list(chunked(track_ids, TRACKS_BATCH_SIZE))
+    feature_chunks = list(chunked(track_ids, AUDIO_FEATURES_BATCH_SIZE))
+    responses = gather([(sp.tracks, chunk) for chunk in track_chunks]
+                       + [(sp.audio_features, chunk) for chunk in feature_chunks],
+                       batch_timeout(len(track_chunks) + len(feature_chunks)))
+
+    # Key by requested ID, so a failed chunk only drops its own tracks
+    tracks = {}
+    for chunk, response in zip(track_chunks, responses[:len(track_chunks)]):
+        if response is not None:
+            tracks.update(zip(chunk, response['tracks']))
+    features = {}
+    for chunk, response in zip(feature_chunks, responses[len(track_chunks):]):
+        if response is not None:
+            features.update(zip(chunk, response))
+
+    records = []
+    for track_id in track_ids:
+        track = tracks.get(track_id)
+        track_features = features.get(track_id)
+        if track is None or track_features is None:
+            continue  # Unavailable track, no audio analysis or failed chunk
+        records.append(format_track(track_id, track, track_features))
+    return TrackBatch.from_records(records)
@@ -0,0 +1,114 @@
+import functools
+import hashlib
+import multiprocessing
+import os
+import pickle
+import re
+import threading
+import pandas as pd
+
+# nltk.download package name -> path checked locally with nltk.data.find
+NLTK_RESOURCES = {
+    'stopwords': 'corpora/stopwords',
+    'wordnet': 'corpora/wordnet',
+}
+
+_available = set()
+_lock = threading.Lock()
+
+def ensure_nltk_resource(name):
+    # Only hits the network when the resource is missing locally
+    if name in _available:
+        return
+    import nltk
+    with _lock:
+        if name not in _available:
+            try:
+                nltk.data.find(NLTK_RESOURCES[name])
+            except LookupError:
+                nltk.download(name, quiet=True)
+            _available.add(name)
+
+@functools.lru_cache(maxsize=None)
+def get_stop_words():
+    ensure_nltk_resource('stopwords')
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english'))
+
+@functools.lru_cache(maxsize=None)
+def get_lemmatizer():
+    ensure_nltk_resource('wordnet')
+    from nltk.stem import WordNetLemmatizer
+    return WordNetLemmatizer()
+
+# Letters only (movie descriptions) or letters and digits (book descriptions), matched on lowercased text
+ALPHA_TOKEN_RE = re.compile(r"[^\W\d_]+")
+ALNUM_TOKEN_RE = re.compile(r"[^\W_]+")
+PARALLEL_MIN_ROWS = 20000
+CHUNK_SIZE = 5000
+
+# sha1 of (options, text) -> preprocessed text, so unchanged descriptions are never reprocessed
+_processed = {}
+_used = set()  # Hashes looked up since load_preprocess_cache(); save_preprocess_cache() keeps only these
+
+@functools.lru_cache(maxsize=200000)
+def lemmatize(token):
+    return get_lemmatizer().lemmatize(token)
+
+def preprocess(text, lemmatize_tokens=False, alpha_only=True):
+    if text is None or text is pd.NA or (isinstance(text, float) and text != text):
+        return ''
+    token_re = ALPHA_TOKEN_RE if alpha_only else ALNUM_TOKEN_RE
+    stop_words = get_stop_words()
+    tokens = [token for token in token_re.findall(text.lower()) if token not in stop_words]
+    if lemmatize_tokens:
+        tokens = [lemmatize(token) for token in tokens]
+    return ' '.join(tokens)
+
+def content_hash(text, lemmatize_tokens, alpha_only):
+    key = f"{int(lemmatize_tokens)}{int(alpha_only)}:{text}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _preprocess_chunk(texts, lemmatize_tokens, alpha_only):
+    return [preprocess(text, lemmatize_tokens, alpha_only) for text in texts]
+
+def preprocess_series(series, lemmatize_tokens=False, alpha_only=True, n_jobs=1, cache=True):
+    # Batch version of preprocess() for a whole Series, returns a Series with the same index.
+    # cache=False leaves the content-hash cache untouched, for streaming ingestion.
+    texts = ['' if pd.isna(text) else str(text) for text in series]
+    hashes = [content_hash(text, lemmatize_tokens, alpha_only) for text in texts]
+
+    processed_cache = _processed if cache else {}
+    if cache:
+        _used.update(hashes)
+    todo = {}
+    for text, text_hash in zip(texts, hashes):
+        if text_hash not in _processed and text_hash not in processed_cache:
+            todo[text_hash] = text
+    if todo:
+        pending = list(todo.values())
+        if n_jobs > 1 and len(pending) >= PARALLEL_MIN_ROWS:
+            chunks = [pending[start:start + CHUNK_SIZE] for start in range(0, len(pending), CHUNK_SIZE)]
+            with multiprocessing.Pool(n_jobs) as pool:
+                results = pool.starmap(_preprocess_chunk, [(chunk, lemmatize_tokens, alpha_only) for chunk in chunks])
+            processed = [text for chunk in results for text in chunk]
+        else:
+            processed = _preprocess_chunk(pending, lemmatize_tokens, alpha_only)
+        processed_cache.update(zip(todo, processed))
+
+    return pd.Series([processed_cache[text_hash] if text_hash in processed_cache else _processed[text_hash]
+                      for text_hash in hashes], index=series.index, dtype=object)
+
+def load_preprocess_cache(path):
+    # Starts a build: entries not looked up before the matching save are dropped
+    _used.clear()
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            _processed.update(pickle.load(f))
+
+def save_preprocess_cache(path):
+    # Only the current build's texts, so removed or changed descriptions don't accumulate
+    for text_hash in _processed.keys() - _used:
+        del _processed[text_hash]
+    with open(path, 'wb') as f:
+        pickle.dump(_processed, f)
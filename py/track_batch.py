@@ -0,0 +1,201 @@
+import threading
+import numpy as np
+
+# Spotify tracks as columns instead of one 11-key dict per track
+FEATURE_KEYS = ['energy', 'tempo', 'valence']
+STRING_FIELDS = ['id', 'name', 'artist', 'artist_id', 'album', 'release_date', 'url', 'album_art_url']
+RECORD_KEYS = ['id', 'name', 'artist', 'artist_id', 'album', 'release_date', 'energy', 'tempo', 'valence',
+               'url', 'album_art_url']  # Key order of spotify_recc.format_track
+ID, ARTIST_ID = STRING_FIELDS.index('id'), STRING_FIELDS.index('artist_id')
+FEATURE_DTYPE = np.float32
+CODE_DTYPE = np.int32
+INITIAL_CAPACITY = 1024
+
+class StringTable:
+    # Interned strings of one TrackTable (or of a standalone batch), so the table lives, and grows,
+    # only as long as the tracks using it. Codes compare within a table: batches are recoded into a
+    # table's strings when added to it. Code 0 is None (e.g. a track without album art).
+    def __init__(self):
+        self.values = [None]
+        self.codes = {}
+        self.lock = threading.Lock()
+        self.array = self.as_array()  # For vectorised decoding; rebuilt once the table has grown past it
+
+    def intern(self, value):
+        if value is None:
+            return 0
+        code = self.codes.get(value)
+        if code is None:
+            with self.lock:
+                code = self.codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+    def as_array(self):
+        array = np.empty(len(self.values), dtype=object)
+        array[:] = self.values
+        return array
+
+    def intern_many(self, values):
+        return np.fromiter((self.intern(value) for value in values), dtype=CODE_DTYPE)
+
+    def decode(self, codes):
+        codes = np.asarray(codes)
+        array = self.array
+        if codes.size and codes.max() >= len(array):
+            with self.lock:
+                array = self.array = self.as_array()
+        return array[codes]
+
+class TrackBatch:
+    # Struct of arrays: float32 FEATURE_KEYS matrix and int32 codes into a StringTable, one column per
+    # STRING_FIELDS entry. Slicing returns views; dicts are only built at render time by to_records().
+    def __init__(self, features, codes, strings):
+        self.features = features
+        self.codes = codes
+        self.strings = strings
+
+    @classmethod
+    def empty(cls, strings=None):
+        strings = strings or StringTable()
+        return cls(np.empty((0, len(FEATURE_KEYS)), FEATURE_DTYPE), np.empty((0, len(STRING_FIELDS)), CODE_DTYPE), strings)
+
+    @classmethod
+    def from_columns(cls, columns, strings=None):
+        # columns: field -> sequence, for every FEATURE_KEYS and STRING_FIELDS entry
+        strings = strings or StringTable()
+        features = np.column_stack([np.asarray(columns[key], dtype=FEATURE_DTYPE) for key in FEATURE_KEYS])
+        codes = np.column_stack([strings.intern_many(columns[field]) for field in STRING_FIELDS])
+        return cls(features.reshape(-1, len(FEATURE_KEYS)), codes.reshape(-1, len(STRING_FIELDS)).astype(CODE_DTYPE), strings)
+
+    @classmethod
+    def from_records(cls, records, strings=None):
+        # records: dicts as returned by spotify_recc.format_track
+        records = list(records)
+        if not records:
+            return cls.empty(strings)
+        return cls.from_columns({key: [record.get(key) for record in records] for key in RECORD_KEYS}, strings)
+
+    @classmethod
+    def concat(cls, batches, strings=None):
+        # Into strings, else the first batch's table
+        if not batches:
+            return cls.empty(strings)
+        strings = strings or batches[0].strings
+        batches = [batch.recode(strings) for batch in batches]
+        return cls(np.concatenate([batch.features for batch in batches]),
+                   np.concatenate([batch.codes for batch in batches]), strings)
+
+    def recode(self, strings):
+        # The same tracks with codes into another table; a no-op for their own
+        if strings is self.strings:
+            return self
+        codes = strings.intern_many(self.strings.decode(self.codes.ravel())).reshape(self.codes.shape)
+        return TrackBatch(self.features, codes, strings)
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, rows):
+        # A slice is a view of the same arrays; an index array or mask copies the selected rows
+        if isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + 1 or None)
+        return TrackBatch(self.features[rows], self.codes[rows], self.strings)
+
+    def column(self, field):
+        if field in FEATURE_KEYS:
+            return self.features[:, FEATURE_KEYS.index(field)]
+        return self.strings.decode(self.codes[:, STRING_FIELDS.index(field)])
+
+    def ids(self):
+        return self.column('id')
+
+    def record(self, row):
+        return self[row].to_records()[0]
+
+    def to_records(self):
+        columns = {field: self.column(field).tolist() for field in STRING_FIELDS}
+        columns.update({key: self.column(key).astype(float).tolist() for key in FEATURE_KEYS})
+        return [dict(zip(RECORD_KEYS, values)) for values in zip(*(columns[key] for key in RECORD_KEYS))]
+
+    def compact(self):
+        # (strings, codes) with only the strings this batch uses, for saving it
+        used, inverse = np.unique(self.codes, return_inverse=True)
+        return self.strings.decode(used).tolist(), inverse.reshape(self.codes.shape).astype(CODE_DTYPE)
+
+    @classmethod
+    def from_compact(cls, values, codes, features, strings=None):
+        strings = strings or StringTable()
+        table = strings.intern_many(values)
+        codes = np.asarray(codes, dtype=np.int64).reshape(-1, len(STRING_FIELDS))
+        return cls(np.asarray(features, dtype=FEATURE_DTYPE).reshape(-1, len(FEATURE_KEYS)), table[codes], strings)
+
+    def to_state(self):
+        # JSON-compatible, e.g. for the response cache's SQLite layer
+        values, codes = self.compact()
+        return {'fields': STRING_FIELDS, 'strings': values, 'codes': codes.tolist(), 'features': self.features.tolist()}
+
+    @classmethod
+    def from_state(cls, state, strings=None):
+        if state['fields'] != STRING_FIELDS:
+            raise ValueError("track batch saved with different fields")
+        return cls.from_compact(state['strings'], state['codes'], state['features'], strings)
+
+class TrackTable:
+    # Growable column storage with an ID -> row map; rows are never rewritten, so batch() views stay valid
+    def __init__(self, strings=None, capacity=INITIAL_CAPACITY):
+        self.strings = strings or StringTable()
+        self.features = np.empty((capacity, len(FEATURE_KEYS)), FEATURE_DTYPE)
+        self.codes = np.empty((capacity, len(STRING_FIELDS)), CODE_DTYPE)
+        self.rows = {}
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, track_id):
+        return track_id in self.rows
+
+    def add(self, batch):
+        # Appends the tracks not stored yet; returns how many were added
+        with self.lock:
+            batch = batch.recode(self.strings)  # Under the lock: clear() replaces the strings
+            new = []
+            for i, track_id in enumerate(batch.ids().tolist()):
+                if track_id not in self.rows:
+                    self.rows[track_id] = self.size + len(new)
+                    new.append(i)
+            if not new:
+                return 0
+            end = self.size + len(new)
+            if end > len(self.features):
+                capacity = max(end, 2 * len(self.features))
+                self.features = np.concatenate([self.features[:self.size], np.empty((capacity - self.size, len(FEATURE_KEYS)), FEATURE_DTYPE)])
+                self.codes = np.concatenate([self.codes[:self.size], np.empty((capacity - self.size, len(STRING_FIELDS)), CODE_DTYPE)])
+            self.features[self.size:end] = batch.features[new]
+            self.codes[self.size:end] = batch.codes[new]
+            self.size = end
+            return len(new)
+
+    def batch(self):
+        with self.lock:
+            return TrackBatch(self.features[:self.size], self.codes[:self.size], self.strings)
+
+    def take(self, track_ids):
+        # Stored tracks among track_ids, in that order
+        with self.lock:
+            rows = [self.rows[track_id] for track_id in track_ids if track_id in self.rows]
+            return self.batch()[np.asarray(rows, dtype=np.int64)]
+
+    def clear(self):
+        # New arrays and strings, so batches taken before keep their rows
+        with self.lock:
+            self.strings = StringTable()
+            self.features = np.empty((INITIAL_CAPACITY, len(FEATURE_KEYS)), FEATURE_DTYPE)
+            self.codes = np.empty((INITIAL_CAPACITY, len(STRING_FIELDS)), CODE_DTYPE)
+            self.rows = {}
+            self.size = 0
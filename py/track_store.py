@@ -0,0 +1,184 @@
+import fcntl
+import json
+import os
+import threading
+import numpy as np
+from sklearn.neighbors import KDTree
+from track_batch import TrackBatch, TrackTable, StringTable, FEATURE_KEYS, STRING_FIELDS, ID, ARTIST_ID, INITIAL_CAPACITY
+
+TRACK_STORE_PATH = "track_store"  # .npz for the feature and code arrays, .json for the string table,
+# _delta.jsonl for tracks added since (one line each), folded into the other two on load
+REBUILD_THRESHOLD = 1000  # Tracks added since the last tree build before a background rebuild starts
+
+class TrackStore:
+    # Every track we have fetched, as one TrackTable (float32 features, interned strings)
+    # and a KD-tree over the standardised features for nearest-neighbour queries.
+    def __init__(self, path=None):
+        self.path = path
+        self.delta_path = path + '_delta.jsonl' if path else None
+        self.lock = threading.RLock()
+        self.table = TrackTable()
+        self.tree = None
+        self.tree_size = 0
+        self.mean = np.zeros(len(FEATURE_KEYS))
+        self.scale = np.ones(len(FEATURE_KEYS))
+        self.rebuilding = False
+        if path and (self.snapshot_exists() or os.path.exists(self.delta_path)):
+            self.load()
+
+    def __len__(self):
+        return len(self.table)
+
+    def add(self, tracks):
+        # tracks: a TrackBatch; returns how many were new. New tracks are appended to the delta
+        # log, so a request's write costs its own tracks rather than the whole store.
+        with self.lock:
+            start = len(self.table)
+            added = self.table.add(tracks)
+            new = self.table.batch()[start:] if added and self.path else None
+        if new is not None:
+            append_lines(self.delta_path, new.to_records())
+        return added
+
+    def standardise(self, features):
+        return (np.asarray(features, dtype=float) - self.mean) / self.scale
+
+    def rebuild_index(self):
+        # Built outside the lock from the rows stored so far (rows are only ever appended), then
+        # swapped in with its standardisation, unless load() replaced the table meanwhile
+        with self.lock:
+            table = self.table
+            features = table.batch().features
+        mean = features.mean(axis=0)
+        scale = features.std(axis=0)
+        scale = np.where(scale > 0, scale, 1.0)
+        tree = KDTree((np.asarray(features, dtype=float) - mean) / scale)
+        with self.lock:
+            if self.table is table and len(features) >= self.tree_size:
+                self.tree, self.mean, self.scale, self.tree_size = tree, mean, scale, len(features)
+
+    def start_rebuild(self):
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=self.background_rebuild, name='track-tree-rebuild', daemon=True).start()
+
+    def background_rebuild(self):
+        try:
+            self.rebuild_index()
+        finally:
+            self.rebuilding = False
+
+    def ensure_index(self):
+        # The first tree is built before querying; later ones in the background, while nearest()
+        # searches the rows added since brute force
+        if self.tree is None and len(self):
+            self.rebuild_index()
+        elif len(self) - self.tree_size > REBUILD_THRESHOLD:
+            self.start_rebuild()
+
+    def nearest(self, query, k):
+        # Tree rows plus the rows added since the tree was built
+        self.ensure_index()
+        with self.lock:
+            query = self.standardise(query).reshape(1, -1)
+            if self.tree is not None:
+                distances, indices = self.tree.query(query, k=min(k, self.tree_size))
+                distances, indices = distances[0], indices[0]
+            else:
+                distances, indices = np.empty(0), np.empty(0, dtype=np.int64)  # load() just reset it (tree_size is 0)
+            if len(self) > self.tree_size:
+                pending = self.standardise(self.table.batch().features[self.tree_size:])
+                pending_distances = np.linalg.norm(pending - query, axis=1)
+                distances = np.concatenate([distances, pending_distances])
+                indices = np.concatenate([indices, np.arange(self.tree_size, self.tree_size + len(pending))])
+                order = np.argsort(distances, kind='stable')[:k]
+                distances, indices = distances[order], indices[order]
+            return indices, distances
+
+    def recommend(self, track_data, n_recommendations=3, exclude_artist=True):
+        # Closest tracks to the first track of track_data by standardised energy/tempo/valence,
+        # not by the same artist; a TrackBatch of rows of the store
+        if len(self) == 0:
+            return TrackBatch.empty()
+        track_data = track_data.recode(self.table.strings)
+        query, query_codes = track_data.features[0], track_data.codes[0]
+        k = n_recommendations * 4 + 1
+        while True:
+            indices, _ = self.nearest(query, k)
+            tracks = self.table.batch()
+            codes = tracks.codes[indices]
+            keep = codes[:, ID] != query_codes[ID]
+            if exclude_artist:
+                keep &= codes[:, ARTIST_ID] != query_codes[ARTIST_ID]
+            selected = indices[keep][:n_recommendations]
+            if len(selected) == n_recommendations or k >= len(self):
+                return tracks[selected]
+            k *= 4
+
+    def snapshot_exists(self):
+        return os.path.exists(self.path + '.npz') and os.path.exists(self.path + '.json')
+
+    def save(self):
+        # Full snapshot of the in-memory table
+        with self.lock:
+            self.write_snapshot(self.table.batch())
+
+    def write_snapshot(self, tracks):
+        strings, codes = tracks.compact()
+        tmp_npz = self.path + '.tmp.npz'
+        np.savez(tmp_npz, features=tracks.features, codes=codes)
+        with open(self.path + '.json.tmp', 'w') as f:
+            json.dump({'fields': STRING_FIELDS, 'strings': strings}, f)
+        os.replace(tmp_npz, self.path + '.npz')
+        os.replace(self.path + '.json.tmp', self.path + '.json')
+
+    def read_snapshot(self, strings=None):
+        if not self.snapshot_exists():
+            return TrackBatch.empty(strings)
+        arrays = np.load(self.path + '.npz')
+        with open(self.path + '.json') as f:
+            meta = json.load(f)
+        if meta['fields'] != STRING_FIELDS:
+            raise ValueError(f"{self.path} was saved with different track fields")
+        return TrackBatch.from_compact(meta['strings'], arrays['codes'], arrays['features'], strings)
+
+    def load(self):
+        # Snapshot plus the delta log, folded into a new snapshot while the log is locked, so
+        # tracks appended meanwhile (e.g. by another serve.py worker) wait instead of being lost
+        with self.lock, open(self.delta_path, 'a+') as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            log.seek(0)
+            strings = StringTable()  # The new table's, so nothing is interned twice
+            appended = TrackBatch.from_records((json.loads(line) for line in log if line.strip()), strings)
+            tracks = self.read_snapshot(strings)
+            self.table = TrackTable(strings, capacity=max(INITIAL_CAPACITY, 2 * (len(tracks) + len(appended))))
+            self.table.add(tracks)
+            if self.table.add(appended):
+                self.write_snapshot(self.table.batch())
+            log.truncate(0)
+            self.tree = None
+            self.tree_size = 0
+
+def append_lines(path, items):
+    # One JSON object per line, written under the same lock load() folds the log under
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(''.join(json.dumps(item) + '\n' for item in items))
+
+_track_store = None
+_track_store_lock = threading.Lock()
+
+def get_track_store(path=TRACK_STORE_PATH):
+    global _track_store
+    if _track_store is None:
+        with _track_store_lock:
+            if _track_store is None:
+                _track_store = TrackStore(path)
+    return _track_store
+
+def add_and_recommend(track_data, track_features, n_recommendations=3):
+    store = get_track_store()
+    store.add(TrackBatch.concat([track_data, track_features]))
+    return store.recommend(track_data, n_recommendations)
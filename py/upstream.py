@@ -0,0 +1,36 @@
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# One pool per worker process for all upstream HTTP calls (Spotify, OMDb, Google Books)
+MAX_WORKERS = int(os.environ.get("RECC_UPSTREAM_WORKERS", 32))
+DEFAULT_TIMEOUT = 10  # Seconds per call, counted from when the fan-out starts
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='upstream')
+logger = logging.getLogger(__name__)
+
+def batch_timeout(n_calls, timeout=DEFAULT_TIMEOUT):
+    # gather() timeout for more calls than the pool has workers: they run in waves
+    return timeout * max(1, -(-n_calls // MAX_WORKERS))
+
+def gather(calls, timeout=DEFAULT_TIMEOUT, default=None):
+    # Run (func, *args) calls concurrently and return results in order.
+    # A call that fails or times out yields `default` instead of failing the request.
+    # Don't call gather() from inside a gathered call: nested waits can exhaust the pool.
+    # Each call runs in a copy of the caller's context, so per-request tracing follows it.
+    futures = [executor.submit(contextvars.copy_context().run, func, *args) for func, *args in calls]
+    deadline = time.monotonic() + timeout
+    results = []
+    for (func, *args), future in zip(calls, futures):
+        try:
+            results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+        except TimeoutError:
+            future.cancel()
+            logger.warning("%s%r timed out after %ss", func.__name__, tuple(args), timeout)
+            results.append(default)
+        except Exception:
+            logger.exception("%s%r failed", func.__name__, tuple(args))
+            results.append(default)
+    return results
@@ -1,12 +1,21 @@
 import sys
 import os
-import pandas as pd
-import numpy as np
-from sklearn.cluster import KMeans
-from flask import Flask, render_template, request, redirect, url_for, session
-from spotify_recc import authenticate_spotify, extract_track_id, get_track_details, get_related_artists, get_related_top, get_related_features, recommend_tracks
-from movie_recc import preprocess_text as preprocess_movie_text, compute_features, cosine_similarity_matrix, get_recommendations, extract_imdb_id, fill_missing_info
-from book_recc import fetch_book_details, extract_volume_id, format_book_data, preprocess_text as preprocess_book_text, compute_similarity, find_recommendations, search_google_books
+import threading
+import time
+import cProfile
+from flask import Flask, Response, jsonify, make_response, render_template, request, redirect, url_for, session, stream_with_context
+from spotify_recc import get_spotify_client, extract_track_id, get_track_details, get_related_artists, get_related_top, get_related_features
+from track_store import add_and_recommend
+from upstream import gather
+from movie_recc import extract_imdb_id
+from movie_index import load_movie_index
+from book_recc import extract_volume_id, search_google_books, NO_LINKS
+from book_index import load_book_index
+from catalogues import on_reload
+from delta_index import start_merge_thread
+from batch import recommend_batch, json_lines
+import metrics
+from metrics import span
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'
@@ -14,8 +23,43 @@ app.secret_key = 'supersecretkey'
 template_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'templates'))
 app.template_folder = template_dir
 
+# Requests with this header are profiled with cProfile when RECC_PROFILING=1 (or in debug mode)
+PROFILE_HEADER = 'X-Profile'
+PROFILE_DIR = os.environ.get("RECC_PROFILE_DIR", "profiles")
+profile_lock = threading.Lock()
+
+MAX_BATCH_LINKS = int(os.environ.get("RECC_MAX_BATCH_LINKS", 1000))
+
+# Similarity indexes per catalogue, built or loaded from disk on first use, then shared
+INDEX_LOADERS = {'imdb': load_movie_index, 'books': load_book_index}
+indexes = {}
+indexes_lock = threading.Lock()
+merge_thread = None
+merges_enabled = True  # serve.py turns this off: its supervisor folds the deltas in between generations
+
+def get_index(name):
+    global merge_thread
+    index = indexes.get(name)
+    if index is None:
+        with indexes_lock:
+            index = indexes.get(name)
+            if index is None:
+                index = INDEX_LOADERS[name]()
+                indexes[name] = index
+            if merge_thread is None and merges_enabled:
+                merge_thread = start_merge_thread(lambda: list(indexes.values()))
+    return index
+
+@on_reload
+def reload_index(name):
+    # Called via catalogues.reload_catalogues() when a dataset is refreshed
+    if name in INDEX_LOADERS:
+        index = INDEX_LOADERS[name]()
+        with indexes_lock:
+            indexes[name] = index
+
 def authenticate_spotify_with_form(client_id, client_secret):
-    return authenticate_spotify(client_id, client_secret)
+    return get_spotify_client(client_id, client_secret)
 
 @app.route('/')
 def index():
@@ -27,8 +71,7 @@ def process_link():
         link = request.form['link']
         return redirect(url_for('index'))
 
-@app.route('/recommend', methods=['POST'])
-def recommend():
+def recommend_page():
     if 'spotify_client_id' in session and 'spotify_client_secret' in session:
         spotify_client_id = session['spotify_client_id']
         spotify_client_secret = session['spotify_client_secret']
@@ -38,12 +81,13 @@ def recommend():
         session['spotify_client_id'] = spotify_client_id
         session['spotify_client_secret'] = spotify_client_secret
 
-    sp = authenticate_spotify_with_form(spotify_client_id, spotify_client_secret)
     link = request.form['link']
     recommendations = []
     recommendations_title = ""
 
     if "open.spotify.com" in link or "spotify:track:" in link:
+        with span('authenticate'):
+            sp = authenticate_spotify_with_form(spotify_client_id, spotify_client_secret)
         if sp is None:
             error_message = "Spotify authentication failed. Please check your credentials and try again."
             session.pop('spotify_client_id', None)
@@ -52,17 +96,20 @@ def recommend():
 
         spotify_url = link
         track_id = extract_track_id(spotify_url)
-        track_data = get_track_details(sp, track_id)
-        artist_id = track_data['artist_id']
-        related_artists = get_related_artists(sp, artist_id)
-        top_artist_rel = get_related_top(sp, related_artists)
-        track_features = get_related_features(sp, top_artist_rel)
-        X = np.array([[f['energy'], f['tempo'], f['valence']] for f in track_features])
-        kmeans = KMeans(n_clusters=5, random_state=0).fit(X)
-
-        recommended_tracks = recommend_tracks(track_data, track_features, kmeans)
-        recommendations_title = f"Recommendations for '{track_data['name']}' by {track_data['artist']}:"
-        for track in recommended_tracks:
+        with span('track_details'):
+            track_data = get_track_details(sp, track_id)
+        track = track_data.record(0)
+        artist_id = track['artist_id']
+        with span('related_artists'):
+            related_artists = get_related_artists(sp, artist_id)
+        with span('related_top_tracks'):
+            top_artist_rel = get_related_top(sp, related_artists)
+        with span('related_features'):
+            track_features = get_related_features(sp, top_artist_rel)
+        with span('recommend'):
+            recommended_tracks = add_and_recommend(track_data, track_features)
+        recommendations_title = f"Recommendations for '{track['name']}' by {track['artist']}:"
+        for track in recommended_tracks.to_records():
             recommendations.append({
                 'title': track['name'],
                 'album': track['album'],
@@ -72,21 +119,15 @@ def recommend():
             })
 
     elif "imdb.com/title/tt" in link:
-        df = pd.read_csv("imdb-movies-dataset.csv")
-        df['Genre'] = df['Genre'].fillna('')
-        df['Genre'] = df['Genre'].astype(str)
-        df['Genre'] = df['Genre'].apply(lambda x: x.split(', '))
-
         imdb_id = extract_imdb_id(link)
         if imdb_id:
-            df = fill_missing_info(df, imdb_id)
-            if not df.empty:
-                df['preprocessed_description'] = df['Description'].apply(preprocess_movie_text)
-                combined_features = compute_features(df)
-                cosine_sim = cosine_similarity_matrix(combined_features)
-                movie_title = df.iloc[-1]['Title']
+            with span('load_index'):
+                movie_index = get_index('imdb')
+            with span('recommend'):
+                movie, recommendations_data = movie_index.recommend_for_imdb_id(imdb_id)
+            if movie is not None:
+                movie_title = movie['Title']
                 recommendations_title = f"Recommendations for '{movie_title}':"
-                recommendations_data = get_recommendations(movie_title, cosine_sim, df)
                 for movie in recommendations_data:
                     recommendations.append({
                         'title': movie['Title'],
@@ -101,50 +142,99 @@ def recommend():
             recommendations_title = "Invalid IMDb link. Please provide a valid IMDb link."
 
     elif "google" and "books" in link:
-        df = pd.read_csv("goodreads_data.csv")
-        df.drop(columns=["Unnamed: 0", "URL"], inplace=True)
-        df.dropna(inplace=True)
-        df["Genres"] = df["Genres"].str.split(", ").apply(lambda x: [genre.strip("[]") for genre in x])
-        df["Genres"] = df["Genres"].apply(lambda x: ', '.join(x))
-        df["Genres"] = df["Genres"].apply(lambda x: x.replace("'", ""))
-
         volume_id = extract_volume_id(link)
-        book_data = fetch_book_details(volume_id)
-        formatted_data = format_book_data(book_data)
-
-        input_book = formatted_data["Book"]
-        recommendations_title = f"Recommendations for '{input_book}':"
-        input_description = preprocess_book_text(formatted_data["Description"])
-        input_genres = preprocess_book_text(formatted_data["Genres"])
-
-        input_book_df = pd.DataFrame([{
-            "Book": input_book,
-            "Description": input_description,
-            "Genres": input_genres,
-            "Author": formatted_data["Author"]
-        }])
-
-        df_extended = pd.concat([df, input_book_df], ignore_index=True)
-        description_similarity, genre_similarity = compute_similarity(df_extended["Description"], df_extended["Genres"])
-        input_book_idx = df_extended.index[df_extended["Book"] == input_book][0]
-        recommendations_data = find_recommendations(input_book_idx, df_extended, description_similarity, genre_similarity)
-
-        for book, author in recommendations_data:
-            cover_url, book_url = search_google_books(book, author)
-            book_row = df_extended[df_extended['Book'] == book].iloc[0]
-            recommendations.append({
-                'title': book,
-                'author': author,
-                'description': book_row['Description'],
-                'genres': book_row['Genres'],
-                'cover_url': cover_url,
-                'book_url': book_url
-            })
+        with span('load_index'):
+            book_index = get_index('books')
+        with span('recommend'):
+            book, recommendations_data = book_index.recommend_for_volume_id(volume_id) if volume_id else (None, [])
+        if book is not None:
+            recommendations_title = f"Recommendations for '{book['Book']}':"
+
+            # Cover/link lookups for all recommended books run concurrently
+            with span('enrich'):
+                book_links = gather([(search_google_books, row['Book'], row['Author']) for row in recommendations_data], default=NO_LINKS)
+                book_links = [links or NO_LINKS for links in book_links]
+            for row, (cover_url, book_url) in zip(recommendations_data, book_links):
+                recommendations.append({
+                    'title': row['Book'],
+                    'author': row['Author'],
+                    'description': row['Description'],
+                    'genres': row['Genres'],
+                    'cover_url': cover_url,
+                    'book_url': book_url
+                })
+        else:
+            recommendations_title = "Failed to retrieve book information from Google Books."
 
     else:
         recommendations_title = "Unsupported link format. Please provide a Spotify track URL, an IMDb link, or a Google Books URL."
 
-    return render_template('index.html', recommendations=recommendations, recommendations_title=recommendations_title)
+    with span('render'):
+        return render_template('index.html', recommendations=recommendations, recommendations_title=recommendations_title)
+
+def link_branch(link):
+    # Same order of checks as recommend_page(), for labelling metrics
+    if "open.spotify.com" in link or "spotify:track:" in link:
+        return 'spotify'
+    if "imdb.com/title/tt" in link:
+        return 'imdb'
+    if "books" in link:
+        return 'books'
+    return 'other'
+
+def profiling_requested():
+    enabled = app.debug or os.environ.get("RECC_PROFILING") == "1"
+    return enabled and request.headers.get(PROFILE_HEADER) == '1'
+
+def save_profile(profiler, branch):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"recommend-{branch}-{int(time.time() * 1000)}.prof")
+    profiler.dump_stats(path)  # Inspect with `python -m pstats` or snakeviz
+    return path
+
+@app.route('/recommend', methods=['POST'])
+def recommend():
+    # Spans per stage go to /metrics and, for this request, to the Server-Timing header
+    trace, token = metrics.start_trace(link_branch(request.form.get('link', '')))
+    # One profiled request at a time: the interpreter has a single profiler slot
+    profiler = None
+    if profiling_requested() and profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        response = make_response(recommend_page())
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile_lock.release()
+        metrics.end_trace(trace, token)
+    response.headers['Server-Timing'] = trace.server_timing()
+    if profiler is not None:
+        response.headers['X-Profile-Path'] = save_profile(profiler, trace.branch)
+    return response
+
+@app.route('/recommend/batch', methods=['POST'])
+def recommend_batch_endpoint():
+    # JSON list of links, or {"links": [...], "spotify_client_id": ..., "spotify_client_secret": ...};
+    # answers with one JSON line per link, streamed as each link type finishes
+    payload = request.get_json(silent=True)
+    if isinstance(payload, list):
+        payload = {'links': payload}
+    links = payload.get('links') if isinstance(payload, dict) else None
+    if not isinstance(links, list) or not all(isinstance(link, str) for link in links):
+        return jsonify(error="Expected a JSON list of links."), 400
+    if len(links) > MAX_BATCH_LINKS:
+        return jsonify(error=f"At most {MAX_BATCH_LINKS} links per batch."), 413
+
+    client_id = payload.get('spotify_client_id') or session.get('spotify_client_id')
+    client_secret = payload.get('spotify_client_secret') or session.get('spotify_client_secret')
+    sp = authenticate_spotify_with_form(client_id, client_secret) if client_id and client_secret else None
+    results = recommend_batch(links, sp, lambda: get_index('imdb'), lambda: get_index('books'))
+    return Response(stream_with_context(json_lines(results)), mimetype='application/x-ndjson')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
     app.run(debug=True, port=8000)